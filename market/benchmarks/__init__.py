@@ -0,0 +1,10 @@
+"""
+Benchmarks of the bot and the broker path.
+
+Run from the `market` directory, e.g.:
+```
+python -m benchmarks.bench_update_processor
+```
+They don't need Telegram or RabbitMQ, scripts that use the database
+create a separate test database (see `_django.test_database`).
+"""
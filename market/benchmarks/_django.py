@@ -0,0 +1,32 @@
+"""Django set up for benchmark scripts."""
+import os
+import tempfile
+from contextlib import contextmanager
+
+import django
+
+DEFAULT_TEST_DB = os.path.join(tempfile.gettempdir(), "market_bench.sqlite3")
+
+
+def setup():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "market.settings")
+    django.setup()
+
+
+@contextmanager
+def test_database(name: str = DEFAULT_TEST_DB):
+    """
+    Create a migrated database for the benchmark and delete it after.
+
+    It is a file (not in memory), so threads of the db executor share it.
+    The database of the project is not touched.
+    """
+    from django.conf import settings
+    from django.test.utils import setup_databases, teardown_databases
+
+    settings.DATABASES["default"].setdefault("TEST", {})["NAME"] = name
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
@@ -0,0 +1,92 @@
+"""
+Encode and decode time and size of shop messages by codec.
+
+Compares Django serializers (how messages were built before
+`rabbit.codecs`) with the JSON and binary codecs, for full objects (the
+received Shop instance is built) and for delta messages.
+```
+python -m benchmarks.bench_codecs --number 20000
+```
+"""
+import argparse
+import timeit
+
+from benchmarks import _django
+
+_django.setup()
+
+from django.core import serializers
+
+from rabbit import broker, codecs
+from shop.models import Shop
+
+UPDATE = broker.UPDATE_OPERATION
+
+
+def make_shop() -> Shop:
+    """Shop with typical values."""
+    return Shop(
+        pk=123,
+        name="Магазин посуды",
+        slug="shop-123",
+        client_id="1234567",
+        ozon_api_key="a" * 36,
+        shipper_api_key="b" * 64,
+        is_active=True,
+        price_updating=False,
+        version=8,
+    )
+
+
+def measure(func, number: int) -> float:
+    """:return: mean time of a call in microseconds."""
+    return timeit.timeit(func, number=number) / number * 1e6
+
+
+def main(args):
+    shop = make_shop()
+    fields = [field.name for field in codecs.get_synchronised_fields(Shop)]
+    django_body = serializers.serialize("json", [shop], fields=fields)
+    rows = [(
+        "django serializers",
+        measure(lambda: serializers.serialize("json", [shop], fields=fields),
+                args.number),
+        measure(lambda: next(serializers.deserialize(
+            "json", django_body, ignorenonexistent=True)).object,
+            args.number),
+        len(django_body.encode()),
+    )]
+    for codec in (codecs.JSONCodec(), codecs.BinaryCodec()):
+        body = codec.encode(codecs.record_from_instance(shop), UPDATE, False)
+        rows.append((
+            codec.content_type,
+            measure(lambda: codec.encode(
+                codecs.record_from_instance(shop), UPDATE, False),
+                args.number),
+            measure(lambda: codec.decode(
+                body, Shop, UPDATE, False).to_instance(), args.number),
+            len(body),
+        ))
+    for codec in (codecs.JSONCodec(), codecs.BinaryCodec()):
+        body = codec.encode(
+            codecs.record_from_instance(shop, ["is_active"]), UPDATE, True)
+        rows.append((
+            f"{codec.content_type} delta",
+            measure(lambda: codec.encode(
+                codecs.record_from_instance(shop, ["is_active"]),
+                UPDATE, True), args.number),
+            measure(lambda: codec.decode(body, Shop, UPDATE, True),
+                    args.number),
+            len(body),
+        ))
+
+    print(f"Shop, mean of {args.number} calls")
+    print(f"{'':36}{'encode us':>10}{'decode us':>10}{'bytes':>7}")
+    for name, encode_us, decode_us, size in rows:
+        print(f"{name:36}{encode_us:>10.1f}{decode_us:>10.1f}{size:>7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--number", type=int, default=20000)
+    main(parser.parse_args())
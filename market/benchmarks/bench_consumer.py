@@ -0,0 +1,137 @@
+"""
+Throughput of consumed shop messages without RabbitMQ.
+
+Update messages for `--shops` shops are submitted to
+`rabbit.consumer.PartitionedWorkers` with `callbacks.on_message_shop`
+(and `on_messages_shop` if `--batch-size` > 1), as the consumer does
+with delivered messages. Checks that the last update of every shop is
+applied and all messages are acked.
+`--db-latency-ms` adds a sleep to every callback call, as a round trip
+to a remote database.
+```
+python -m benchmarks.bench_consumer --workers 1 4 8 --db-latency-ms 5
+```
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from benchmarks import _django
+
+_django.setup()
+
+from django.conf import settings
+
+from rabbit import broker, callbacks, codecs, consumer
+from shop.models import Shop
+from tg_bot import db_executor
+
+
+class StubMessage:
+    """Delivered message, remembers if it is acked (or rejected)."""
+    redelivered = False
+    content_type = codecs.JSON_CONTENT_TYPE
+
+    def __init__(self, delivered: list["StubMessage"], body: bytes,
+                 headers: dict):
+        """:param delivered: messages of the channel in delivery order."""
+        self.delivered = delivered
+        self.delivery_tag = len(delivered)
+        delivered.append(self)
+        self.body = body
+        self.headers = headers
+        self.message_id = uuid.uuid4().hex
+        self.is_processed = False
+
+    async def ack(self, multiple: bool = False):
+        if multiple:
+            for message in self.delivered[:self.delivery_tag + 1]:
+                message.is_processed = True
+        self.is_processed = True
+
+    async def reject(self, requeue: bool = False):
+        self.is_processed = True
+
+
+def make_messages(shops: list[Shop], rounds: int,
+                  label: str) -> list[StubMessage]:
+    """`rounds` updates of every shop, the name is `<pk>-<label>-<round>`."""
+    codec = codecs.get_codec(StubMessage.content_type)
+    messages = []
+    delivered = []
+    for round_ in range(rounds):
+        for shop in shops:
+            shop.name = f"{shop.pk}-{label}-{round_}"
+            shop.version += 1
+            body = codec.encode(codecs.record_from_instance(shop),
+                                broker.UPDATE_OPERATION, False)
+            messages.append(StubMessage(delivered, body, {
+                broker.OPERATION_KEY: broker.UPDATE_OPERATION,
+                broker.VERSION_KEY: shop.version,
+            }))
+    return messages
+
+
+def with_latency(callback, latency: float):
+    async def wrapper(*args):
+        await asyncio.sleep(latency)
+        return await callback(*args)
+    return wrapper
+
+
+async def measure(args, shops: list[Shop], workers: int) -> str:
+    label = f"w{workers}"
+    messages = make_messages(shops, args.rounds, label)
+    latency = args.db_latency_ms / 1000
+    batch_callback = None
+    if args.batch_size > 1:
+        batch_callback = with_latency(callbacks.on_messages_shop, latency)
+    message_workers = consumer.PartitionedWorkers(
+        with_latency(callbacks.on_message_shop, latency),
+        workers,
+        partition_key=callbacks.get_shop_pk,
+        batch_callback=batch_callback,
+        batch_size=args.batch_size,
+        batch_wait=args.batch_wait_ms / 1000,
+    )
+    message_workers.start()
+    started_at = time.perf_counter()
+    for message in messages:
+        await message_workers.submit(message)
+    await message_workers.join()
+    elapsed = time.perf_counter() - started_at
+    await message_workers.stop()
+
+    names = await db_executor.run(
+        lambda: set(Shop.objects.values_list("name", flat=True)))
+    last_applied = names == {f"{shop.pk}-{label}-{args.rounds - 1}"
+                             for shop in shops}
+    all_acked = all(message.is_processed for message in messages)
+    return (f"workers={workers:<3} {len(messages)} messages "
+            f"{len(messages) / elapsed:7.0f} msg/s, "
+            f"last update applied: {last_applied}, all acked: {all_acked}")
+
+
+def main(args):
+    with _django.test_database():
+        shops = [Shop.objects.create(name=f"shop {i}", client_id="1",
+                                     ozon_api_key=f"key {i}")
+                 for i in range(args.shops)]
+        print(f"{args.shops} shops, {args.rounds} updates of each, "
+              f"batch size {args.batch_size}, "
+              f"db latency {args.db_latency_ms} ms")
+        for workers in args.workers:
+            print(asyncio.run(measure(args, shops, workers)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--shops", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=8)
+    parser.add_argument("--db-latency-ms", type=float, default=0)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--batch-wait-ms", type=float,
+                        default=settings.RMQ_CONSUMER_BATCH_WAIT_MS)
+    main(parser.parse_args())
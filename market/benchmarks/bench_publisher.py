@@ -0,0 +1,156 @@
+"""
+Publishes per second: a connection per message vs the pooled publisher.
+
+The old way is how Shop signals published before `rabbit.publisher`:
+`asyncio.run` with a new connection, channel and exchange declaration
+for every message. The new way enqueues all messages from the main
+thread with `Publisher.publish_threadsafe` and waits for confirmations.
+
+Uses RabbitMQ from settings (RMQ_HOST, etc.), messages go to the
+`--exchange` exchange without queues, so they are dropped by the broker.
+Without a broker use `--stub-rtt-ms`: every AMQP call (connect, open
+channel, declare, publish with confirmation, close) sleeps for the
+given round trip time.
+```
+python -m benchmarks.bench_publisher --stub-rtt-ms 1
+```
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from benchmarks import _django
+
+_django.setup()
+
+from aio_pika import ExchangeType, Message, connect_robust
+from django.conf import settings
+
+from rabbit import publisher
+
+
+class StubBroker:
+    """Connection factory whose calls only wait for the round trip."""
+
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.calls = Counter()
+
+    async def call(self, name: str):
+        self.calls[name] += 1
+        await asyncio.sleep(self.rtt)
+
+    async def connect(self, **kwargs) -> "StubConnection":
+        await self.call("connections")
+        return StubConnection(self)
+
+
+class StubConnection:
+    def __init__(self, broker: StubBroker):
+        self.broker = broker
+
+    async def channel(self, **kwargs) -> "StubChannel":
+        await self.broker.call("channels")
+        return StubChannel(self.broker)
+
+    async def close(self):
+        await self.broker.call("closes")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class StubChannel:
+    def __init__(self, broker: StubBroker):
+        self.broker = broker
+
+    async def declare_exchange(self, *args, **kwargs) -> "StubExchange":
+        await self.broker.call("declarations")
+        return StubExchange(self.broker)
+
+
+class StubExchange:
+    def __init__(self, broker: StubBroker):
+        self.broker = broker
+
+    async def publish(self, message: Message, routing_key: str, **kwargs):
+        await self.broker.call("publishes")
+
+
+async def send_with_new_connection(connect, exchange_name: str,
+                                   message: Message):
+    """Old `Broker.send`."""
+    connection = await connect(
+        host=settings.RMQ_HOST,
+        port=settings.RMQ_PORT,
+        login=settings.RMQ_LOGIN,
+        password=settings.RMQ_PASSWORD,
+    )
+    async with connection:
+        channel = await connection.channel()
+        exchange = await channel.declare_exchange(
+            exchange_name, ExchangeType.DIRECT)
+        await exchange.publish(message, routing_key=exchange_name)
+
+
+def bench_new_connections(connect, exchange_name: str,
+                          messages: int) -> float:
+    started_at = time.perf_counter()
+    for i in range(messages):
+        asyncio.run(send_with_new_connection(
+            connect, exchange_name, Message(str(i).encode())))
+    return messages / (time.perf_counter() - started_at)
+
+
+def bench_publisher(channels: int, exchange_name: str,
+                    messages: int) -> float:
+    pooled_publisher = publisher.Publisher(channels)
+    # connect and declare before measuring, as in a running process
+    pooled_publisher.publish_threadsafe(
+        exchange_name, Message(b"warm up"), exchange_name).result()
+    started_at = time.perf_counter()
+    futures = [
+        pooled_publisher.publish_threadsafe(
+            exchange_name, Message(str(i).encode()), exchange_name)
+        for i in range(messages)
+    ]
+    for future in futures:
+        future.result()
+    result = messages / (time.perf_counter() - started_at)
+    pooled_publisher.stop()
+    return result
+
+
+def main(args):
+    connect = connect_robust
+    stub = None
+    if args.stub_rtt_ms is not None:
+        stub = StubBroker(args.stub_rtt_ms / 1000)
+        connect = stub.connect
+        publisher.connect_robust = stub.connect
+        print(f"stub broker, round trip {args.stub_rtt_ms} ms")
+
+    old = bench_new_connections(connect, args.exchange, args.messages)
+    if stub is not None:
+        print(f"connection per message: {dict(stub.calls)}")
+        stub.calls.clear()
+    new = bench_publisher(args.channels, args.exchange, args.messages)
+    if stub is not None:
+        print(f"pooled publisher: {dict(stub.calls)}")
+    print(f"{args.messages} messages: connection per message {old:.0f} "
+          f"msg/s, pooled publisher ({args.channels} channels) "
+          f"{new:.0f} msg/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--channels", type=int,
+                        default=settings.RMQ_PUBLISHER_CHANNELS)
+    parser.add_argument("--exchange", default="bench_publisher")
+    parser.add_argument("--stub-rtt-ms", type=float, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,94 @@
+"""
+Latency of a shop list page depending on its position in a big table.
+
+Compares the old `OFFSET` query with keyset pagination (`id > after`),
+both as plain queries and through
+`ShopService.paginate_shops_for_buttons` (with the db executor, without
+the page cache).
+```
+python -m benchmarks.bench_shop_pagination --shops 300000
+```
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks import _django
+
+_django.setup()
+
+from django.conf import settings
+
+from shop.models import Shop
+from shop.services import ShopService
+
+
+def create_shops(count: int):
+    Shop.objects.bulk_create(
+        (Shop(name=f"shop {i}", client_id="1", ozon_api_key=f"key {i}")
+         for i in range(count)),
+        batch_size=5000,
+    )
+
+
+def measure_sync(func, runs: int) -> float:
+    """:return: mean time of a call in ms."""
+    started_at = time.perf_counter()
+    for _ in range(runs):
+        func()
+    return (time.perf_counter() - started_at) / runs * 1000
+
+
+async def measure_async(func, runs: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(runs):
+        await func()
+    return (time.perf_counter() - started_at) / runs * 1000
+
+
+def main(args):
+    with _django.test_database():
+        create_shops(args.shops)
+        ids = list(Shop.objects.order_by("id").values_list("id", flat=True))
+        shops = Shop.objects.only("name", "is_active")
+        positions = {
+            "first": 0,
+            "middle": len(ids) // 2,
+            "last": len(ids) - args.limit,
+        }
+        print(f"{len(ids)} shops, {args.limit} per page, "
+              f"mean of {args.runs} runs, ms")
+        print(f"{'page':<8}{'offset':>10}{'keyset':>10}{'service':>10}")
+        for name, position in positions.items():
+            after = ids[position - 1] if position else None
+
+            def offset_page():
+                return list(
+                    shops.order_by("id")[position:position + args.limit])
+
+            def keyset_page():
+                qs = shops.order_by("id")
+                if after is not None:
+                    qs = qs.filter(id__gt=after)
+                return list(qs[:args.limit])
+
+            def service_page():
+                return ShopService().paginate_shops_for_buttons(
+                    Shop.objects.all(), args.limit, after=after)
+
+            assert ([shop.pk for shop in offset_page()]
+                    == [shop.pk for shop in keyset_page()])
+            offset_ms = measure_sync(offset_page, args.runs)
+            keyset_ms = measure_sync(keyset_page, args.runs)
+            service_ms = asyncio.run(measure_async(service_page, args.runs))
+            print(f"{name:<8}{offset_ms:>10.2f}{keyset_ms:>10.2f}"
+                  f"{service_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--shops", type=int, default=300_000)
+    parser.add_argument("--limit", type=int,
+                        default=settings.TG_BOT_LIST_LIMIT)
+    parser.add_argument("--runs", type=int, default=20)
+    main(parser.parse_args())
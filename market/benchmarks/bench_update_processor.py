@@ -0,0 +1,82 @@
+"""
+Throughput of update processing with N chats sending at the same time.
+
+Compares sequential processing (`concurrent_updates(False)`, i.e.
+SimpleUpdateProcessor(1)) with ChatOrderedUpdateProcessor. The handler
+only sleeps (`--handler-ms`), as a handler waiting for the database or
+Telegram. Also checks that updates of every chat are processed in order.
+```
+python -m benchmarks.bench_update_processor --chats 1 10 50
+```
+"""
+import argparse
+import asyncio
+import datetime
+import time
+
+from benchmarks import _django
+
+_django.setup()
+
+from django.conf import settings
+from telegram import Chat, Message, Update, User
+from telegram.ext import SimpleUpdateProcessor
+
+from tg_bot.update_processor import ChatOrderedUpdateProcessor
+
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    message = Message(
+        update_id,
+        datetime.datetime.now(),
+        Chat(chat_id, Chat.PRIVATE),
+        from_user=User(chat_id, "user", False),
+        text="text",
+    )
+    return Update(update_id, message=message)
+
+
+async def measure(processor, chats: int, updates_per_chat: int,
+                  handler_delay: float) -> tuple[float, bool]:
+    """:return: updates per second, True if every chat was in order."""
+    processed: dict[int, list[int]] = {}
+
+    async def handler(update: Update):
+        await asyncio.sleep(handler_delay)
+        processed.setdefault(update.effective_chat.id, []).append(
+            update.update_id)
+
+    updates = [make_update(i * chats + chat_id, chat_id)
+               for i in range(updates_per_chat)
+               for chat_id in range(1, chats + 1)]
+    started_at = time.perf_counter()
+    await asyncio.gather(*(processor.process_update(update, handler(update))
+                           for update in updates))
+    elapsed = time.perf_counter() - started_at
+    is_ordered = all(ids == sorted(ids) for ids in processed.values())
+    return len(updates) / elapsed, is_ordered
+
+
+async def main(args):
+    print(f"handler {args.handler_ms} ms, {args.updates_per_chat} updates "
+          f"per chat, {args.concurrent_updates} concurrent updates")
+    for chats in args.chats:
+        sequential, _ = await measure(
+            SimpleUpdateProcessor(1), chats, args.updates_per_chat,
+            args.handler_ms / 1000)
+        ordered, is_ordered = await measure(
+            ChatOrderedUpdateProcessor(args.concurrent_updates), chats,
+            args.updates_per_chat, args.handler_ms / 1000)
+        print(f"chats={chats:<4} sequential {sequential:7.0f} upd/s, "
+              f"per chat ordered {ordered:7.0f} upd/s, "
+              f"in order: {is_ordered}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--chats", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--updates-per-chat", type=int, default=10)
+    parser.add_argument("--handler-ms", type=float, default=10)
+    parser.add_argument("--concurrent-updates", type=int,
+                        default=settings.TG_BOT_CONCURRENT_UPDATES)
+    asyncio.run(main(parser.parse_args()))
@@ -83,10 +83,22 @@ WSGI_APPLICATION = 'market.wsgi.application'
 DATABASE_DIR = BASE_DIR / "database"
 DATABASE_DIR.mkdir(exist_ok=True)
 
+# seconds to keep connection open, used by threads of the bot db executor
+DB_CONN_MAX_AGE = int(getenv("DB_CONN_MAX_AGE", "600"))
+# seconds to wait for a locked SQLite database
+DB_BUSY_TIMEOUT = int(getenv("DB_BUSY_TIMEOUT", "20"))
+# SQLite write-ahead log, readers do not wait for a writer
+DB_SQLITE_WAL = getenv("DB_SQLITE_WAL", "1") == "1"
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': DATABASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': DB_BUSY_TIMEOUT,
+        },
     }
 }
 
@@ -140,14 +152,93 @@ TG_BOT_LIST_LIMIT = int(getenv('TG_BOT_LIST_LIMIT', "5"))
 TG_REPORT_CHAT_ID = getenv('TG_REPORT_CHAT_ID', None)
 TG_HELP_ADMIN_USERNAME = getenv("TG_HELP_ADMIN_USERNAME")
 TG_AUTO_CUSTOMISATION = getenv('TG_AUTO_CUSTOMISATION', "1") == "1"
+# updates from different chats processed at the same time
+# (updates from one chat are always processed in order)
+TG_BOT_CONCURRENT_UPDATES = int(getenv("TG_BOT_CONCURRENT_UPDATES", "32"))
+# seconds between writes of changed chat_data and conversations to db
+TG_PERSISTENCE_FLUSH_INTERVAL = float(
+    getenv("TG_PERSISTENCE_FLUSH_INTERVAL", "5"))
+# worker processes sharded by chat_id, 0 - handle updates in main process
+TG_BOT_WORKERS = int(getenv("TG_BOT_WORKERS", "0"))
 
 TG_PAYMENT_PROVIDER_TOKEN = getenv('TG_PAYMENT_PROVIDER_TOKEN')
 
+# admin password checks running at the same time (in threads)
+TG_PASSWORD_CHECK_WORKERS = int(getenv("TG_PASSWORD_CHECK_WORKERS", "2"))
+# failed admin logins (per chat and per username) before throttling
+TG_LOGIN_MAX_FAILED_ATTEMPTS = int(getenv("TG_LOGIN_MAX_FAILED_ATTEMPTS", "5"))
+TG_LOGIN_THROTTLE_SECONDS = int(getenv("TG_LOGIN_THROTTLE_SECONDS", "300"))
+# threads (with own db connections) for ORM queries of the bot
+TG_DB_EXECUTOR_WORKERS = int(getenv("TG_DB_EXECUTOR_WORKERS", "4"))
+# handlers' queries go first, background work (broker messages, etc.)
+# gets at least this share of the executor while it waits
+TG_DB_BACKGROUND_MIN_SHARE = float(
+    getenv("TG_DB_BACKGROUND_MIN_SHARE", "0.2"))
+# cache of TelegramUser statuses (ban, subscription, role) by chat_id
+TG_USER_STATUS_CACHE_SIZE = int(getenv("TG_USER_STATUS_CACHE_SIZE", "10000"))
+TG_USER_STATUS_CACHE_TTL = int(getenv("TG_USER_STATUS_CACHE_TTL", "60"))
+# seconds between checks of TgUser changes made by other processes (e.g.
+# a ban in the admin site), 0 to rely on the cache TTL only
+TG_USER_STATUS_CHECK_INTERVAL = float(getenv("TG_USER_STATUS_CHECK_INTERVAL", "2"))
+# cache of shop data shown in shop menus, by Shop.pk
+TG_SHOP_INFO_CACHE_SIZE = int(getenv("TG_SHOP_INFO_CACHE_SIZE", "10000"))
+TG_SHOP_INFO_CACHE_TTL = int(getenv("TG_SHOP_INFO_CACHE_TTL", "300"))
+# cache of shop list pages
+TG_SHOP_PAGE_CACHE_SIZE = int(getenv("TG_SHOP_PAGE_CACHE_SIZE", "1000"))
+TG_SHOP_PAGE_CACHE_TTL = int(getenv("TG_SHOP_PAGE_CACHE_TTL", "60"))
+# 0 - do not log metrics
+TG_METRICS_LOG_INTERVAL = int(getenv("TG_METRICS_LOG_INTERVAL", "0"))
+
+# "polling" or "webhook"
+TG_BOT_MODE = getenv("TG_BOT_MODE", "polling")
+TG_WEBHOOK_LISTEN = getenv("TG_WEBHOOK_LISTEN", "127.0.0.1")
+TG_WEBHOOK_PORT = int(getenv("TG_WEBHOOK_PORT", "8443"))
+TG_WEBHOOK_PATH = getenv("TG_WEBHOOK_PATH", "tg_webhook")
+TG_WEBHOOK_URL = getenv("TG_WEBHOOK_URL", None)
+TG_WEBHOOK_SECRET_TOKEN = getenv("TG_WEBHOOK_SECRET_TOKEN", None)
+# skip `set_webhook`, e.g. for local testing with recorded updates
+TG_WEBHOOK_REGISTER = getenv("TG_WEBHOOK_REGISTER", "1") == "1"
+
 # RabbitMQ
 RMQ_HOST = getenv("RMQ_HOST", "rabbitmq")
 RMQ_PORT = getenv("RMQ_PORT", 5672)
 RMQ_LOGIN = getenv("RMQ_LOGIN", "guest")
 RMQ_PASSWORD = getenv("RMQ_PASSWORD", "guest")
+# unacked messages delivered to the consumer and concurrent workers
+# processing them (messages of one shop are processed in order)
+RMQ_CONSUMER_PREFETCH = int(getenv("RMQ_CONSUMER_PREFETCH", "400"))
+RMQ_CONSUMER_WORKERS = int(getenv("RMQ_CONSUMER_WORKERS", "4"))
+# every worker applies up to BATCH_SIZE messages, that came during
+# BATCH_WAIT_MS milliseconds, in one transaction
+RMQ_CONSUMER_BATCH_SIZE = int(getenv("RMQ_CONSUMER_BATCH_SIZE", "100"))
+RMQ_CONSUMER_BATCH_WAIT_MS = int(getenv("RMQ_CONSUMER_BATCH_WAIT_MS", "50"))
+# consumed queues are named `<exchange>.<routing_key>.<APP_NAME>`, one
+# durable queue is shared by all processes of the application
+RMQ_CONSUMER_APP_NAME = getenv("RMQ_CONSUMER_APP_NAME", "tg_bot")
+# ids of the last processed messages kept to skip redelivered ones
+RMQ_CONSUMER_DEDUP_WINDOW = int(getenv("RMQ_CONSUMER_DEDUP_WINDOW", "10000"))
+# a failed message is retried after RETRY_DELAY seconds (doubled every
+# attempt, not more than MAX_RETRY_DELAY), after MAX_ATTEMPTS attempts it
+# goes to the dead-letter queue (rabbit.retry)
+RMQ_CONSUMER_MAX_ATTEMPTS = int(getenv("RMQ_CONSUMER_MAX_ATTEMPTS", "5"))
+RMQ_CONSUMER_RETRY_DELAY = float(getenv("RMQ_CONSUMER_RETRY_DELAY", "5"))
+RMQ_CONSUMER_MAX_RETRY_DELAY = float(getenv("RMQ_CONSUMER_MAX_RETRY_DELAY", "300"))
+# send only changed fields of updated shops (delta format, see README),
+# enable when all receivers support it, otherwise whole objects are sent
+RMQ_SHOP_SEND_DELTAS = getenv("RMQ_SHOP_SEND_DELTAS", "0") == "1"
+# codec of sent Shop messages (rabbit.codecs): "application/json" or
+# "application/x-market-record" (binary, the receiver must support it)
+RMQ_SHOP_MESSAGE_CONTENT_TYPE = getenv("RMQ_SHOP_MESSAGE_CONTENT_TYPE", "application/json")
+# channels of the long-lived publisher (rabbit.publisher)
+RMQ_PUBLISHER_CHANNELS = int(getenv("RMQ_PUBLISHER_CHANNELS", "4"))
+# seconds to wait for publisher confirmation
+RMQ_PUBLISH_TIMEOUT = float(getenv("RMQ_PUBLISH_TIMEOUT", "10"))
+# outbox relay of Shop events (rabbit.outbox): messages per batch,
+# seconds between polls of the drained outbox, retry backoff in seconds
+RMQ_OUTBOX_BATCH_SIZE = int(getenv("RMQ_OUTBOX_BATCH_SIZE", "100"))
+RMQ_OUTBOX_POLL_INTERVAL = float(getenv("RMQ_OUTBOX_POLL_INTERVAL", "1"))
+RMQ_OUTBOX_RETRY_DELAY = float(getenv("RMQ_OUTBOX_RETRY_DELAY", "5"))
+RMQ_OUTBOX_MAX_RETRY_DELAY = float(getenv("RMQ_OUTBOX_MAX_RETRY_DELAY", "300"))
 
 # Signals
 ENABLE_SIGNALS_TO_SYNCHRONISE_DB = getenv("ENABLE_SIGNALS_TO_SYNCHRONISE_DB", "1") == "1"
\ No newline at end of file
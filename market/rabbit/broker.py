@@ -1,9 +1,13 @@
 import logging
 import asyncio
+from typing import Optional
 
 from django.conf import settings
 
 from aio_pika import ExchangeType, Message, connect_robust
+from aio_pika.abc import AbstractChannel
+
+from rabbit import consumer, publisher, retry
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +15,13 @@ RMQ_HOST = settings.RMQ_HOST
 RMQ_PORT = settings.RMQ_PORT
 RMQ_LOGIN = settings.RMQ_LOGIN
 RMQ_PASSWORD = settings.RMQ_PASSWORD
+CONSUMER_PREFETCH = settings.RMQ_CONSUMER_PREFETCH
+CONSUMER_WORKERS = settings.RMQ_CONSUMER_WORKERS
+CONSUMER_BATCH_SIZE = settings.RMQ_CONSUMER_BATCH_SIZE
+CONSUMER_BATCH_WAIT = settings.RMQ_CONSUMER_BATCH_WAIT_MS / 1000
+CONSUMER_APP_NAME = settings.RMQ_CONSUMER_APP_NAME
+# seconds before consuming is restarted after an error
+CONSUMER_RESTART_DELAY = 5
 
 OZON_SHOP_EXCHANGE = "ozon_shop"
 OZON_SHOP_ROUTING_KEY = "ozon_shop"
@@ -24,6 +35,23 @@ CREATE_OPERATION = "create"
 UPDATE_OPERATION = "update"
 DELETE_OPERATION = "delete"
 
+# format of update message body, full object if there is no header
+FORMAT_KEY = "format"
+DELTA_FORMAT = "delta"
+
+# Shop.version of the sender, it increases with every change of the shop,
+# so the consumer skips repeated and outdated messages
+VERSION_KEY = "version"
+
+
+def get_consumer_queue_name(exchange_name: str, routing_key: str) -> str:
+    """
+    Stable name of the queue consumed by this application, so the same
+    queue (and its retry queues) is used after restarts of the consumer
+    and of the process.
+    """
+    return f"{exchange_name}.{routing_key}.{CONSUMER_APP_NAME}"
+
 
 class Broker:
     connection = None
@@ -54,40 +82,149 @@ class Broker:
                    message: Message,
                    routing_key: str,
                    ):
-        """Send message to queue."""
-        if self.connection is None:
-            await self.connect_to_broker()
+        """
+        Send message to queue.
 
-        async with self.connection:
-            channel = await self.connection.channel()
-
-            exchange = await channel.declare_exchange(
-                exchange_name, ExchangeType.DIRECT,
-            )
-            await exchange.publish(message, routing_key=routing_key)
+        Uses the long-lived publisher of the process (channels and
+        exchanges are reused), waits for confirmation by the broker.
+        """
+        await publisher.get_publisher().publish_from_loop(
+            exchange_name, message, routing_key)
 
     async def consume_queue(self,
                             callback,
                             exchange_name: str,
                             routing_key: str,
+                            queue_name: Optional[str] = None,
                             auto_delete_queue: bool = False,
+                            prefetch_count: int = CONSUMER_PREFETCH,
+                            workers: int = CONSUMER_WORKERS,
+                            partition_key=None,
+                            batch_callback=None,
+                            batch_size: int = CONSUMER_BATCH_SIZE,
+                            batch_wait: float = CONSUMER_BATCH_WAIT,
                             ):
-        """Listen queue"""
+        """
+        Listen queue.
+
+        Not more than `prefetch_count` unacked messages are delivered,
+        they are processed by `workers` concurrent workers
+        (see rabbit.consumer.PartitionedWorkers).
+        Failed messages are retried with backoff and dead-lettered after
+        the last attempt (see rabbit.retry). If consuming fails (e.g. the
+        channel is closed), it is restarted, so errors don't stop the
+        other coroutines of the process.
+        :param callback: processes one message, it must not ack.
+        :param queue_name: consumed queue, by default
+            `<exchange>.<routing_key>.<RMQ_CONSUMER_APP_NAME>`.
+        :param partition_key: function, messages with the same key are
+            processed in order of delivery.
+        :param batch_callback: processes up to `batch_size` messages
+            collected during `batch_wait` seconds, if it fails they are
+            processed by `callback` one by one.
+        """
+        if queue_name is None:
+            queue_name = get_consumer_queue_name(exchange_name, routing_key)
+        while True:
+            try:
+                await self._consume_queue(
+                    callback,
+                    exchange_name,
+                    routing_key,
+                    queue_name,
+                    auto_delete_queue=auto_delete_queue,
+                    prefetch_count=prefetch_count,
+                    workers=workers,
+                    partition_key=partition_key,
+                    batch_callback=batch_callback,
+                    batch_size=batch_size,
+                    batch_wait=batch_wait,
+                )
+            except Exception:
+                logger.exception(f"Consuming {exchange_name} failed, "
+                                 f"restart in {CONSUMER_RESTART_DELAY} s")
+                await asyncio.sleep(CONSUMER_RESTART_DELAY)
+
+    async def _consume_queue(self,
+                             callback,
+                             exchange_name: str,
+                             routing_key: str,
+                             queue_name: str,
+                             auto_delete_queue: bool,
+                             prefetch_count: int,
+                             workers: int,
+                             partition_key,
+                             batch_callback,
+                             batch_size: int,
+                             batch_wait: float,
+                             ):
         if self.connection is None:
             await self.connect_to_broker()
 
         channel = await self.connection.channel()
+        try:
+            await self._consume_channel(
+                channel,
+                callback,
+                exchange_name,
+                routing_key,
+                queue_name,
+                auto_delete_queue=auto_delete_queue,
+                prefetch_count=prefetch_count,
+                workers=workers,
+                partition_key=partition_key,
+                batch_callback=batch_callback,
+                batch_size=batch_size,
+                batch_wait=batch_wait,
+            )
+        finally:
+            # a restart opens a new channel
+            if not channel.is_closed:
+                await channel.close()
+
+    async def _consume_channel(self,
+                               channel: AbstractChannel,
+                               callback,
+                               exchange_name: str,
+                               routing_key: str,
+                               queue_name: str,
+                               auto_delete_queue: bool,
+                               prefetch_count: int,
+                               workers: int,
+                               partition_key,
+                               batch_callback,
+                               batch_size: int,
+                               batch_wait: float,
+                               ):
+        await channel.set_qos(prefetch_count=prefetch_count)
 
         exchange = await channel.declare_exchange(
             exchange_name, ExchangeType.DIRECT,
         )
         queue = await channel.declare_queue(
+            queue_name,
             auto_delete=auto_delete_queue,
             durable=True
         )
         await queue.bind(exchange, routing_key=routing_key)
-
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                logging.debug(f'Received message body: {message.body}')
-                await callback(message)
+        retry_queues = retry.RetryQueues(
+            channel, exchange_name, routing_key, queue.name)
+        await retry_queues.declare()
+
+        message_workers = consumer.PartitionedWorkers(
+            callback,
+            workers,
+            partition_key=partition_key,
+            batch_callback=batch_callback,
+            batch_size=batch_size,
+            batch_wait=batch_wait,
+            on_failure=retry_queues.handle_failure,
+        )
+        message_workers.start()
+        try:
+            async with queue.iterator() as queue_iter:
+                async for message in queue_iter:
+                    logging.debug(f'Received message body: {message.body}')
+                    await message_workers.submit(message)
+        finally:
+            await message_workers.stop()
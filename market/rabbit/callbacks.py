@@ -1,64 +1,422 @@
+import contextlib
+import copy
 import logging
+import random
+import threading
+import time
+from typing import Callable, Iterable, Optional, Union
 
 from aio_pika.abc import AbstractIncomingMessage
-from rabbit import broker
+from rabbit import broker, codecs, consumer, retry
 
-from django.core import serializers
-from django.db.models import Model
+from django.conf import settings
+from django.db import OperationalError, connections, router, transaction
+from django.db.models import F, Model
+from django.db.models.signals import post_save
 
-from shop.models import Shop
+from shop.models import ReceivedShopVersion, Shop
 from shop.services.shop_services import ShopService
+from tg_bot import db_executor, metrics
 
 logger = logging.getLogger(__name__)
 
+CONSUMER_DEDUP_WINDOW = settings.RMQ_CONSUMER_DEDUP_WINDOW
+
+# a write transaction is repeated if the database is locked
+BATCH_WRITE_ATTEMPTS = 3
+_sqlite_write_lock = threading.Lock()
+
+# ids of applied messages, redelivered copies are skipped without queries
+_applied_messages = consumer.DedupWindow(CONSUMER_DEDUP_WINDOW)
+
+
+def get_shop_pk(message: AbstractIncomingMessage) -> int:
+    """Partition key of shop messages, so one shop is updated in order."""
+    operation = message.headers.get(broker.OPERATION_KEY)
+    return codecs.get_codec(message.content_type).get_pk(
+        message.body, operation, _is_delta(message))
+
 
 async def on_message_shop(message: AbstractIncomingMessage) -> None:
     """
-    Callback for consumer
+    Callback for consumer (the message is acked by the consumer).
+
+    Database queries have background priority, so handlers of the bot
+    are not delayed by a burst of messages.
+    """
+    if message.message_id in _applied_messages:
+        metrics.counter("rmq.consumer.duplicates").inc()
+        logger.info(f"Skip repeated message {message.message_id}")
+        return
+    with db_executor.priority(db_executor.BACKGROUND):
+        await _apply_shop_message(message)
+    _applied_messages.add(message.message_id)
+
+
+async def on_messages_shop(messages: list[AbstractIncomingMessage]) -> None:
+    """
+    Batch callback for consumer, applies messages in one transaction.
+
+    The result is the same as of applying them one by one in order:
+    affected shops are loaded by one query, changes are applied to them in
+    memory, then the final states are written by bulk queries.
+    Shops changed only by delta messages are updated without post_save,
+    only by their changed fields (as by `_apply_shop_delta`).
+    Repeated and outdated messages (see `_is_outdated`) are skipped.
+    """
+    new_messages = [message for message in messages
+                    if message.message_id not in _applied_messages]
+    if len(new_messages) < len(messages):
+        metrics.counter("rmq.consumer.duplicates").inc(
+            len(messages) - len(new_messages))
+    if not new_messages:
+        return
+    changes = [_parse_shop_message(message) for message in new_messages]
+    shop_ids = {shop_id for operation, shop_id, payload, version in changes}
+    with db_executor.priority(db_executor.BACKGROUND):
+        local_shops, received_versions = await db_executor.run(
+            _load_shops, shop_ids)
+
+        shops = dict(local_shops)
+        deleted_ids = set()
+        # shops replaced by full objects, they are saved with post_save
+        replaced_ids = set()
+        # merged delta records by Shop.pk
+        patches = {}
+        applied_versions = {}
+        for operation, shop_id, payload, version in changes:
+            if _is_outdated(shop_id, version, received_versions):
+                continue
+            if version is not None:
+                received_versions[shop_id] = version
+                applied_versions[shop_id] = version
+            current_shop_obj = shops.get(shop_id)
+            match operation:
+                case broker.UPDATE_OPERATION if isinstance(
+                        payload, codecs.Record):
+                    if current_shop_obj is None:
+                        logger.warning(f"Shop {shop_id} to update by delta "
+                                       f"DoesNotExist")
+                        continue
+                    if current_shop_obj is local_shops.get(shop_id):
+                        current_shop_obj = copy.copy(current_shop_obj)
+                        shops[shop_id] = current_shop_obj
+                    _set_shop_values(current_shop_obj, payload.values)
+                    patch = patches.get(shop_id)
+                    if patch is None:
+                        patch = patches[shop_id] = codecs.Record(
+                            Shop, shop_id, {})
+                    patch.values.update(payload.values)
+                case broker.UPDATE_OPERATION:
+                    is_equal = False
+                    if current_shop_obj is not None:
+                        payload.version = current_shop_obj.version
+                        is_equal = compare_model_objs_by_fields(
+                            payload, current_shop_obj)
+                    if not is_equal:
+                        shops[shop_id] = payload
+                        replaced_ids.add(shop_id)
+                case broker.CREATE_OPERATION:
+                    if current_shop_obj is None:
+                        shops[shop_id] = payload
+                        replaced_ids.add(shop_id)
+                case broker.DELETE_OPERATION:
+                    if current_shop_obj is not None:
+                        shops[shop_id] = None
+                        if shop_id in local_shops:
+                            deleted_ids.add(shop_id)
+
+        to_create = []
+        to_update = []
+        to_patch = []
+        for shop_id, shop in shops.items():
+            if shop is None or shop is local_shops.get(shop_id):
+                continue
+            if shop_id in local_shops and shop_id not in deleted_ids:
+                if shop_id in replaced_ids:
+                    # the version is incremented on writing
+                    to_update.append(shop)
+                else:
+                    to_patch.append(patches[shop_id])
+            else:
+                shop.version = 1
+                to_create.append(shop)
+        await db_executor.run(
+            _save_shop_changes,
+            deleted_ids, to_create, to_update, to_patch, applied_versions,
+        )
+    for message in new_messages:
+        _applied_messages.add(message.message_id)
+    for shop_id in shop_ids:
+        ShopService().invalidate_shop_info(shop_id)
+    logger.info(f"Applied {len(new_messages)} shop messages: "
+                f"{len(deleted_ids)} deleted, {len(to_create)} created, "
+                f"{len(to_update)} updated, {len(to_patch)} patched")
+
+
+def _set_shop_values(shop: Shop, values: dict):
+    for name, value in values.items():
+        setattr(shop, name, value)
+    if "ozon_api_key" in values:
+        shop.update_api_key_hash()
+
+
+def _load_shops(
+        shop_ids: Iterable[int],
+) -> tuple[dict[int, Shop], dict[int, int]]:
+    """:return: local shops and versions of applied messages by Shop.pk."""
+    return Shop.objects.in_bulk(shop_ids), _get_received_versions(shop_ids)
+
+
+def _is_outdated(shop_id: int, version: Optional[int],
+                 received_versions: dict[int, int]) -> bool:
+    """
+    True if a message with the same or a newer version of the shop is
+    already applied (it is a repeated or reordered message).
+    Messages without version (old senders) are always applied.
+    """
+    applied_version = received_versions.get(shop_id)
+    if version is None or applied_version is None or version > applied_version:
+        return False
+    metrics.counter("rmq.consumer.outdated").inc()
+    logger.info(f"Skip outdated message of shop {shop_id}: "
+                f"{version=}, {applied_version=}")
+    return True
+
+
+def _get_received_versions(shop_ids: Iterable[int],
+                           using: Optional[str] = None) -> dict[int, int]:
+    return dict(ReceivedShopVersion.objects.using(using)
+                .filter(shop_id__in=shop_ids)
+                .values_list("shop_id", "version"))
+
+
+def _save_received_versions(versions: dict[int, int],
+                            using: Optional[str] = None):
+    """Insert or update versions of applied messages by Shop.pk."""
+    ReceivedShopVersion.objects.using(using).bulk_create(
+        [ReceivedShopVersion(shop_id=shop_id, version=version)
+         for shop_id, version in versions.items()],
+        update_conflicts=True,
+        unique_fields=["shop_id"],
+        update_fields=["version", "updated_at"],
+    )
+
+
+def _parse_shop_message(
+        message: AbstractIncomingMessage,
+) -> tuple[str, int, Union[Shop, codecs.Record, None], Optional[int]]:
+    """
+    Decode message by the codec of its content type.
+
+    :return: operation, Shop.pk, payload: received Shop obj.,
+        Record with changed fields (delta format) or None (delete),
+        and version of the shop (None if the sender does not send it).
+    :raise retry.UnprocessableMessage: unknown operation or broken body.
+    """
+    operation = message.headers.get(broker.OPERATION_KEY, None)
+    if operation not in (broker.CREATE_OPERATION, broker.UPDATE_OPERATION,
+                         broker.DELETE_OPERATION):
+        raise retry.UnprocessableMessage(
+            f"{operation=} does not match any known operation.")
+    is_delta = _is_delta(message)
+    try:
+        record = codecs.get_codec(message.content_type).decode(
+            message.body, Shop, operation, is_delta)
+        version = message.headers.get(broker.VERSION_KEY, record.version)
+        if version is not None:
+            version = int(version)
+    except Exception as e:
+        # decoding gives the same result every time
+        raise retry.UnprocessableMessage(
+            f"Can't decode message: {e!r}") from e
+    if operation == broker.DELETE_OPERATION:
+        return operation, record.pk, None, version
+    if is_delta:
+        return operation, record.pk, record, version
+    received_shop_obj: Shop = record.to_instance()
+    received_shop_obj.update_api_key_hash()
+    return operation, received_shop_obj.pk, received_shop_obj, version
+
+
+def _is_delta(message: AbstractIncomingMessage) -> bool:
+    return (message.headers.get(broker.OPERATION_KEY)
+            == broker.UPDATE_OPERATION
+            and message.headers.get(broker.FORMAT_KEY)
+            == broker.DELTA_FORMAT)
+
+
+def _save_shop_changes(
+        deleted_ids: set[int],
+        to_create: list[Shop],
+        to_update: list[Shop],
+        to_patch: list[codecs.Record],
+        applied_versions: dict[int, int],
+):
+    """
+    Write changes of shops by bulk queries in one transaction.
+
+    Bulk queries don't send post_save, it is sent for every created and
+    updated Shop, as if it was saved (caches, counters, outbox).
+    Versions of `to_update` are incremented in the database (as by
+    `Shop.save`), not from the loaded values.
+    Every delta of `to_patch` is written by its own UPDATE of the changed
+    fields only, without post_save, so other columns changed by the bot
+    since the shops were loaded are not overwritten.
+    :param applied_versions: versions of applied messages by Shop.pk,
+        saved in the same transaction.
+    """
+    return _write_shops(
+        _save_shop_changes_atomic, deleted_ids, to_create, to_update,
+        to_patch, applied_versions)
+
+
+def _write_shops(write: Callable, *args):
+    """
+    Call `write(using, *args)`, it must write in one transaction.
+
+    The transaction is repeated if the database is locked.
     """
+    using = router.db_for_write(Shop)
+    if connections[using].vendor == "sqlite":
+        # SQLite has one writer at a time, batches of the workers wait
+        # here instead of failing on upgrade of a read transaction to
+        # write one ("database is locked")
+        lock = _sqlite_write_lock
+    else:
+        lock = contextlib.nullcontext()
+    for attempt in range(1, BATCH_WRITE_ATTEMPTS + 1):
+        try:
+            with lock:
+                return write(using, *args)
+        except OperationalError as e:
+            # e.g. the database is locked by another process
+            if attempt == BATCH_WRITE_ATTEMPTS:
+                raise
+            logger.info(f"Retry writing shop changes ({attempt=}): {e!r}")
+            time.sleep(random.uniform(0, 0.05 * attempt))
+
+
+def _save_shop_changes_atomic(
+        using: str,
+        deleted_ids: set[int],
+        to_create: list[Shop],
+        to_update: list[Shop],
+        to_patch: list[codecs.Record],
+        applied_versions: dict[int, int],
+):
+    fields = [field.name for field in Shop._meta.concrete_fields
+              if not field.primary_key and field.name != "version"]
+    with transaction.atomic(using=using):
+        if deleted_ids:
+            # delete() sends pre_delete/post_delete itself
+            Shop.objects.using(using).filter(id__in=deleted_ids).delete()
+        Shop.objects.using(using).bulk_create(to_create)
+        Shop.objects.using(using).bulk_update(to_update, fields)
+        if to_update:
+            _increment_versions(to_update, using)
+        for delta in to_patch:
+            _apply_shop_delta(delta, using)
+        for shop in to_create:
+            post_save.send(sender=Shop, instance=shop, created=True,
+                           update_fields=None, raw=False, using=using)
+        for shop in to_update:
+            post_save.send(sender=Shop, instance=shop, created=False,
+                           update_fields=None, raw=False, using=using)
+        if applied_versions:
+            _save_received_versions(applied_versions, using)
+
+
+def _increment_versions(shops: list[Shop], using: str):
+    """Increment versions in the database and set them to the objects."""
+    queryset = Shop.objects.using(using).filter(
+        pk__in=[shop.pk for shop in shops])
+    queryset.update(version=F("version") + 1)
+    versions = dict(queryset.values_list("pk", "version"))
+    for shop in shops:
+        shop.version = versions[shop.pk]
+
+
+async def _apply_shop_message(message: AbstractIncomingMessage) -> None:
+    """Apply creating, updating or deleting of Shop from the message."""
     logger.info(" [x] Received message %r" % message)
     logger.info("Message body is: %r" % message.body)
 
-    operation = message.headers.get(broker.OPERATION_KEY, None)
-    match operation:
-        case broker.UPDATE_OPERATION:
-            for deserialized_shop in serializers.deserialize(
-                    'json', message.body):
-                received_shop_obj: Shop = deserialized_shop.object
-                local_shop_obj = await ShopService()\
-                    .get_shop_by_id(received_shop_obj.pk)
-                is_equal = compare_model_objs_by_fields(
-                    received_shop_obj, local_shop_obj)
-                if not is_equal:
-                    await received_shop_obj.asave()
-                break
-
-        case broker.CREATE_OPERATION:
-            for deserialized_shop in serializers.deserialize(
-                    'json', message.body):
-                received_shop_obj: Shop = deserialized_shop.object
-                local_shop_obj = await ShopService() \
-                    .get_shop_by_id(received_shop_obj.pk)
-                if local_shop_obj is None:
-                    await received_shop_obj.asave()
-                break
-
-        case broker.DELETE_OPERATION:
-            id_to_delete = int(message.body.decode())
-            local_shop_obj = await ShopService() \
-                .get_shop_by_id(id_to_delete)
-            if local_shop_obj is not None:
-                await local_shop_obj.adelete()
-
-        case _:
-            assert False, f"{operation=} does not match any known operation."
-
-    await message.ack()
-
-
-def compare_model_objs_by_fields(instance: Model, other: Model):
-    instance_fields_values = {
-        getattr(instance, field.name) for field in instance._meta.fields}
-    other_fields_values = {
-        getattr(other, field.name) for field in other._meta.fields}
-    return instance_fields_values == other_fields_values
+    operation, shop_id, payload, version = _parse_shop_message(message)
+    is_changed = await db_executor.run(
+        _write_shops, _apply_shop_change, operation, shop_id, payload, version)
+    if is_changed:
+        ShopService().invalidate_shop_info(shop_id)
+
+
+def _apply_shop_change(
+        using: str,
+        operation: str,
+        shop_id: int,
+        payload: Union[Shop, codecs.Record, None],
+        version: Optional[int],
+) -> bool:
+    """
+    Check the version, apply the change and save the version
+    in one transaction.
+
+    :return: True if Shop could be changed.
+    """
+    with transaction.atomic(using=using):
+        if version is not None:
+            received_versions = _get_received_versions([shop_id], using)
+            if _is_outdated(shop_id, version, received_versions):
+                return False
+        is_changed = True
+        shops = Shop.objects.using(using)
+        match operation:
+            case broker.UPDATE_OPERATION if isinstance(payload, codecs.Record):
+                _apply_shop_delta(payload, using)
+
+            case broker.UPDATE_OPERATION:
+                received_shop_obj: Shop = payload
+                local_shop_obj = shops.filter(pk=shop_id).first()
+                if local_shop_obj is not None:
+                    # local version is incremented by save
+                    received_shop_obj.version = local_shop_obj.version
+                    is_changed = not compare_model_objs_by_fields(
+                        received_shop_obj, local_shop_obj)
+                if is_changed:
+                    received_shop_obj.save(using=using)
+
+            case broker.CREATE_OPERATION:
+                received_shop_obj: Shop = payload
+                is_changed = not shops.filter(pk=shop_id).exists()
+                if is_changed:
+                    received_shop_obj.save(using=using)
+
+            case broker.DELETE_OPERATION:
+                # delete() sends pre_delete/post_delete itself
+                shops.filter(pk=shop_id).delete()
+
+            case _:
+                raise retry.UnprocessableMessage(
+                    f"{operation=} does not match any known operation.")
+
+        if version is not None:
+            _save_received_versions({shop_id: version}, using)
+    return is_changed
+
+
+def _apply_shop_delta(delta: codecs.Record, using: str):
+    """Update only changed columns of Shop by one UPDATE statement."""
+    shop = Shop(pk=delta.pk)
+    _set_shop_values(shop, delta.values)
+    update_fields = list(delta.values)
+    if "ozon_api_key" in delta.values:
+        update_fields.append("ozon_api_key_hash")
+    values = {name: getattr(shop, name) for name in update_fields}
+    updated = Shop.objects.using(using).filter(pk=delta.pk).update(**values)
+    if not updated:
+        logger.warning(f"Shop {delta.pk} to update by delta DoesNotExist")
+
+
+def compare_model_objs_by_fields(instance: Model, other: Model) -> bool:
+    """True if every concrete field has the same value in both objects."""
+    return all(getattr(instance, field.attname) == getattr(other, field.attname)
+               for field in instance._meta.concrete_fields)
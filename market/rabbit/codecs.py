@@ -0,0 +1,315 @@
+"""
+Codecs of broker messages about models (Shop, Warehouse).
+
+A message body is encoded by the codec of the AMQP `content_type`
+property, messages without it are JSON (as before codecs):
+```
+codec = codecs.get_codec(message.content_type)
+record = codec.decode(message.body, Shop, operation, is_delta)
+```
+JSON keeps the formats of the other services: full object as
+`django.core.serializers` JSON, delta (see `broker.DELTA_FORMAT`) as
+`{"pk": 1, "version": 7, "fields": {...}}`, delete as "<pk>".
+Binary codec packs values by a schema built from the model fields,
+it is several times faster and smaller.
+"""
+import dataclasses
+import functools
+import json
+import struct
+import zlib
+from typing import Any, Callable, Optional
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+
+from rabbit import broker
+from shop.models import Shop, Warehouse
+
+JSON_CONTENT_TYPE = "application/json"
+BINARY_CONTENT_TYPE = "application/x-market-record"
+
+
+@dataclasses.dataclass
+class Record:
+    """Model object in a message: pk, field values and version."""
+    model: type[models.Model]
+    pk: int
+    # field name: python value (pk of the related object for ForeignKey)
+    values: dict[str, Any]
+    version: Optional[int] = None
+
+    def to_instance(self) -> models.Model:
+        """Unsaved model object with the values."""
+        get_field = self.model._meta.get_field
+        return self.model(pk=self.pk, **{
+            get_field(name).attname: value
+            for name, value in self.values.items()})
+
+
+@functools.cache
+def get_synchronised_fields(model: type[models.Model]) -> list[models.Field]:
+    """
+    Fields sent to other services (without pk and local ones).
+
+    The list is cached, it must not be changed.
+    """
+    local_fields = getattr(model, "LOCAL_FIELDS", ())
+    return [field for field in model._meta.concrete_fields
+            if not field.primary_key and field.name not in local_fields]
+
+
+def record_from_instance(
+        instance: models.Model,
+        field_names: Optional[list[str]] = None,
+) -> Record:
+    """
+    :param field_names: fields to put into the record,
+        all synchronised fields if None.
+    """
+    fields = get_synchronised_fields(type(instance))
+    if field_names is not None:
+        fields = [field for field in fields if field.name in field_names]
+    return Record(
+        model=type(instance),
+        pk=instance.pk,
+        values={field.name: field.value_from_object(instance)
+                for field in fields},
+        version=getattr(instance, "version", None),
+    )
+
+
+class JSONCodec:
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, record: Record, operation: str, is_delta: bool) -> bytes:
+        if operation == broker.DELETE_OPERATION:
+            return str(record.pk).encode()
+        if is_delta:
+            data = {"pk": record.pk, "version": record.version,
+                    "fields": record.values}
+        else:
+            data = [{"model": record.model._meta.label_lower,
+                     "pk": record.pk,
+                     "fields": record.values}]
+        # as `django.core.serializers` JSON
+        return json.dumps(data, cls=DjangoJSONEncoder,
+                          ensure_ascii=False).encode()
+
+    def decode(self, body: bytes, model: type[models.Model], operation: str,
+               is_delta: bool) -> Record:
+        """Unknown and local fields are ignored (as `ignorenonexistent`)."""
+        if operation == broker.DELETE_OPERATION:
+            return Record(model=model, pk=int(body.decode()), values={})
+        data = json.loads(body)
+        if not is_delta:
+            data = data[0]
+        value_fields = _get_value_fields(model)
+        values = {}
+        for name, value in data["fields"].items():
+            field = value_fields.get(name)
+            if field is None:
+                continue
+            values[name] = None if value is None else field.to_python(value)
+        version = data.get("version")
+        return Record(model=model, pk=int(data["pk"]), values=values,
+                      version=None if version is None else int(version))
+
+    def get_pk(self, body: bytes, operation: str, is_delta: bool) -> int:
+        if operation == broker.DELETE_OPERATION:
+            return int(body.decode())
+        data = json.loads(body)
+        return int(data["pk"] if is_delta else data[0]["pk"])
+
+
+@functools.cache
+def _get_value_fields(model: type[models.Model]) -> dict[str, models.Field]:
+    """
+    Synchronised fields by name, the field of related pk for ForeignKey
+    (it converts the value).
+    """
+    return {
+        field.name: field.target_field if field.remote_field else field
+        for field in get_synchronised_fields(model)
+    }
+
+
+class _Schema:
+    """Order and binary types of synchronised fields of a model."""
+
+    def __init__(self, model: type[models.Model]):
+        fields = get_synchronised_fields(model)
+        # (name, bit, pack, unpack) in order of the schema
+        self._fields = [(field.name, 1 << i, *_get_packer(field))
+                        for i, field in enumerate(fields)]
+        self.bitmap_size = (len(fields) + 7) // 8
+        description = ";".join(f"{field.name}:{field.get_internal_type()}"
+                               for field in fields)
+        # both sides must have the same schema
+        self.fingerprint = zlib.crc32(description.encode()) & 0xFFFF
+
+    def pack(self, values: dict[str, Any], out: bytearray):
+        present = 0
+        nulls = 0
+        packed = bytearray()
+        for name, bit, pack, unpack in self._fields:
+            if name not in values:
+                continue
+            present |= bit
+            value = values[name]
+            if value is None:
+                nulls |= bit
+            else:
+                pack(value, packed)
+        out += present.to_bytes(self.bitmap_size, "little")
+        out += nulls.to_bytes(self.bitmap_size, "little")
+        out += packed
+
+    def unpack(self, body: memoryview, offset: int) -> dict[str, Any]:
+        size = self.bitmap_size
+        present = int.from_bytes(body[offset:offset + size], "little")
+        nulls = int.from_bytes(body[offset + size:offset + 2 * size],
+                               "little")
+        offset += 2 * size
+        values = {}
+        for name, bit, pack, unpack in self._fields:
+            if not present & bit:
+                continue
+            if nulls & bit:
+                values[name] = None
+            else:
+                values[name], offset = unpack(body, offset)
+        if offset != len(body):
+            raise ValueError("Wrong length of binary message")
+        return values
+
+
+_BOOL = struct.Struct("<?")
+_INT = struct.Struct("<q")
+_STR_LEN = struct.Struct("<I")
+
+
+def _pack_bool(value, out: bytearray):
+    out += _BOOL.pack(value)
+
+
+def _unpack_bool(body: memoryview, offset: int):
+    return _BOOL.unpack_from(body, offset)[0], offset + _BOOL.size
+
+
+def _pack_int(value, out: bytearray):
+    out += _INT.pack(value)
+
+
+def _unpack_int(body: memoryview, offset: int):
+    return _INT.unpack_from(body, offset)[0], offset + _INT.size
+
+
+def _pack_str(value, out: bytearray):
+    encoded = value.encode()
+    out += _STR_LEN.pack(len(encoded))
+    out += encoded
+
+
+def _unpack_str(body: memoryview, offset: int):
+    (length,) = _STR_LEN.unpack_from(body, offset)
+    offset += _STR_LEN.size
+    return str(body[offset:offset + length], "utf-8"), offset + length
+
+
+_PACKERS = {
+    "BooleanField": (_pack_bool, _unpack_bool),
+    "CharField": (_pack_str, _unpack_str),
+    "SlugField": (_pack_str, _unpack_str),
+    "TextField": (_pack_str, _unpack_str),
+    "IntegerField": (_pack_int, _unpack_int),
+    "BigIntegerField": (_pack_int, _unpack_int),
+    "PositiveIntegerField": (_pack_int, _unpack_int),
+    "PositiveBigIntegerField": (_pack_int, _unpack_int),
+    "AutoField": (_pack_int, _unpack_int),
+    "BigAutoField": (_pack_int, _unpack_int),
+}
+
+
+def _get_packer(field: models.Field) -> tuple[Callable, Callable]:
+    if field.remote_field is not None:
+        field = field.target_field
+    try:
+        return _PACKERS[field.get_internal_type()]
+    except KeyError:
+        raise ValueError(f"Binary codec does not support {field!r}")
+
+
+class BinaryCodec:
+    """
+    Schema-based binary codec, supports MODELS.
+
+    Layout (little-endian): format version (B), model id (B),
+    schema fingerprint (H), flags (B: delta, has version), pk (q),
+    [version (q)], bitmap of present fields, bitmap of null fields,
+    values of present not null fields in order of the schema
+    (bool: 1 byte, int: 8 bytes, str: length (I) and utf-8).
+    """
+    content_type = BINARY_CONTENT_TYPE
+
+    FORMAT_VERSION = 1
+    # model ids must not be changed
+    MODELS = {1: Shop, 2: Warehouse}
+
+    _HEADER = struct.Struct("<BBHBq")
+    _DELTA_FLAG = 1
+    _VERSION_FLAG = 2
+
+    def __init__(self):
+        self._model_ids = {model: model_id
+                           for model_id, model in self.MODELS.items()}
+        self._schemas = {model: _Schema(model) for model in self.MODELS.values()}
+
+    def encode(self, record: Record, operation: str, is_delta: bool) -> bytes:
+        schema = self._schemas[record.model]
+        flags = self._DELTA_FLAG if is_delta else 0
+        if record.version is not None:
+            flags |= self._VERSION_FLAG
+        out = bytearray(self._HEADER.pack(
+            self.FORMAT_VERSION, self._model_ids[record.model],
+            schema.fingerprint, flags, record.pk))
+        if record.version is not None:
+            out += _INT.pack(record.version)
+        schema.pack(record.values, out)
+        return bytes(out)
+
+    def decode(self, body: bytes, model: type[models.Model], operation: str,
+               is_delta: bool) -> Record:
+        body = memoryview(body)
+        format_version, model_id, fingerprint, flags, pk = \
+            self._HEADER.unpack_from(body)
+        if format_version != self.FORMAT_VERSION:
+            raise ValueError(f"Unknown binary {format_version=}")
+        if self.MODELS.get(model_id) is not model:
+            raise ValueError(f"Binary message of {model_id=} is not {model}")
+        schema = self._schemas[model]
+        if fingerprint != schema.fingerprint:
+            raise ValueError(f"Schema of {model} differs from the sender's")
+        offset = self._HEADER.size
+        version = None
+        if flags & self._VERSION_FLAG:
+            (version,) = _INT.unpack_from(body, offset)
+            offset += _INT.size
+        values = schema.unpack(body, offset)
+        return Record(model=model, pk=pk, values=values, version=version)
+
+    def get_pk(self, body: bytes, operation: str, is_delta: bool) -> int:
+        return self._HEADER.unpack_from(body)[4]
+
+
+CODECS = {codec.content_type: codec for codec in (JSONCodec(), BinaryCodec())}
+
+
+def get_codec(content_type: Optional[str]):
+    """Codec by content type, JSON if it is not set."""
+    if not content_type:
+        return CODECS[JSON_CONTENT_TYPE]
+    try:
+        return CODECS[content_type]
+    except KeyError:
+        raise ValueError(f"Unknown {content_type=}")
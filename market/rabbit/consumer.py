@@ -0,0 +1,259 @@
+"""
+Concurrent processing of consumed messages.
+
+Messages are distributed between workers by a partition key (e.g. Shop.pk),
+so messages with the same key are processed one by one in order of
+delivery, and messages with different keys are processed concurrently:
+```
+workers = PartitionedWorkers(callback, 4, partition_key=get_shop_pk)
+workers.start()
+async for message in queue_iter:
+    await workers.submit(message)
+```
+A worker can take several waiting messages at once and process them by
+one call of `batch_callback` (e.g. one transaction for all of them).
+"""
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Hashable, Optional
+
+from aio_pika.abc import AbstractIncomingMessage
+
+from tg_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PartitionedWorkers:
+    """
+    Fixed number of worker tasks, each with its own bounded queue.
+
+    A message goes to the queue `hash(partition_key(message)) % workers`.
+    Workers ack processed messages (callbacks must not do it).
+    If processing raises, the message is passed to `on_failure` (e.g. to
+    retry it later, see rabbit.retry) and acked. Without `on_failure`, or
+    if it raises too, the message is returned to the queue once and
+    rejected if it fails again.
+    """
+
+    def __init__(
+            self,
+            callback: Callable[[AbstractIncomingMessage], Awaitable],
+            workers: int,
+            queue_size: int = 0,
+            partition_key: Optional[
+                Callable[[AbstractIncomingMessage], Hashable]] = None,
+            batch_callback: Optional[
+                Callable[[list[AbstractIncomingMessage]], Awaitable]] = None,
+            batch_size: int = 1,
+            batch_wait: float = 0,
+            on_failure: Optional[
+                Callable[[AbstractIncomingMessage, Exception],
+                         Awaitable]] = None,
+    ):
+        """
+        :param callback: processes one message.
+        :param workers: number of concurrent workers.
+        :param queue_size: max messages waiting for every worker
+            (0 is unlimited, the number is limited by consumer prefetch).
+        :param partition_key: messages with equal keys are processed in
+            order. If None, all messages are in the same partition.
+        :param batch_callback: processes list of messages of one worker
+            (in order of delivery). If it raises, the messages are
+            processed one by one by `callback`.
+        :param batch_size: max messages in a batch.
+        :param batch_wait: seconds to wait for more messages after the
+            first one, before the batch is processed.
+        :param on_failure: takes a message, that `callback` failed to
+            process, and the error.
+        """
+        if workers < 1:
+            raise ValueError(f"Wrong {workers=}")
+        if batch_size < 1:
+            raise ValueError(f"Wrong {batch_size=}")
+        self.callback = callback
+        self.partition_key = partition_key
+        self.batch_callback = batch_callback
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.on_failure = on_failure
+        self._queues = [asyncio.Queue(queue_size) for _ in range(workers)]
+        self._tasks: list[asyncio.Task] = []
+        self._acks = _AckTracker()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work(queue))
+                       for queue in self._queues]
+
+    async def submit(self, message: AbstractIncomingMessage):
+        """Put message to the queue of its partition (waits if it is full)."""
+        self._acks.delivered(message)
+        await self._queues[self._get_partition(message)].put(message)
+        metrics.gauge("rmq.consumer.in_progress").inc()
+
+    async def join(self):
+        """Wait until all submitted messages are processed."""
+        for queue in self._queues:
+            await queue.join()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _get_partition(self, message: AbstractIncomingMessage) -> int:
+        if self.partition_key is None or len(self._queues) == 1:
+            return 0
+        try:
+            key = self.partition_key(message)
+        except Exception as e:
+            logger.warning(f"Can't get partition key of {message!r}: {e!r}")
+            key = None
+        return hash(key) % len(self._queues)
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            batch = await self._get_batch(queue)
+            try:
+                await self._process_batch(batch)
+            finally:
+                metrics.gauge("rmq.consumer.in_progress").dec(len(batch))
+                for _ in batch:
+                    queue.task_done()
+
+    async def _get_batch(
+            self, queue: asyncio.Queue) -> list[AbstractIncomingMessage]:
+        """Wait for a message, then for up to `batch_size` of them."""
+        batch = [await queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _process_batch(self, batch: list[AbstractIncomingMessage]):
+        if self.batch_callback is not None:
+            try:
+                with metrics.timer("rmq.consumer.batch_time").time():
+                    await self.batch_callback(batch)
+            except Exception:
+                metrics.counter("rmq.consumer.batch_failed").inc()
+                logger.exception(f"Can't process batch of {len(batch)} "
+                                 f"messages, processing one by one")
+            else:
+                metrics.counter("rmq.consumer.batches").inc()
+                await self._acks.done(batch, ack=True)
+                return
+        for message in batch:
+            await self._process_one(message)
+
+    async def _process_one(self, message: AbstractIncomingMessage):
+        try:
+            with metrics.timer("rmq.consumer.process_time").time():
+                await self.callback(message)
+        except Exception as e:
+            metrics.counter("rmq.consumer.failed").inc()
+            logger.exception(f"Can't process message {message!r}")
+            await self._handle_failure(message, e)
+        else:
+            await self._acks.done([message], ack=True)
+
+    async def _handle_failure(
+            self,
+            message: AbstractIncomingMessage,
+            error: Exception,
+    ):
+        if self.on_failure is not None:
+            try:
+                await self.on_failure(message, error)
+            except Exception as e:
+                logger.warning(f"Can't handle failed message "
+                               f"{message!r}: {e!r}")
+            else:
+                await self._acks.done([message], ack=True)
+                return
+        try:
+            await message.reject(requeue=not message.redelivered)
+        except Exception as e:
+            logger.warning(f"Can't reject message {message!r}: {e!r}")
+        await self._acks.done([message], ack=False)
+
+
+class _AckTracker:
+    """
+    Acks processed messages in order of delivery.
+
+    Messages are processed by several workers, so one `ack(multiple=True)`
+    is sent for the processed messages at the head of the delivery order,
+    it never acks a message that is still being processed.
+    """
+
+    def __init__(self):
+        self._delivered: deque[AbstractIncomingMessage] = deque()
+        # id(message) of processed messages: True if it must be acked
+        self._processed: dict[int, bool] = {}
+        self._lock = asyncio.Lock()
+
+    def delivered(self, message: AbstractIncomingMessage):
+        self._delivered.append(message)
+
+    async def done(self, messages: list[AbstractIncomingMessage], ack: bool):
+        """
+        Mark messages as processed.
+
+        :param ack: False if the messages are already rejected.
+        """
+        for message in messages:
+            self._processed[id(message)] = ack
+        # acks are sent in order of delivery tags
+        async with self._lock:
+            last_to_ack = None
+            while (self._delivered
+                   and id(self._delivered[0]) in self._processed):
+                message = self._delivered.popleft()
+                if self._processed.pop(id(message)):
+                    last_to_ack = message
+            if last_to_ack is None:
+                return
+            try:
+                await last_to_ack.ack(multiple=True)
+            except Exception as e:
+                logger.warning(f"Can't ack messages up to "
+                               f"{last_to_ack!r}: {e!r}")
+
+
+class DedupWindow:
+    """
+    Ids of the last processed messages (AMQP `message_id`).
+
+    A message is redelivered if its ack was lost, and republished if the
+    publisher confirmation was lost, such copies have the same id.
+    Only `size` last ids are kept.
+    """
+
+    def __init__(self, size: int):
+        """:param size: max number of ids, 0 disables the window."""
+        self.size = size
+        self._ids: OrderedDict[str, None] = OrderedDict()
+
+    def __contains__(self, message_id: Optional[str]) -> bool:
+        return message_id is not None and message_id in self._ids
+
+    def add(self, message_id: Optional[str]):
+        if message_id is None or not self.size:
+            return
+        self._ids[message_id] = None
+        self._ids.move_to_end(message_id)
+        while len(self._ids) > self.size:
+            self._ids.popitem(last=False)
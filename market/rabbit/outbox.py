@@ -0,0 +1,150 @@
+"""
+Relay of the transactional outbox of Shop events.
+
+Signals (shop.signals) don't publish, they write ShopOutboxMessage rows
+in the same transaction as the change of Shop. So nothing is sent for
+a rolled back change, and nothing is lost while the broker is down.
+The relay (a side coroutine of the bot process) drains the table:
+```
+await outbox.OutboxRelay().run()
+```
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from typing import Optional
+
+from aio_pika import DeliveryMode, Message
+from django.conf import settings
+from django.utils import timezone
+
+from rabbit import broker, publisher
+from shop.models import ShopOutboxMessage
+from tg_bot import db_executor, metrics
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = settings.RMQ_OUTBOX_BATCH_SIZE
+OUTBOX_POLL_INTERVAL = settings.RMQ_OUTBOX_POLL_INTERVAL
+OUTBOX_RETRY_DELAY = settings.RMQ_OUTBOX_RETRY_DELAY
+OUTBOX_MAX_RETRY_DELAY = settings.RMQ_OUTBOX_MAX_RETRY_DELAY
+
+
+class OutboxRelay:
+    """
+    Sends outbox messages to BOT_SHOP_EXCHANGE in batches.
+
+    Messages of one shop are published one by one in order of id (the
+    next one after the confirmation of the previous one), different
+    shops are published concurrently. If a message is not published,
+    it is retried with exponential backoff, and later messages of the
+    same shop wait for it.
+    Only one relay must run for a database.
+    """
+
+    def __init__(
+            self,
+            batch_size: int = OUTBOX_BATCH_SIZE,
+            poll_interval: float = OUTBOX_POLL_INTERVAL,
+    ):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+    async def run(self):
+        """Drain the outbox forever."""
+        logger.info("Shop outbox relay is started.")
+        while True:
+            try:
+                sent = await self.relay_batch()
+            except Exception as e:
+                logger.error(f"Shop outbox relay failed: {e!r}")
+                sent = 0
+            if sent < self.batch_size:
+                # the outbox is drained (or the broker is unavailable)
+                await asyncio.sleep(self.poll_interval)
+
+    async def relay_batch(self) -> int:
+        """
+        Send one batch of messages.
+
+        :return: number of sent messages.
+        """
+        with db_executor.priority(db_executor.BACKGROUND):
+            messages = await db_executor.run(self._get_batch)
+            if not messages:
+                return 0
+            by_shop = defaultdict(list)
+            for message in messages:
+                by_shop[message.shop_id].append(message)
+            results = await asyncio.gather(
+                *(self._send_shop_messages(shop_messages)
+                  for shop_messages in by_shop.values()))
+            sent_ids = [pk for sent, failed in results for pk in sent]
+            failed = [failed for sent, failed in results if failed]
+            await db_executor.run(self._save_results, sent_ids, failed)
+        metrics.counter("outbox.sent").inc(len(sent_ids))
+        if failed:
+            metrics.counter("outbox.failed").inc(len(failed))
+        return len(sent_ids)
+
+    def _get_batch(self) -> list[ShopOutboxMessage]:
+        """Oldest messages of shops, that don't wait for retry."""
+        waiting_shops = ShopOutboxMessage.objects \
+            .filter(next_attempt_at__gt=timezone.now()) \
+            .values("shop_id")
+        return list(ShopOutboxMessage.objects
+                    .exclude(shop_id__in=waiting_shops)
+                    .order_by("id")[:self.batch_size])
+
+    async def _send_shop_messages(
+            self,
+            messages: list[ShopOutboxMessage],
+    ) -> tuple[list[int], Optional[tuple[ShopOutboxMessage, Exception]]]:
+        """
+        Publish messages of one shop in order, stop on the first error.
+
+        :return: ids of sent messages and the failed message with error.
+        """
+        sent = []
+        for message in messages:
+            try:
+                await publisher.get_publisher().publish_from_loop(
+                    broker.BOT_SHOP_EXCHANGE,
+                    self._to_amqp_message(message),
+                    broker.BOT_SHOP_ROUTING_KEY,
+                )
+            except Exception as e:
+                logger.warning(f"Can't publish outbox message {message.pk} "
+                               f"(shop {message.shop_id}): {e!r}")
+                return sent, (message, e)
+            sent.append(message.pk)
+        return sent, None
+
+    @staticmethod
+    def _to_amqp_message(message: ShopOutboxMessage) -> Message:
+        return Message(
+            bytes(message.body),
+            content_type=message.content_type or None,
+            delivery_mode=DeliveryMode.PERSISTENT,
+            headers={**message.headers,
+                     broker.OPERATION_KEY: message.operation},
+            message_id=f"shop-outbox-{message.pk}",
+        )
+
+    @staticmethod
+    def _save_results(
+            sent_ids: list[int],
+            failed: list[tuple[ShopOutboxMessage, Exception]],
+    ):
+        if sent_ids:
+            ShopOutboxMessage.objects.filter(id__in=sent_ids).delete()
+        now = timezone.now()
+        for message, error in failed:
+            delay = min(OUTBOX_RETRY_DELAY * 2 ** message.attempts,
+                        OUTBOX_MAX_RETRY_DELAY)
+            message.attempts += 1
+            message.next_attempt_at = now + timedelta(seconds=delay)
+            message.last_error = repr(error)
+            message.save(update_fields=(
+                "attempts", "next_attempt_at", "last_error"))
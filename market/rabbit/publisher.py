@@ -0,0 +1,190 @@
+"""
+Long-lived publisher to RabbitMQ.
+
+One robust connection, a pool of channels with publisher confirms and
+declared exchanges are kept for the whole process. The publisher runs its
+own event loop in a background thread, so sync code can
+enqueue messages without creating event loops and without waiting:
+```
+future = publisher.get_publisher().publish_threadsafe(
+    exchange_name, message, routing_key)
+```
+"""
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import os
+import threading
+from typing import Optional
+
+from aio_pika import ExchangeType, Message, connect_robust
+from aio_pika.abc import (
+    AbstractExchange,
+    AbstractRobustChannel,
+    AbstractRobustConnection,
+)
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+RMQ_HOST = settings.RMQ_HOST
+RMQ_PORT = settings.RMQ_PORT
+RMQ_LOGIN = settings.RMQ_LOGIN
+RMQ_PASSWORD = settings.RMQ_PASSWORD
+PUBLISHER_CHANNELS = settings.RMQ_PUBLISHER_CHANNELS
+PUBLISH_TIMEOUT = settings.RMQ_PUBLISH_TIMEOUT
+
+
+class Publisher:
+    """
+    Publishes messages using a pool of channels.
+
+    Every message is confirmed by the broker (publisher confirms), the
+    future of `publish_threadsafe` is done after the confirmation.
+    """
+
+    def __init__(self, channels_count: int = PUBLISHER_CHANNELS):
+        if channels_count < 1:
+            raise ValueError(f"Wrong {channels_count=}")
+        self.channels_count = channels_count
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._connection: Optional[AbstractRobustConnection] = None
+        self._channels: Optional[asyncio.Queue] = None
+        self._exchanges: dict[tuple[int, str], AbstractExchange] = {}
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start event loop of the publisher in a daemon thread."""
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._loop.run_forever,
+                name="rabbit_publisher",
+                daemon=True,
+            )
+            self._thread.start()
+        logger.info("RabbitMQ publisher is started.")
+
+    def publish_threadsafe(
+            self,
+            exchange_name: str,
+            message: Message,
+            routing_key: str,
+    ) -> concurrent.futures.Future:
+        """
+        Enqueue message from any thread, does not block.
+
+        :return: future, done when the message is confirmed by the broker.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(
+            self.publish(exchange_name, message, routing_key), self._loop)
+
+    async def publish_from_loop(
+            self,
+            exchange_name: str,
+            message: Message,
+            routing_key: str,
+    ):
+        """Publish from another event loop and wait for confirmation."""
+        await asyncio.wrap_future(
+            self.publish_threadsafe(exchange_name, message, routing_key))
+
+    async def publish(
+            self,
+            exchange_name: str,
+            message: Message,
+            routing_key: str,
+    ):
+        """Publish using the channel pool (runs in the publisher loop)."""
+        await self._connect()
+        channel: AbstractRobustChannel = await self._channels.get()
+        try:
+            exchange = await self._get_exchange(channel, exchange_name)
+            await exchange.publish(
+                message, routing_key=routing_key, timeout=PUBLISH_TIMEOUT)
+        finally:
+            self._channels.put_nowait(channel)
+
+    def stop(self, timeout: float = 2 * PUBLISH_TIMEOUT):
+        """Wait for enqueued messages, close the connection, stop the loop."""
+        if self._thread is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close(), self._loop)
+        try:
+            future.result(timeout)
+        except Exception as e:
+            logger.warning(f"Can't close publisher connection: {e!r}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+        logger.info("RabbitMQ publisher is stopped.")
+
+    async def _connect(self):
+        if self._channels is not None:
+            return
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._channels is not None:
+                return
+            logger.info(f"Publisher is connecting to broker: {RMQ_HOST}")
+            self._connection = await connect_robust(
+                host=RMQ_HOST,
+                port=RMQ_PORT,
+                login=RMQ_LOGIN,
+                password=RMQ_PASSWORD,
+            )
+            channels = asyncio.Queue()
+            for _ in range(self.channels_count):
+                channel = await self._connection.channel(
+                    publisher_confirms=True)
+                channels.put_nowait(channel)
+            self._channels = channels
+
+    async def _get_exchange(
+            self,
+            channel: AbstractRobustChannel,
+            exchange_name: str,
+    ) -> AbstractExchange:
+        """Declare exchange once per channel."""
+        key = (id(channel), exchange_name)
+        exchange = self._exchanges.get(key)
+        if exchange is None:
+            exchange = await channel.declare_exchange(
+                exchange_name, ExchangeType.DIRECT,
+            )
+            self._exchanges[key] = exchange
+        return exchange
+
+    async def _close(self):
+        # let enqueued messages be published
+        pending = asyncio.all_tasks() - {asyncio.current_task()}
+        if pending:
+            await asyncio.wait(pending, timeout=PUBLISH_TIMEOUT)
+        if self._connection is not None:
+            await self._connection.close()
+        self._connection = None
+        self._channels = None
+        self._exchanges.clear()
+
+
+_publisher: Optional[Publisher] = None
+_publisher_pid: Optional[int] = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher() -> Publisher:
+    """Publisher of the current process (a new one after fork)."""
+    global _publisher, _publisher_pid
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != os.getpid():
+            _publisher = Publisher()
+            _publisher_pid = os.getpid()
+            atexit.register(_publisher.stop)
+        return _publisher
@@ -0,0 +1,164 @@
+"""
+Retries of failed messages with backoff and dead-lettering.
+
+A failed message is not requeued at once (it would fail again at once),
+its copy is published to a delay queue `<queue>.retry.<delay>ms`,
+when the delay (TTL of the queue) expires, the broker returns it by the
+default exchange to the queue of the consumer only (not to the exchange,
+other queues bound to it have already received the message).
+The delay is doubled with every attempt.
+After `max_attempts` failed attempts the message is published to the
+dead-letter exchange `<exchange>.dead` (bound to the durable queue with
+the same name) and is not processed anymore:
+```
+retry_queues = RetryQueues(channel, exchange_name, routing_key, queue.name)
+await retry_queues.declare()
+workers = PartitionedWorkers(..., on_failure=retry_queues.handle_failure)
+```
+"""
+import logging
+from typing import Optional
+
+from aio_pika import DeliveryMode, ExchangeType, Message
+from aio_pika.abc import (
+    AbstractChannel,
+    AbstractExchange,
+    AbstractIncomingMessage,
+)
+from django.conf import settings
+
+from tg_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_MAX_ATTEMPTS = settings.RMQ_CONSUMER_MAX_ATTEMPTS
+CONSUMER_RETRY_DELAY = settings.RMQ_CONSUMER_RETRY_DELAY
+CONSUMER_MAX_RETRY_DELAY = settings.RMQ_CONSUMER_MAX_RETRY_DELAY
+
+# headers of retried and dead-lettered messages
+ATTEMPTS_KEY = "x-attempts"
+ERROR_KEY = "x-error"
+# max length of the error in the header
+MAX_ERROR_LENGTH = 500
+
+
+class UnprocessableMessage(Exception):
+    """
+    The message can't be processed however many times it is retried
+    (e.g. unknown operation or broken body), it is dead-lettered at once.
+    """
+
+
+class RetryQueues:
+    """Delay queues and dead-letter exchange of a consumed exchange."""
+
+    def __init__(
+            self,
+            channel: AbstractChannel,
+            exchange_name: str,
+            routing_key: str,
+            queue_name: str,
+            max_attempts: int = CONSUMER_MAX_ATTEMPTS,
+            retry_delay: float = CONSUMER_RETRY_DELAY,
+            max_retry_delay: float = CONSUMER_MAX_RETRY_DELAY,
+    ):
+        """
+        :param channel: channel of the consumer.
+        :param queue_name: consumed queue, retried messages return to it.
+            It must be a stable name (not server-generated), the durable
+            delay queues are named after it.
+        :param max_attempts: attempts of processing a message, including
+            the first one.
+        :param retry_delay: seconds before the first retry.
+        :param max_retry_delay: max seconds before a retry.
+        """
+        if max_attempts < 1:
+            raise ValueError(f"Wrong {max_attempts=}")
+        self.channel = channel
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.queue_name = queue_name
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.dead_letter_exchange_name = f"{exchange_name}.dead"
+        self._dead_letter_exchange: Optional[AbstractExchange] = None
+
+    def get_delay_queue_name(self, attempt: int) -> str:
+        """Name of the queue of messages waiting for the next attempt."""
+        return f"{self.queue_name}.retry.{self._get_delay_ms(attempt)}ms"
+
+    async def declare(self):
+        """Declare delay queues and the dead-letter exchange and queue."""
+        for attempt in range(1, self.max_attempts):
+            # the queue name contains the delay, so changed settings don't
+            # conflict with arguments of existing queues
+            await self.channel.declare_queue(
+                self.get_delay_queue_name(attempt),
+                durable=True,
+                arguments={
+                    "x-message-ttl": self._get_delay_ms(attempt),
+                    # the default exchange routes by the queue name
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": self.queue_name,
+                },
+            )
+        self._dead_letter_exchange = await self.channel.declare_exchange(
+            self.dead_letter_exchange_name, ExchangeType.DIRECT, durable=True,
+        )
+        dead_letter_queue = await self.channel.declare_queue(
+            self.dead_letter_exchange_name, durable=True)
+        await dead_letter_queue.bind(
+            self._dead_letter_exchange, routing_key=self.routing_key)
+
+    async def handle_failure(
+            self,
+            message: AbstractIncomingMessage,
+            error: Exception,
+    ):
+        """
+        Publish the failed message to a delay queue or to the dead-letter
+        exchange (waits for confirmation), then it can be acked.
+        """
+        attempts = int(message.headers.get(ATTEMPTS_KEY, 0)) + 1
+        retry_message = self._copy_message(message, attempts, error)
+        if (attempts >= self.max_attempts
+                or isinstance(error, UnprocessableMessage)):
+            await self._dead_letter_exchange.publish(
+                retry_message, routing_key=self.routing_key)
+            metrics.counter("rmq.consumer.dead_lettered").inc()
+            logger.error(f"Message {message.message_id} is dead-lettered "
+                         f"after {attempts} attempts: {error!r}")
+            return
+        await self.channel.default_exchange.publish(
+            retry_message, routing_key=self.get_delay_queue_name(attempts))
+        metrics.counter("rmq.consumer.retried").inc()
+        logger.warning(f"Message {message.message_id} will be retried in "
+                       f"{self._get_delay_ms(attempts)} ms "
+                       f"({attempts=}): {error!r}")
+
+    def _get_delay_ms(self, attempt: int) -> int:
+        delay = min(self.retry_delay * 2 ** (attempt - 1),
+                    self.max_retry_delay)
+        return int(delay * 1000)
+
+    @staticmethod
+    def _copy_message(
+            message: AbstractIncomingMessage,
+            attempts: int,
+            error: Exception,
+    ) -> Message:
+        return Message(
+            message.body,
+            headers={**message.headers,
+                     ATTEMPTS_KEY: attempts,
+                     ERROR_KEY: repr(error)[:MAX_ERROR_LENGTH]},
+            content_type=message.content_type,
+            content_encoding=message.content_encoding,
+            delivery_mode=DeliveryMode.PERSISTENT,
+            message_id=message.message_id,
+            correlation_id=message.correlation_id,
+            timestamp=message.timestamp,
+            type=message.type,
+            app_id=message.app_id,
+        )
@@ -14,3 +14,10 @@ class ShopAdmin(admin.ModelAdmin):
 class StorageAdmin(admin.ModelAdmin):
     list_display = ('pk', 'name', 'warehouse_id',)
     list_display_links = ('pk', 'name')
+
+
+@admin.register(models.ShopOutboxMessage)
+class ShopOutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'shop_id', 'operation', 'created_at', 'attempts',
+                    'next_attempt_at',)
+    list_filter = ('operation',)
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:27
+
+from django.db import migrations, models
+
+
+def count_shops(apps, schema_editor):
+    Shop = apps.get_model('shop', 'Shop')
+    ShopCounter = apps.get_model('shop', 'ShopCounter')
+    ShopCounter.objects.update_or_create(
+        name='total', defaults={'value': Shop.objects.count()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_alter_warehouse_options_remove_warehouse_ozon_id_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Счетчик магазинов',
+                'verbose_name_plural': 'Счетчики магазинов',
+                'db_table': 'shop_counters',
+            },
+        ),
+        migrations.RunPython(count_shops, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:32
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_api_keys(apps, schema_editor):
+    Shop = apps.get_model('shop', 'Shop')
+    shops = list(Shop.objects.only('ozon_api_key'))
+    for shop in shops:
+        shop.ozon_api_key_hash = hashlib.sha256(
+            shop.ozon_api_key.encode()).hexdigest()
+    Shop.objects.bulk_update(shops, ['ozon_api_key_hash'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_shopcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='ozon_api_key_hash',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(hash_api_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_shop_ozon_api_key_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopOutboxMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shop_id', models.BigIntegerField(db_index=True)),
+                ('operation', models.CharField(max_length=20)),
+                ('body', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'verbose_name': 'Сообщение о магазине',
+                'verbose_name_plural': 'Исходящие сообщения о магазинах',
+                'db_table': 'shop_outbox',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_shopoutboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shop',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='shopoutboxmessage',
+            name='headers',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
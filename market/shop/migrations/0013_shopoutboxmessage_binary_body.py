@@ -0,0 +1,45 @@
+# Generated by Django 4.2.5 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+def copy_body(apps, schema_editor):
+    ShopOutboxMessage = apps.get_model('shop', 'ShopOutboxMessage')
+    for message in ShopOutboxMessage.objects.all():
+        message.payload = message.body.encode()
+        message.save(update_fields=['payload'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_shop_version_shopoutboxmessage_headers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shopoutboxmessage',
+            name='content_type',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='shopoutboxmessage',
+            name='payload',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(copy_body, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='shopoutboxmessage',
+            name='body',
+        ),
+        migrations.RenameField(
+            model_name='shopoutboxmessage',
+            old_name='payload',
+            new_name='body',
+        ),
+        migrations.AlterField(
+            model_name='shopoutboxmessage',
+            name='body',
+            field=models.BinaryField(),
+        ),
+    ]
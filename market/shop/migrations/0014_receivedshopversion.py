@@ -0,0 +1,26 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0013_shopoutboxmessage_binary_body'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceivedShopVersion',
+            fields=[
+                ('shop_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('version', models.PositiveBigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Версия полученного магазина',
+                'verbose_name_plural': 'Версии полученных магазинов',
+                'db_table': 'shop_received_versions',
+            },
+        ),
+    ]
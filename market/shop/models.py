@@ -1,4 +1,6 @@
-from django.db import models
+import hashlib
+
+from django.db import models, router, transaction
 from django.utils.translation import gettext_lazy as _
 
 
@@ -17,6 +19,95 @@ class Shop(models.Model):
     is_active = models.BooleanField(verbose_name="Магазин активен", default=False)
     price_updating = models.BooleanField(verbose_name="Обновление цен", default=True)
     vendor_name = models.CharField(max_length=50, verbose_name="Поставщик", default='Сималенд')
+    # sha256 of ozon_api_key, used for lookups instead of the raw key
+    ozon_api_key_hash = models.CharField(max_length=64, db_index=True, editable=False, default='')
+    # incremented on every change, sent to other services with the changes
+    version = models.PositiveBigIntegerField(default=0, editable=False)
+
+    # not sent to other services by the broker as fields
+    LOCAL_FIELDS = ('ozon_api_key_hash', 'version')
+
+    # names of fields changed by the last save, None if unknown
+    # (the object was not loaded from db)
+    changed_fields = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def get_changed_fields(self):
+        """Names of fields changed since loading, None if unknown."""
+        loaded_values = getattr(self, '_loaded_values', None)
+        if loaded_values is None or self.get_deferred_fields():
+            return None
+        return {field.name for field in self._meta.concrete_fields
+                if getattr(self, field.attname) != loaded_values[field.attname]}
+
+    @staticmethod
+    def hash_api_key(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def update_api_key_hash(self):
+        self.ozon_api_key_hash = self.hash_api_key(self.ozon_api_key)
+
+    def save(self, *args, **kwargs):
+        self.update_api_key_hash()
+        update_fields = kwargs.get('update_fields')
+        changed_fields = self.get_changed_fields()
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if changed_fields is None:
+                changed_fields = update_fields
+            else:
+                changed_fields &= update_fields
+            if 'ozon_api_key' in update_fields:
+                update_fields.add('ozon_api_key_hash')
+        is_versioned = (changed_fields is None
+                        or bool(changed_fields - set(self.LOCAL_FIELDS)))
+        if is_versioned and update_fields is not None:
+            update_fields.add('version')
+        if update_fields is not None:
+            kwargs['update_fields'] = update_fields
+        self.changed_fields = changed_fields
+        # the outbox message is written by post_save in the same transaction
+        using = kwargs.get('using') or router.db_for_write(Shop, instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            if is_versioned and not self._increment_version(using):
+                # a new row
+                self.version += 1
+            super().save(*args, **kwargs)
+        self._remember_saved_values(update_fields)
+
+    def _increment_version(self, using) -> bool:
+        """
+        Increment the version in the database, not the loaded one, so
+        concurrent changes (e.g. `ShopService._toggle`) can't get the same
+        version. The row stays locked by the UPDATE until the end of the
+        transaction.
+
+        :return: False if there is no row of the Shop yet.
+        """
+        if self.pk is None:
+            return False
+        shops = Shop.objects.using(using).filter(pk=self.pk)
+        if not shops.update(version=models.F('version') + 1):
+            return False
+        self.version = shops.values_list('version', flat=True).get()
+        return True
+
+    def _remember_saved_values(self, update_fields):
+        """Values in db after save, to find changed fields next time."""
+        loaded_values = getattr(self, '_loaded_values', None)
+        if update_fields is None:
+            loaded_values = {}
+        elif loaded_values is None:
+            return
+        for field in self._meta.concrete_fields:
+            if update_fields is None or field.name in update_fields:
+                loaded_values[field.attname] = getattr(self, field.attname)
+        self._loaded_values = loaded_values
 
 
 class Warehouse(models.Model):
@@ -31,3 +122,64 @@ class Warehouse(models.Model):
 
     def __str__(self):
         return f'{self.shop.name} - {self.name}'
+
+
+class ShopCounter(models.Model):
+    """
+    Counter of shops, maintained by signals (see shop.signals),
+    so the number of shops is never counted by COUNT(*).
+    """
+    TOTAL = "total"
+
+    class Meta:
+        verbose_name = 'Счетчик магазинов'
+        verbose_name_plural = 'Счетчики магазинов'
+        db_table = 'shop_counters'
+
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
+
+
+class ShopOutboxMessage(models.Model):
+    """
+    Shop change event, that must be sent to the broker.
+
+    Written by signals in the same transaction as the change of Shop,
+    sent and deleted by the relay (see rabbit.outbox).
+    Messages of one shop are sent in order of id.
+    """
+    class Meta:
+        verbose_name = 'Сообщение о магазине'
+        verbose_name_plural = 'Исходящие сообщения о магазинах'
+        db_table = 'shop_outbox'
+
+    # not a foreign key, messages about deleted shops are kept
+    shop_id = models.BigIntegerField(db_index=True)
+    operation = models.CharField(max_length=20)
+    body = models.BinaryField()
+    content_type = models.CharField(max_length=100, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    # the relay does not send messages of the shop until this time
+    next_attempt_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True, default='')
+    # AMQP headers of the message, besides the operation
+    headers = models.JSONField(default=dict, blank=True)
+
+
+class ReceivedShopVersion(models.Model):
+    """
+    Version of the last applied broker message about a shop.
+
+    Written by the consumer (see rabbit.callbacks) with the change,
+    messages with the same or a lower version are skipped.
+    """
+    class Meta:
+        verbose_name = 'Версия полученного магазина'
+        verbose_name_plural = 'Версии полученных магазинов'
+        db_table = 'shop_received_versions'
+
+    # not a foreign key, versions of deleted shops are kept
+    shop_id = models.BigIntegerField(primary_key=True)
+    version = models.PositiveBigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
@@ -1,16 +1,49 @@
+import asyncio
+import dataclasses
 import logging
+import threading
 
-from typing import Optional
+from typing import Callable, Optional
 
+from cachetools import TTLCache
 from django.conf import settings
-from django.db.models import QuerySet
+from django.db import connections, router, transaction
+from django.db.models import F, QuerySet
+from django.db.models.signals import post_save
+from django.utils.crypto import constant_time_compare
 
-from shop.models import Shop
+from shop.models import Shop, ShopCounter
+from tg_bot import db_executor, metrics
 from tg_bot.data_classes import ShopInfo
 
 logger = logging.getLogger(__name__)
 
 LIST_LIMIT = settings.TG_BOT_LIST_LIMIT
+SHOP_INFO_CACHE_SIZE = settings.TG_SHOP_INFO_CACHE_SIZE
+SHOP_INFO_CACHE_TTL = settings.TG_SHOP_INFO_CACHE_TTL
+SHOP_PAGE_CACHE_SIZE = settings.TG_SHOP_PAGE_CACHE_SIZE
+SHOP_PAGE_CACHE_TTL = settings.TG_SHOP_PAGE_CACHE_TTL
+
+# ShopInfo by Shop.pk, invalidated after commit of every save and delete
+# of Shop (shop.signals) and by applied broker messages (rabbit.callbacks).
+_shop_info_cache = TTLCache(maxsize=SHOP_INFO_CACHE_SIZE,
+                            ttl=SHOP_INFO_CACHE_TTL)
+# Pages of shop lists by (scope, version, limit, after, before).
+# Pages of the old version are never read and expire by TTL.
+_shop_page_cache = TTLCache(maxsize=SHOP_PAGE_CACHE_SIZE,
+                            ttl=SHOP_PAGE_CACHE_TTL)
+# Version stamp of all shops, incremented on every invalidation, also on
+# the ones received from other bot processes (tg_bot.workers).
+# A read that started before an invalidation does not put its
+# (maybe outdated) result into the caches.
+_shops_version = 0
+# signals are sent from ORM threads
+_shop_cache_lock = threading.Lock()
+# called with Shop.pk after local invalidation, e.g. to send it to other
+# bot worker processes (tg_bot.workers), they must be thread-safe
+_invalidation_listeners: list[Callable[[int], None]] = []
+# running prefetch tasks (keep references until they are done)
+_prefetch_tasks: set[asyncio.Task] = set()
 
 
 class ShopService:
@@ -20,45 +53,161 @@ class ShopService:
             self,
             qs: QuerySet[Shop],
             limit: int = LIST_LIMIT,
-            offset: int = 0,
+            after: Optional[int] = None,
+            before: Optional[int] = None,
+            scope: Optional[tuple] = None,
     ) -> list[ShopInfo]:
         """
         Prepare `page` of ShopInfo for displaying (e.g. as a keyboard).
 
+        Keyset pagination ordered by id, so the query uses the primary key
+        index and does not depend on how far the page is.
         :param qs: QuerySet of Shops
         :param limit: limit
-        :param offset: offset
-        :return: list of ShopInfo obj. that represents a part of passed
-            QuerySet. ShopInfo obj. contains only important fields for
-            pagination (id, name, is_active).
+        :param after: take first `limit` shops with greater id.
+        :param before: take last `limit` shops with smaller id.
+            If both cursors are None, it is the first page.
+        :param scope: hashable key that identifies qs (e.g. all shops or
+            shops of a seller), if it is passed the page is cached.
+        :return: list of ShopInfo obj. ordered by id, that represents a part
+            of passed QuerySet. ShopInfo obj. contains only important fields
+            for pagination (id, name, is_active).
+        """
+        if limit < 1:
+            raise AttributeError(f"Limit less than 1: {limit=}")
+        if scope is None:
+            return await self._query_page(qs, limit, after, before)
+
+        with _shop_cache_lock:
+            version = _shops_version
+            key = (scope, version, limit, after, before)
+            page = _shop_page_cache.get(key)
+        if page is not None:
+            metrics.counter("shop_page_cache.hit").inc()
+        else:
+            metrics.counter("shop_page_cache.miss").inc()
+            page = await self._query_page(qs, limit, after, before)
+            with _shop_cache_lock:
+                if version == _shops_version:
+                    _shop_page_cache[key] = page
+        return [dataclasses.replace(shop_info) for shop_info in page]
+
+    def prefetch_next_page(
+            self,
+            qs: QuerySet[Shop],
+            page: list[ShopInfo],
+            limit: int,
+            scope: tuple,
+    ):
         """
-        if (limit < 0) or (offset < 0):
-            raise AttributeError(
-                f"Limit or offset less than 0: {limit=}; {offset=}")
+        Load the page after `page` into the page cache in background.
 
-        shops = qs.order_by("id").only("name", "is_active")
-        shops = shops[offset:(offset + limit)]
+        So `next` button is answered from memory.
+        """
+        if len(page) < limit:
+            # it is the last page
+            return
+        task = asyncio.create_task(
+            self._prefetch(qs, limit, after=page[-1].id, scope=scope))
+        _prefetch_tasks.add(task)
+        task.add_done_callback(_prefetch_tasks.discard)
+
+    async def _prefetch(self, qs: QuerySet[Shop], limit: int, after: int,
+                        scope: tuple):
+        with _shop_cache_lock:
+            key = (scope, _shops_version, limit, after, None)
+            if key in _shop_page_cache:
+                return
+        try:
+            with db_executor.priority(db_executor.BACKGROUND):
+                await self.paginate_shops_for_buttons(
+                    qs, limit, after=after, scope=scope)
+        except Exception as e:
+            logger.warning(f"Can't prefetch shop page {scope=}, {after=}: "
+                           f"{e!r}")
+
+    async def _query_page(
+            self,
+            qs: QuerySet[Shop],
+            limit: int,
+            after: Optional[int],
+            before: Optional[int],
+    ) -> list[ShopInfo]:
+        """Select page from db (see `paginate_shops_for_buttons`)."""
+        shops = qs.only("name", "is_active")
+        if after is not None:
+            shops = shops.filter(id__gt=after).order_by("id")
+        elif before is not None:
+            shops = shops.filter(id__lt=before).order_by("-id")
+        else:
+            shops = shops.order_by("id")
+        shops = shops[:limit]
 
         result = []
-        async for shop in shops:
+        for shop in await db_executor.run(list, shops):
             shop_info = ShopInfo(
                 id=shop.pk,
                 name=shop.name,
                 is_active=shop.is_active,
             )
             result.append(shop_info)
+        if after is None and before is not None:
+            result.reverse()
         return result
 
     async def get_shop_info_by_id(self, shop_id: int) -> ShopInfo:
         """
         Get full information about Shop object.
 
+        Read through ShopInfo cache.
         :param shop_id: Shop.pk.
-        :return: data object ShopInfo.
+        :return: data object ShopInfo (a copy, it can be changed).
         """
-        shop = await Shop.objects.aget(id=shop_id)
+        with _shop_cache_lock:
+            shop_info = _shop_info_cache.get(shop_id)
+            version = _shops_version
+        if shop_info is not None:
+            metrics.counter("shop_info_cache.hit").inc()
+            return dataclasses.replace(shop_info)
+        metrics.counter("shop_info_cache.miss").inc()
+
+        shop = await db_executor.run(Shop.objects.get, id=shop_id)
         logger.debug(f"get_shop_info {shop.pk}")
-        return self._to_shop_info(shop)
+        shop_info = self._to_shop_info(shop)
+        with _shop_cache_lock:
+            if version == _shops_version:
+                _shop_info_cache[shop_id] = shop_info
+        return dataclasses.replace(shop_info)
+
+    def invalidate_shop_info(self, shop_id: int, notify: bool = True):
+        """
+        Remove ShopInfo from the cache (when Shop is changed).
+
+        Cached pages of shop lists become outdated too. Call it after
+        commit of the change (see `transaction.on_commit`), a read that
+        starts later must see the new row.
+        :param shop_id: Shop.pk.
+        :param notify: call invalidation listeners, False if the
+            invalidation came from another process.
+        """
+        global _shops_version
+        with _shop_cache_lock:
+            _shops_version += 1
+            _shop_info_cache.pop(shop_id, None)
+        if notify:
+            for listener in list(_invalidation_listeners):
+                listener(shop_id)
+
+    def add_invalidation_listener(self, listener: Callable[[int], None]):
+        """
+        Call `listener(shop_id)` on every `invalidate_shop_info`.
+
+        It is called from the thread that changed Shop (e.g. ORM threads).
+        """
+        _invalidation_listeners.append(listener)
+
+    def remove_invalidation_listener(self, listener: Callable[[int], None]):
+        _invalidation_listeners.remove(listener)
 
     async def get_shop_info_by_api_key(self, api_key: str) -> ShopInfo:
         """
@@ -67,7 +216,9 @@ class ShopService:
         :param api_key: api_key, used as identifier
         :return: data object ShopInfo
         """
-        shop = await Shop.objects.aget(ozon_api_key=api_key)
+        shop = await self.get_shop_by_api_key(api_key)
+        if shop is None:
+            raise Shop.DoesNotExist(f"Shop with {api_key=} DoesNotExist")
         logger.debug(f"get_shop_info {shop.pk=}")
         return self._to_shop_info(shop)
 
@@ -84,19 +235,46 @@ class ShopService:
         )
         return shop_info
 
+    async def get_total_count(self) -> int:
+        """Get number of all shops from the counter (without COUNT)."""
+        counter = await db_executor.run(
+            ShopCounter.objects.filter(name=ShopCounter.TOTAL).first)
+        if counter is None:
+            return await db_executor.run(Shop.objects.count)
+        return counter.value
+
+    def change_total_count(self, delta: int):
+        """
+        Add delta to the counter of all shops.
+
+        Must be called after Shop is created (+1) or deleted (-1).
+        """
+        updated = ShopCounter.objects.filter(name=ShopCounter.TOTAL) \
+            .update(value=F("value") + delta)
+        if not updated:
+            # the change is already in the table
+            ShopCounter.objects.get_or_create(
+                name=ShopCounter.TOTAL,
+                defaults={"value": Shop.objects.count()},
+            )
+
     async def get_shop_by_api_key(self, shop_api_key: str) -> Optional[Shop]:
         """
         Async get Shop by api_key.
 
-        If shop does not exist returns None
+        If shop does not exist returns None.
+        Shop is found by indexed hash of the key, then the key itself is
+        compared in constant time.
         :param shop_api_key: api_key.
         :return: Shop object or None.
         """
-        try:
-            shop = await Shop.objects.aget(ozon_api_key=shop_api_key)
-            return shop
-        except Shop.DoesNotExist:
-            logger.debug(f"Shop with {shop_api_key=} DoesNotExist")
+        key_hash = Shop.hash_api_key(shop_api_key)
+        shops = await db_executor.run(
+            list, Shop.objects.filter(ozon_api_key_hash=key_hash))
+        for shop in shops:
+            if constant_time_compare(shop.ozon_api_key, shop_api_key):
+                return shop
+        logger.debug("Shop with the api key DoesNotExist")
 
     async def get_shop_by_id(self, shop_id) -> Optional[Shop]:
         """
@@ -107,21 +285,67 @@ class ShopService:
         :return: Shop object or None.
         """
         try:
-            shop = await Shop.objects.aget(id=shop_id)
+            shop = await db_executor.run(Shop.objects.get, id=shop_id)
             return shop
         except Shop.DoesNotExist:
             logger.debug(f"Shop with {shop_id=} DoesNotExist")
 
-    async def switch_activation(self, shop_id):
-        """Changes `is_active` field in Shop object to opposite value."""
-        shop = await self.get_shop_by_id(shop_id)
-        shop.is_active = not shop.is_active
-        await shop.asave()
+    async def switch_activation(self, shop_id) -> ShopInfo:
+        """
+        Changes `is_active` field in Shop object to opposite value.
+
+        :return: ShopInfo with the new state.
+        """
+        return await self._toggle(shop_id, "is_active")
 
-    async def switch_price_updating(self, shop_id):
+    async def switch_price_updating(self, shop_id) -> ShopInfo:
         """
-        Changes `stop_updated_price` field in Shop object to opposite value.
+        Changes `price_updating` field in Shop object to opposite value.
+
+        :return: ShopInfo with the new state.
+        """
+        return await self._toggle(shop_id, "price_updating")
+
+    async def _toggle(self, shop_id, field_name: str) -> ShopInfo:
         """
-        shop = await self.get_shop_by_id(shop_id)
-        shop.update_prices = not shop.update_prices
-        await shop.asave()
+        Invert boolean field by one `UPDATE ... SET col = NOT col` statement.
+
+        The statement returns the updated row, so concurrent switches can't
+        lose each other and the new state is known without another query.
+        post_save is sent as if the Shop was saved (caches, broker).
+        """
+        shop = await db_executor.run(
+            self._toggle_and_notify, shop_id, field_name)
+        if shop is None:
+            raise Shop.DoesNotExist(f"Shop with {shop_id=} DoesNotExist")
+        return self._to_shop_info(shop)
+
+    @staticmethod
+    def _toggle_and_notify(shop_id, field_name: str) -> Optional[Shop]:
+        using = router.db_for_write(Shop)
+        quote_name = connections[using].ops.quote_name
+        opts = Shop._meta
+        column = quote_name(opts.get_field(field_name).column)
+        version = quote_name(opts.get_field("version").column)
+        returning = ", ".join(
+            quote_name(field.column) for field in opts.concrete_fields)
+        sql = (f"UPDATE {quote_name(opts.db_table)} "
+               f"SET {column} = NOT {column}, {version} = {version} + 1 "
+               f"WHERE {quote_name(opts.pk.column)} = %s "
+               f"RETURNING {returning}")
+        # post_save writes the outbox message in the same transaction
+        with transaction.atomic(using=using):
+            # raw queryset converts db values (e.g. 0/1 in SQLite to bool)
+            shops = list(Shop.objects.db_manager(using).raw(sql, [shop_id]))
+            if not shops:
+                return None
+            shop = shops[0]
+            post_save.send(
+                sender=Shop,
+                instance=shop,
+                created=False,
+                update_fields=frozenset([field_name]),
+                raw=False,
+                using=using,
+            )
+        return shop
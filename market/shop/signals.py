@@ -1,18 +1,20 @@
-import asyncio
 import logging
+from typing import Optional
 
-from aio_pika import DeliveryMode, Message
-from django.core import serializers
 from django.conf import settings
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from rabbit import broker
+from rabbit import broker, codecs
 
-from .models import Shop
+from .models import Shop, ShopOutboxMessage
+from .services import ShopService
 
 logger = logging.getLogger(__name__)
 
 ENABLE_SIGNALS_TO_SYNCHRONISE_DB = settings.ENABLE_SIGNALS_TO_SYNCHRONISE_DB
+SHOP_MESSAGE_CONTENT_TYPE = settings.RMQ_SHOP_MESSAGE_CONTENT_TYPE
+SHOP_SEND_DELTAS = settings.RMQ_SHOP_SEND_DELTAS
 
 
 def only_if_enabled(signal, enabled, **kwargs):
@@ -26,7 +28,8 @@ def only_if_enabled(signal, enabled, **kwargs):
     ```
     @only_if_enabled(post_save, ENABLE_SIGNALS_TO_SYNCHRONISE_DB, sender=Shop)
     @receiver(post_save, sender=Shop)
-    def create_or_update_shop(sender, instance, created, **kwargs):
+    def create_or_update_shop(sender, instance, created, update_fields=None,
+                          **kwargs):
         ...
     ```
     :param signal:
@@ -50,31 +53,37 @@ def only_if_enabled(signal, enabled, **kwargs):
 
 @only_if_enabled(post_save, ENABLE_SIGNALS_TO_SYNCHRONISE_DB, sender=Shop)
 @receiver(post_save, sender=Shop)
-def create_or_update_shop(sender, instance, created, **kwargs):
+def create_or_update_shop(sender, instance, created, update_fields=None,
+                          **kwargs):
     """
     Signal triggered when the Shop object is created or updated
     """
     logger.info("Shop post save signal")
 
-    data = serializers.serialize("json", [instance])
-
-    if not created:
-        logger.info(f"Updated {instance=}, {instance.pk=}")
-        message = Message(
-            data.encode(),
-            delivery_mode=DeliveryMode.PERSISTENT,
-            headers={broker.OPERATION_KEY: broker.UPDATE_OPERATION},
-        )
-    else:
+    if created:
         logger.info(f"Created {instance=}, {instance.pk=}")
-        message = Message(
-            data.encode(),
-            delivery_mode=DeliveryMode.PERSISTENT,
-            headers={broker.OPERATION_KEY: broker.CREATE_OPERATION},
-        )
-    coro = broker.Broker().send(
-        broker.BOT_SHOP_EXCHANGE, message, broker.BOT_SHOP_ROUTING_KEY)
-    asyncio.run(coro)
+        _add_to_outbox(instance, broker.CREATE_OPERATION)
+        return
+
+    logger.info(f"Updated {instance=}, {instance.pk=}")
+    changed_fields = instance.changed_fields
+    if changed_fields is None and update_fields is not None:
+        changed_fields = update_fields
+    if changed_fields is None:
+        # changes are unknown, send the whole object
+        _add_to_outbox(instance, broker.UPDATE_OPERATION)
+        return
+
+    field_names = [field.name
+                   for field in codecs.get_synchronised_fields(Shop)
+                   if field.name in changed_fields]
+    if not field_names:
+        logger.debug(f"No synchronised fields of {instance.pk=} changed")
+        return
+    if not SHOP_SEND_DELTAS:
+        # receivers that don't support deltas get the whole object
+        field_names = None
+    _add_to_outbox(instance, broker.UPDATE_OPERATION, field_names)
 
 
 @only_if_enabled(post_delete, ENABLE_SIGNALS_TO_SYNCHRONISE_DB, sender=Shop)
@@ -84,11 +93,60 @@ def delete_shop(sender, instance, **kwargs):
     Signal triggered when the Shop object is deleted
     """
     logger.info(f"Deleted {instance=}, {instance.pk=}")
-    message = Message(
-        str(instance.id).encode(),
-        delivery_mode=DeliveryMode.PERSISTENT,
-        headers={broker.OPERATION_KEY: broker.DELETE_OPERATION},
+    _add_to_outbox(instance, broker.DELETE_OPERATION, field_names=[])
+
+
+@receiver(post_save, sender=Shop)
+@receiver(post_delete, sender=Shop)
+def invalidate_shop_info(sender, instance, using, **kwargs):
+    """
+    Drop cached ShopInfo, it is connected regardless of broker signals.
+
+    It is dropped after commit, otherwise a concurrent read could cache
+    the old committed row as the new version.
+    """
+    shop_id = instance.pk
+    transaction.on_commit(
+        lambda: ShopService().invalidate_shop_info(shop_id), using=using)
+
+
+@receiver(post_save, sender=Shop)
+def count_created_shop(sender, instance, created, **kwargs):
+    """Maintain the counter of all shops."""
+    if created:
+        ShopService().change_total_count(1)
+
+
+@receiver(post_delete, sender=Shop)
+def count_deleted_shop(sender, instance, **kwargs):
+    """Maintain the counter of all shops."""
+    ShopService().change_total_count(-1)
+
+
+def _add_to_outbox(instance: Shop, operation: str,
+                   field_names: Optional[list[str]] = None):
+    """
+    Save message for the broker in the transaction of the change.
+
+    It is sent by the outbox relay (rabbit.outbox).
+    The body is encoded by the codec of SHOP_MESSAGE_CONTENT_TYPE.
+    :param field_names: changed fields for delta update message,
+        if None the whole object is sent.
+    """
+    codec = codecs.get_codec(SHOP_MESSAGE_CONTENT_TYPE)
+    is_delta = operation == broker.UPDATE_OPERATION and field_names is not None
+    record = codecs.record_from_instance(instance, field_names)
+    version = instance.version
+    if operation == broker.DELETE_OPERATION:
+        # deleting is a change too, the last update has the current version
+        version += 1
+    headers = {broker.VERSION_KEY: version}
+    if is_delta:
+        headers[broker.FORMAT_KEY] = broker.DELTA_FORMAT
+    ShopOutboxMessage.objects.create(
+        shop_id=instance.pk,
+        operation=operation,
+        body=codec.encode(record, operation, is_delta),
+        content_type=codec.content_type,
+        headers=headers,
     )
-    coro = broker.Broker().send(
-        broker.BOT_SHOP_EXCHANGE, message, broker.BOT_SHOP_ROUTING_KEY)
-    asyncio.run(coro)
@@ -5,12 +5,16 @@ from warnings import filterwarnings
 
 from telegram import Update
 from telegram.warnings import PTBUserWarning
-from telegram.ext import ApplicationBuilder
+from telegram.ext import Application, ApplicationBuilder, TypeHandler
 from django.conf import settings
 
-from tg_bot import set_up, customisation
-from tg_bot.run import run_polling
-from rabbit import broker, callbacks
+from tg_bot import set_up, customisation, metrics
+from tg_bot.run import run_polling, run_webhook
+from tg_bot.persistence import DjangoPersistence
+from tg_bot.services import TelegramUserService
+from tg_bot.update_processor import ChatOrderedUpdateProcessor
+from tg_bot.workers import WorkerPool
+from rabbit import broker, callbacks, outbox
 
 
 # to ignore CallbackQueryHandler warnings
@@ -27,22 +31,67 @@ logger = logging.getLogger(__name__)
 
 TOKEN = settings.TG_BOT_TOKEN
 AUTO_CUSTOMISATION = settings.TG_AUTO_CUSTOMISATION
+CONCURRENT_UPDATES = settings.TG_BOT_CONCURRENT_UPDATES
+WORKERS = settings.TG_BOT_WORKERS
+METRICS_LOG_INTERVAL = settings.TG_METRICS_LOG_INTERVAL
+USER_STATUS_CHECK_INTERVAL = settings.TG_USER_STATUS_CHECK_INTERVAL
+PERSISTENCE_FLUSH_INTERVAL = settings.TG_PERSISTENCE_FLUSH_INTERVAL
 
+POLLING_MODE = "polling"
+WEBHOOK_MODE = "webhook"
+MODES = (POLLING_MODE, WEBHOOK_MODE)
 
-def run():
+
+def build_application(with_updater: bool = True) -> Application:
     """
-    Start telegram bot and register all handlers.
+    Create application and register all handlers.
+
+    :param with_updater: False for worker processes, that get updates
+        from the front process.
     """
-    logger.info("Bot is running.")
-    # arbitrary_callback_data(True) makes it possible to pass
-    # any type as callback data
-    application = ApplicationBuilder() \
-        .concurrent_updates(False) \
+    # callback data is encoded into strings (see tg_bot.callback_data),
+    # so arbitrary_callback_data is not used
+    builder = ApplicationBuilder() \
+        .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES)) \
         .token(TOKEN) \
-        .arbitrary_callback_data(True) \
-        .build()
+        .persistence(DjangoPersistence(PERSISTENCE_FLUSH_INTERVAL))
+    if not with_updater:
+        builder = builder.updater(None)
+    application = builder.build()
 
     set_up.register_handlers(application)
+    return application
+
+
+def build_worker_application() -> Application:
+    """Create application for worker process."""
+    return build_application(with_updater=False)
+
+
+def run(mode: str = settings.TG_BOT_MODE, workers: int = WORKERS):
+    """
+    Start telegram bot and register all handlers.
+
+    :param mode: how to receive updates, `polling` or `webhook`.
+    :param workers: number of worker processes, if 0 updates are processed
+        in the same process.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown {mode=}, expected one of {MODES}")
+    logger.info(f"Bot is running ({mode}, {workers=}).")
+    if workers:
+        # workers are forked by a clean fork server, not by this process
+        pool = WorkerPool(workers, build_worker_application)
+        pool.start()
+        # front process only forwards updates to the workers
+        application = ApplicationBuilder() \
+            .token(TOKEN) \
+            .post_init(pool.connect) \
+            .post_shutdown(pool.close) \
+            .build()
+        application.add_handler(TypeHandler(Update, pool.forward))
+    else:
+        application = build_application()
 
     # Set or refresh some bot attributes
     # (if False it can be set manually using BotFather).
@@ -55,10 +104,30 @@ def run():
         callbacks.on_message_shop,
         broker.OZON_SHOP_EXCHANGE,
         broker.OZON_SHOP_ROUTING_KEY,
+        partition_key=callbacks.get_shop_pk,
+        batch_callback=callbacks.on_messages_shop,
     )
-    run_polling(application,
-                side_coroutines=[rmq_consumer_coro],
-                allowed_updates=Update.ALL_TYPES)
+    side_coroutines = [rmq_consumer_coro, outbox.OutboxRelay().run()]
+    if METRICS_LOG_INTERVAL:
+        side_coroutines.append(metrics.log_periodically(METRICS_LOG_INTERVAL))
+    if USER_STATUS_CHECK_INTERVAL and not workers:
+        # workers check it themselves, the front does not handle updates
+        side_coroutines.append(TelegramUserService().watch_statuses_version(
+            USER_STATUS_CHECK_INTERVAL))
+    if mode == WEBHOOK_MODE:
+        run_webhook(application,
+                    side_coroutines=side_coroutines,
+                    listen=settings.TG_WEBHOOK_LISTEN,
+                    port=settings.TG_WEBHOOK_PORT,
+                    url_path=settings.TG_WEBHOOK_PATH,
+                    webhook_url=settings.TG_WEBHOOK_URL,
+                    secret_token=settings.TG_WEBHOOK_SECRET_TOKEN,
+                    register_webhook=settings.TG_WEBHOOK_REGISTER,
+                    allowed_updates=Update.ALL_TYPES)
+    else:
+        run_polling(application,
+                    side_coroutines=side_coroutines,
+                    allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,95 @@
+"""
+Compact encoding of callback data objects.
+
+Objects are encoded into short strings (Telegram allows up to 64 bytes),
+so callback data does not need any storage on the bot side:
+- ShopInfo -> `s:<id>`
+- Navigation -> `n:<limit>:<page>` (first page),
+  `n:<limit>:<page>:a:<id>` (after id) or `n:<limit>:<page>:b:<id>` (before id)
+
+Decoded objects and buttons that no handler expects are counted in
+metrics (`callback_data.decoded`, `callback_data.invalid`).
+"""
+import re
+from typing import Union
+
+from django.conf import settings
+
+from tg_bot import metrics
+from tg_bot.data_classes import Navigation, ShopInfo
+
+SEPARATOR = ":"
+SHOP_INFO_PREFIX = "s"
+NAVIGATION_PREFIX = "n"
+AFTER = "a"
+BEFORE = "b"
+# max items on a page, the limit in callback data is sent by the client
+LIST_LIMIT = settings.TG_BOT_LIST_LIMIT
+
+# patterns for CallbackQueryHandler
+SHOP_INFO_PATTERN = rf"^{SHOP_INFO_PREFIX}{SEPARATOR}\d+$"
+NAVIGATION_PATTERN = (rf"^{NAVIGATION_PREFIX}{SEPARATOR}\d+{SEPARATOR}\d+"
+                      rf"({SEPARATOR}[{AFTER}{BEFORE}]{SEPARATOR}\d+)?$")
+
+
+def is_invalid(data: str) -> bool:
+    """
+    Check that data has a prefix of an encoded object, but can't be
+    decoded, e.g. it is damaged or sent by an older version of the bot.
+
+    Can be used as a pattern of CallbackQueryHandler.
+    """
+    prefix, _, _ = data.partition(SEPARATOR)
+    if prefix == SHOP_INFO_PREFIX:
+        return re.match(SHOP_INFO_PATTERN, data) is None
+    if prefix == NAVIGATION_PREFIX:
+        return re.match(NAVIGATION_PATTERN, data) is None
+    return False
+
+
+def encode_shop_info(shop_info: ShopInfo) -> str:
+    """Only id is encoded, other fields must be fetched by handler."""
+    return f"{SHOP_INFO_PREFIX}{SEPARATOR}{shop_info.id}"
+
+
+def encode_navigation(navigation: Navigation) -> str:
+    encoded = (f"{NAVIGATION_PREFIX}{SEPARATOR}{navigation.limit}"
+               f"{SEPARATOR}{navigation.page}")
+    if navigation.after is not None:
+        encoded += f"{SEPARATOR}{AFTER}{SEPARATOR}{navigation.after}"
+    elif navigation.before is not None:
+        encoded += f"{SEPARATOR}{BEFORE}{SEPARATOR}{navigation.before}"
+    return encoded
+
+
+def decode(data: str) -> Union[ShopInfo, Navigation, str]:
+    """
+    Decode callback data.
+
+    :param data: callback data from CallbackQuery.
+    :return: ShopInfo (only with id), Navigation (limit is not more than
+        LIST_LIMIT), or the same string if it is not an encoded object.
+    """
+    prefix, _, payload = data.partition(SEPARATOR)
+    try:
+        if prefix == SHOP_INFO_PREFIX:
+            decoded = ShopInfo(id=int(payload), name="")
+        elif prefix == NAVIGATION_PREFIX:
+            limit, page, *cursor = payload.split(SEPARATOR)
+            decoded = Navigation(limit=min(max(int(limit), 1), LIST_LIMIT),
+                                 page=int(page))
+            if cursor:
+                direction, cursor_id = cursor
+                if direction == AFTER:
+                    decoded.after = int(cursor_id)
+                elif direction == BEFORE:
+                    decoded.before = int(cursor_id)
+                else:
+                    raise ValueError(f"Unknown {direction=}")
+        else:
+            return data
+    except ValueError:
+        metrics.counter("callback_data.invalid").inc()
+        raise ValueError(f"Wrong callback data: {data=}")
+    metrics.counter("callback_data.decoded").inc()
+    return decoded
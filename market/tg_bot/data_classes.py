@@ -15,8 +15,32 @@ class ShopInfo:
     individual_updating_time: Optional[bool] = field(default=None, repr=False)
 
 
+@dataclass
+class TelegramUserInfo:
+    """Represents TelegramUser model with ids of linked shops."""
+    id: int
+    chat_id: int
+    role: str
+    is_banned: bool
+    is_active: bool
+    is_logged_out: bool
+    shops_count: int
+    shop_ids: list[int] = field(default_factory=list, repr=False)
+    # generation of the status cache when it was loaded
+    # (see TelegramUserService.cache_statuses)
+    status_cache_generation: int = field(default=0, repr=False, compare=False)
+
+
 @dataclass
 class Navigation:
-    """Contains information for page navigation."""
+    """
+    Contains information for page navigation.
+
+    Pages are selected by cursor (keyset pagination): items after
+    the last item of the previous page, or before the first item of the
+    next page. Without cursors it is the first page.
+    """
     limit: int
-    offset: int
+    page: int = 1  # only for displaying
+    after: Optional[int] = None  # id of the last item of the previous page
+    before: Optional[int] = None  # id of the first item of the next page
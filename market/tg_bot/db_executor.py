@@ -0,0 +1,191 @@
+"""
+Executor for database queries of the bot process.
+
+Async ORM methods (`aget`, `asave`, etc.) run all queries on one thread
+(`sync_to_async(thread_sensitive=True)`), so queries from all chats and
+from the broker consumer wait for each other. Services run ORM calls in
+this executor instead:
+```
+shop = await db_executor.run(Shop.objects.get, id=shop_id)
+shops = await db_executor.run(list, qs)
+```
+Every thread has its own connection, which is kept open between calls
+(`CONN_MAX_AGE`) and closed if it is broken or too old.
+
+Waiting calls are started by priority class: INTERACTIVE (handlers,
+default) before BACKGROUND (broker messages, persistence, prefetch).
+BACKGROUND calls get at least DB_BACKGROUND_MIN_SHARE of started calls
+while they wait, so they can't starve. The class is set for the current
+task:
+```
+with db_executor.priority(db_executor.BACKGROUND):
+    ...
+```
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from django import db
+from django.conf import settings
+
+from tg_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_EXECUTOR_WORKERS = settings.TG_DB_EXECUTOR_WORKERS
+DB_BACKGROUND_MIN_SHARE = settings.TG_DB_BACKGROUND_MIN_SHARE
+SQLITE_WAL = settings.DB_SQLITE_WAL
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+# in order of priority
+PRIORITIES = (INTERACTIVE, BACKGROUND)
+
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "db_priority", default=INTERACTIVE)
+
+# created on first use, so worker processes create their own threads
+_executor: Optional[ThreadPoolExecutor] = None
+_scheduler: Optional["_PriorityScheduler"] = None
+
+
+@contextmanager
+def priority(priority_class: str):
+    """Set priority class of db calls made inside the `with` block."""
+    if priority_class not in PRIORITIES:
+        raise ValueError(f"Unknown {priority_class=}")
+    token = _priority.set(priority_class)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+async def run(func: Callable, *args, **kwargs):
+    """
+    Run sync function that uses ORM in the database executor.
+
+    Not more than DB_EXECUTOR_WORKERS functions run at the same time,
+    others wait in the queue of their priority class
+    (`db.<class>.queue_wait`, `db.<class>.queue_depth` metrics).
+    """
+    global _executor, _scheduler
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=DB_EXECUTOR_WORKERS,
+            thread_name_prefix="db_executor",
+        )
+        _scheduler = _PriorityScheduler(
+            DB_EXECUTOR_WORKERS, DB_BACKGROUND_MIN_SHARE)
+    priority_class = _priority.get()
+    queued_at = time.perf_counter()
+    await _scheduler.acquire(priority_class)
+    try:
+        metrics.timer(f"db.{priority_class}.queue_wait").observe(
+            time.perf_counter() - queued_at)
+        loop = asyncio.get_running_loop()
+        call = functools.partial(_call_with_connection, func, *args, **kwargs)
+        with metrics.timer(f"db.{priority_class}.latency").time():
+            return await loop.run_in_executor(_executor, call)
+    finally:
+        _scheduler.release()
+
+
+def database_sync_to_async(func: Callable):
+    """Decorator, makes sync function awaitable, it runs in the executor."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+class _PriorityScheduler:
+    """
+    Semaphore that wakes up waiters by priority class.
+
+    A free slot is given to the oldest INTERACTIVE waiter, but if
+    BACKGROUND waiters were skipped too many times in a row, to the oldest
+    BACKGROUND one.
+    """
+
+    def __init__(self, slots: int, background_min_share: float):
+        if not 0 < background_min_share <= 1:
+            raise ValueError(f"Wrong {background_min_share=}")
+        self._free_slots = slots
+        self._waiters: dict[str, deque[asyncio.Future]] = {
+            priority_class: deque() for priority_class in PRIORITIES}
+        self._max_background_skips = round(1 / background_min_share) - 1
+        self._background_skips = 0
+
+    async def acquire(self, priority_class: str):
+        if self._free_slots and not any(self._waiters.values()):
+            self._free_slots -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority_class].append(waiter)
+        depth = metrics.gauge(f"db.{priority_class}.queue_depth")
+        depth.inc()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if not waiter.cancelled():
+                # the slot was already given to this waiter
+                self.release()
+            elif waiter in self._waiters[priority_class]:
+                self._waiters[priority_class].remove(waiter)
+            raise
+        finally:
+            depth.dec()
+
+    def release(self):
+        while (waiter := self._next_waiter()) is not None:
+            # cancelled waiters are removed by their tasks later
+            if not waiter.done():
+                # the slot goes to the waiter
+                waiter.set_result(None)
+                return
+        self._free_slots += 1
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        interactive = self._waiters[INTERACTIVE]
+        background = self._waiters[BACKGROUND]
+        if background and (
+                not interactive
+                or self._background_skips >= self._max_background_skips):
+            self._background_skips = 0
+            return background.popleft()
+        if interactive:
+            if background:
+                self._background_skips += 1
+            return interactive.popleft()
+        return None
+
+
+def _call_with_connection(func: Callable, *args, **kwargs):
+    """Call func, reusing connection of the current thread if it is alive."""
+    db.close_old_connections()
+    try:
+        with metrics.timer("db.run_time").time():
+            return func(*args, **kwargs)
+    finally:
+        db.close_old_connections()
+
+
+def set_up_connection(connection):
+    """
+    Configure new connection (`connection_created` receiver).
+
+    SQLite: WAL journal allows reading while another connection writes.
+    Waiting for locks is set by `timeout` in DATABASES OPTIONS.
+    """
+    if connection.vendor == "sqlite" and SQLITE_WAL:
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL;")
+            cursor.execute("PRAGMA synchronous=NORMAL;")
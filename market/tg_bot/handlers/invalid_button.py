@@ -4,19 +4,25 @@ from telegram import Update
 from telegram.ext import (
     ContextTypes,
 )
-from tg_bot import texts
+from tg_bot import metrics, texts
 
 logger = logging.getLogger(__name__)
 
 
 async def handle_invalid_button(
         update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Informs the user that the button is no longer available."""
+    """
+    Informs the user that the button is no longer available.
+
+    Used for buttons that can't be decoded (e.g. sent by an older version
+    of the bot) or point to a shop that is not available.
+    """
     user = update.callback_query.from_user
+    metrics.counter("callback_data.invalid").inc()
     await update.callback_query.answer(texts.HANDLE_INVALID_BUTTON_ANS)
     await update.effective_message.edit_text(texts.INVALID_BUTTON)
-    logger.debug(f"User {user.username} {user.id} "
-                 f"has clicked on invalid button.")
+    logger.info(f"User {user.username} {user.id} has clicked on invalid "
+                f"button: {update.callback_query.data}")
 
 
 async def unexpected_callback(
@@ -83,6 +83,14 @@ async def check_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
         texts.PASSWORD_RECEIVED.format(password=password),
     )
     username = chat_service.get_admin_username()
+    if chat_service.is_admin_login_throttled(username):
+        logger.info(f"User {user.username} {chat_id} "
+                    f"has too many failed attempts with {username=}")
+        await update.message.reply_text(
+            text=texts.TOO_MANY_LOGIN_ATTEMPTS,
+            reply_markup=inline_keyboards.build_cancel(),
+        )
+        return None
     authenticated = await chat_service.authenticate_admin(
         username=username,
         password=password,
@@ -6,7 +6,7 @@ from telegram.ext import ContextTypes, ConversationHandler
 from django.conf import settings
 
 from tg_bot import texts
-from tg_bot.services import TelegramUserService
+from tg_bot.services import TelegramUserLoader, TelegramUserService
 from tg_bot.handlers.command_handlers import start
 
 logger = logging.getLogger(__name__)
@@ -66,5 +66,7 @@ async def successful_payment_callback(
     """Confirms the successful payment."""
     logger.info(f"{update.effective_chat.id} precheckout_callback payment.")
     await TelegramUserService().activate(update.effective_user.id)
+    TelegramUserLoader.from_context(context).invalidate(
+        update.effective_chat.id)
     await update.message.reply_text(texts.PAYMENT_SUCCESS)
     return await start(update, context)
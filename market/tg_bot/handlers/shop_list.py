@@ -9,7 +9,7 @@ from tg_bot.conversation_states import States
 from tg_bot.keyboards import inline_keyboards
 from tg_bot.services import ChatService
 from tg_bot.data_classes import Navigation
-from tg_bot import texts
+from tg_bot import callback_data, texts
 
 logger = logging.getLogger(__name__)
 
@@ -31,17 +31,17 @@ async def display_shop_list(update: Update,
     logger.debug(f"User {user.username} {chat_id=} is opening "
                  f"`shop_list with {query.data=}")
 
-    limit = LIST_LIMIT
-    offset = 0
-    if isinstance(query.data, Navigation):
-        limit = query.data.limit
-        offset = query.data.offset
+    navigation = Navigation(limit=LIST_LIMIT)
+    data = callback_data.decode(query.data)
+    if isinstance(data, Navigation):
+        navigation = data
     await query.answer(text=texts.DISPLAY_SHOP_LIST_ANS)
     shop_qs = await chat_service.get_shops()
     keyboard = await inline_keyboards.build_shop_list(
         qs=shop_qs,
-        limit=limit,
-        offset=offset,
+        total_count=await chat_service.get_shops_count(),
+        navigation=navigation,
+        scope=await chat_service.get_shops_scope(),
     )
     await query.edit_message_text(
         text=texts.DISPLAY_SHOP_LIST,
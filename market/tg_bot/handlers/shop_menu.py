@@ -3,13 +3,14 @@ import logging
 from telegram import Update
 from telegram.ext import ContextTypes
 
+from shop.models import Shop
 from shop.services import ShopService
 from tg_bot.conversation_states import States
 from tg_bot.keyboards import inline_keyboards
 from tg_bot.services import ChatService
 from tg_bot.data_classes import ShopInfo
-from tg_bot import texts, utils
-from tg_bot.handlers import prohibitions
+from tg_bot import callback_data, texts, utils
+from tg_bot.handlers import invalid_button, prohibitions
 
 logger = logging.getLogger(__name__)
 
@@ -28,9 +29,18 @@ async def display_shop_menu(update: Update,
                  f"`shop_menu with {query.data=}")
 
     chat_service = ChatService(chat_id, context)
-    if isinstance(query.data, ShopInfo):
+    data = callback_data.decode(query.data)
+    if isinstance(data, ShopInfo):
         # callback from shop list, using `shop` button
-        shop_info = query.data
+        if not await chat_service.is_shop_available(data.id):
+            logger.warning(f"User {user.username} {chat_id=} tried to open "
+                           f"not available shop {data.id}")
+            return await invalid_button.handle_invalid_button(update, context)
+        try:
+            shop_info = await ShopService().get_shop_info_by_id(data.id)
+        except Shop.DoesNotExist:
+            # button of a deleted shop
+            return await invalid_button.handle_invalid_button(update, context)
         chat_service.set_shop_info(shop_info)
     else:
         # callback from shop submenu using `back` button
@@ -93,13 +103,17 @@ async def activate_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     shop_info = chat_service.get_shop_info()
     # to refresh data about shop
     new_shop_info = await shop_service.get_shop_info_by_id(shop_info.id)
+    return await _display_activation(query, new_shop_info)
+
+
+async def _display_activation(query, shop_info: ShopInfo):
     await query.edit_message_text(
         text=texts.ACTIVATE_SHOP.format(
-            name=new_shop_info.name,
-            is_active=utils.readable_shop_activiti(new_shop_info.is_active)
+            name=shop_info.name,
+            is_active=utils.readable_shop_activiti(shop_info.is_active)
         ),
         reply_markup=inline_keyboards.build_activate_shop(
-            new_shop_info.is_active),
+            shop_info.is_active),
         parse_mode="html",
     )
     return States.ACTIVATE
@@ -126,8 +140,8 @@ async def switch_activation(update: Update,
     shop_info = chat_service.get_shop_info()
     logger.info(f"User {user.username} {chat_id=} "
                 f"is switching activations of {shop_info}")
-    await shop_service.switch_activation(shop_info.id)
-    return await activate_shop(update, context)
+    new_shop_info = await shop_service.switch_activation(shop_info.id)
+    return await _display_activation(query, new_shop_info)
 
 
 async def price_updating(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -139,6 +153,10 @@ async def price_updating(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_service = ChatService(chat_id, context)
     shop_info = chat_service.get_shop_info()
     shop_info = await shop_service.get_shop_info_by_id(shop_info.id)
+    return await _display_price_updating(query, shop_info)
+
+
+async def _display_price_updating(query, shop_info: ShopInfo):
     is_updating_on = not shop_info.update_prices
     await query.edit_message_text(
         text=texts.PRICE_UPDATING.format(
@@ -173,5 +191,5 @@ async def switch_price_updating(update: Update,
     shop_info = chat_service.get_shop_info()
     logger.info(f"User {user.username} {chat_id=} "
                 f"is switching price_updating of {shop_info}")
-    await shop_service.switch_price_updating(shop_info.id)
-    return await price_updating(update, context)
+    new_shop_info = await shop_service.switch_price_updating(shop_info.id)
+    return await _display_price_updating(query, new_shop_info)
@@ -7,10 +7,12 @@ from django.conf import settings
 
 from tg_bot.conversation_states import States
 from tg_bot.keyboards import inline_keyboards
-from tg_bot.services import ChatService, TelegramUserService
+from tg_bot.services import ChatService
 from tg_bot.data_classes import Navigation, ShopInfo
-from tg_bot import texts
-from tg_bot.handlers import prohibitions
+from shop.models import Shop
+from shop.services import ShopService
+from tg_bot import callback_data, texts
+from tg_bot.handlers import invalid_button, prohibitions
 
 logger = logging.getLogger(__name__)
 
@@ -33,17 +35,17 @@ async def display_unlink_shop(
         f" {query.data=}.")
     chat_service = ChatService(chat_id, context)
 
-    limit = LIST_LIMIT
-    offset = 0
-    if isinstance(query.data, Navigation):
-        limit = query.data.limit
-        offset = query.data.offset
+    navigation = Navigation(limit=LIST_LIMIT)
+    data = callback_data.decode(query.data)
+    if isinstance(data, Navigation):
+        navigation = data
     await query.answer(text=texts.DISPLAY_UNLINK_SHOP_ANS)
     shop_qs = await chat_service.get_shops()
     keyboard = await inline_keyboards.build_shop_list(
         qs=shop_qs,
-        limit=limit,
-        offset=offset,
+        total_count=await chat_service.get_shops_count(),
+        navigation=navigation,
+        scope=await chat_service.get_shops_scope(),
     )
     await query.edit_message_text(
         text=texts.DISPLAY_UNLINK_SHOP,
@@ -63,10 +65,19 @@ async def confirm_unlink_shop(
     query = update.callback_query
     chat_id = query.from_user.id
     chat_service = ChatService(chat_id, context)
-    if not isinstance(query.data, ShopInfo):
+    data = callback_data.decode(query.data)
+    if not isinstance(data, ShopInfo):
         logger.error(f"{chat_id=} Wrong callback data: {query.data}")
         raise ValueError(f"Wrong callback data: {query.data=}")
-    shop_info = query.data
+    if not await chat_service.is_shop_available(data.id):
+        logger.warning(f"{chat_id=} tried to unlink not available "
+                       f"shop {data.id}")
+        return await invalid_button.handle_invalid_button(update, context)
+    try:
+        shop_info = await ShopService().get_shop_info_by_id(data.id)
+    except Shop.DoesNotExist:
+        # button of a deleted shop
+        return await invalid_button.handle_invalid_button(update, context)
     chat_service.set_shop_info_to_unlink(shop_info)
     await query.answer(
         text=texts.CONFIRM_UNLINK_SHOP_ANS.format(name=shop_info.name))
@@ -99,9 +110,7 @@ async def unlink_shop(
         return await prohibitions.display_not_active(update, context)
 
     shop_to_unlink = chat_service.get_shop_info_to_unlink()
-    tg_user_service = TelegramUserService()
-    await tg_user_service.unlink_shop_by_chat_id(
-        chat_id=chat_id, shop_id=shop_to_unlink.id)
+    await chat_service.unlink_shop(shop_to_unlink.id)
     await query.answer(
         text=texts.UNLINK_SHOP_ANS.format(name=shop_to_unlink.name),
         show_alert=True,
@@ -2,6 +2,7 @@
 import logging
 
 from math import ceil
+from typing import Optional
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
@@ -9,7 +10,7 @@ from django.conf import settings
 from django.db.models import QuerySet
 
 from tg_bot.data_classes import ShopInfo, Navigation
-from tg_bot import utils
+from tg_bot import callback_data as cb_data, utils
 from shop.services import ShopService
 from shop.models import Shop
 
@@ -109,40 +110,62 @@ def build_seller_menu():
 
 async def build_shop_list(
         qs: QuerySet[Shop],
-        limit: int = LIST_LIMIT,
-        offset: int = 0,
+        total_count: int,
+        navigation: Optional[Navigation] = None,
         with_back: bool = True,
+        scope: Optional[tuple] = None,
 ):
     """
     Build keyboard, that contains shop list.
 
     It uses pagination.
     :param qs: QuerySet of Shops, that need to be paginated.
-    :param limit: maximum items per page.
-    :param offset: index of start item.
+    :param total_count: number of Shops in qs (for page counter).
+    :param navigation: page to display, first page if None.
     :param with_back: whether display back button.
+    :param scope: key of qs for caching pages, the next page is prefetched.
     :return: keyboard with navigation buttons.
     """
+    if navigation is None:
+        navigation = Navigation(limit=LIST_LIMIT)
     shop_service = ShopService()
     shops: list[ShopInfo] = await shop_service.paginate_shops_for_buttons(
         qs=qs,
-        limit=limit,
-        offset=offset,
+        limit=navigation.limit,
+        after=navigation.after,
+        before=navigation.before,
+        scope=scope,
     )
+    if navigation.after is not None and not shops:
+        # the end of the list (shops were deleted), show the last page
+        navigation = Navigation(
+            limit=navigation.limit,
+            page=max(1, navigation.page - 1),
+            before=navigation.after + 1,
+        )
+        shops = await shop_service.paginate_shops_for_buttons(
+            qs=qs, limit=navigation.limit, before=navigation.before,
+            scope=scope)
+    if navigation.before is not None and len(shops) < navigation.limit:
+        # the beginning of the list, show the full first page
+        navigation = Navigation(limit=navigation.limit)
+        shops = await shop_service.paginate_shops_for_buttons(
+            qs=qs, limit=navigation.limit, scope=scope)
+    if scope is not None:
+        shop_service.prefetch_next_page(qs, shops, navigation.limit, scope)
     keyboard = []
     for shop in shops:
         keyboard.append(
             [InlineKeyboardButton(
                 f"{shop.name} {utils.readable_shop_activiti(shop.is_active)}",
-                callback_data=shop,
+                callback_data=cb_data.encode_shop_info(shop),
             )]
         )
     keyboard.append(
         _build_navigation_buttons(
-            limit=limit,
-            offset=offset,
-            displayed_count=len(shops),
-            total_count=await qs.acount(),
+            navigation=navigation,
+            shops=shops,
+            total_count=total_count,
         )
     )
     if with_back:
@@ -206,33 +229,40 @@ def build_price_updating(is_updating_on: bool):
 
 
 def _build_navigation_buttons(
-        limit: int, offset: int, displayed_count: int, total_count: int):
+        navigation: Navigation, shops: list[ShopInfo], total_count: int):
     """
     Creates navigation buttons to adding to keyboards as a line.
 
     Displays: `back`, `page counter`, `next`.
-    :param limit: maximum items per page.
-    :param offset: index of start item.
-    :param displayed_count: how many items in the current page.
+    `back` and `next` buttons contain cursors: ids of the first
+    and the last displayed items.
+    :param navigation: the current page.
+    :param shops: items of the current page.
     :param total_count: total amount of items.
     :return: buttons for keyboard.
     """
-    if offset > 0:
-        nav_back = Navigation(limit=limit, offset=max(0, (offset - limit)))
+    limit = navigation.limit
+    if navigation.page > 1 and shops:
+        nav_back = Navigation(
+            limit=limit, page=navigation.page - 1, before=shops[0].id)
     else:
-        nav_back = Navigation(limit=limit, offset=0)
-    if displayed_count < limit:
-        nav_forward = Navigation(limit=limit, offset=offset)
+        nav_back = Navigation(limit=limit)
+    if len(shops) < limit:
+        nav_forward = navigation
     else:
-        nav_forward = Navigation(limit=limit, offset=(offset + limit))
+        nav_forward = Navigation(
+            limit=limit, page=navigation.page + 1, after=shops[-1].id)
+    pages_count = max(1, ceil(total_count / limit))
 
     buttons = [
-        InlineKeyboardButton("<<", callback_data=nav_back),
         InlineKeyboardButton(
-            f"{offset // limit + 1} / {ceil(total_count / limit)}",
+            "<<", callback_data=cb_data.encode_navigation(nav_back)),
+        InlineKeyboardButton(
+            f"{min(navigation.page, pages_count)} / {pages_count}",
             callback_data=DO_NOTHING
         ),
-        InlineKeyboardButton(">>", callback_data=nav_forward),
+        InlineKeyboardButton(
+            ">>", callback_data=cb_data.encode_navigation(nav_forward)),
     ]
     return buttons
 
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from tg_bot import bot
 
@@ -5,5 +6,21 @@ from tg_bot import bot
 class Command(BaseCommand):
     help = "Run telegram bot."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--mode",
+            choices=bot.MODES,
+            default=settings.TG_BOT_MODE,
+            help="How to receive updates (default: TG_BOT_MODE setting).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.TG_BOT_WORKERS,
+            help="Number of worker processes sharded by chat_id, "
+                 "0 to handle updates in one process "
+                 "(default: TG_BOT_WORKERS setting).",
+        )
+
     def handle(self, *args, **options):
-        bot.run()
+        bot.run(mode=options["mode"], workers=options["workers"])
@@ -0,0 +1,135 @@
+"""
+In-process metrics: counters, gauges and timers.
+
+Metrics are created on first use by name, e.g.
+```
+metrics.counter("login.throttled").inc()
+with metrics.timer("password_check.hash_time").time():
+    ...
+```
+Values are written to the log periodically (`TG_METRICS_LOG_INTERVAL`).
+"""
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+
+class Counter:
+    """Monotonic counter."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        with _lock:
+            self.value += amount
+
+    def snapshot(self) -> int:
+        return self.value
+
+
+class Gauge:
+    """Current value (e.g. queue depth) and its maximum."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.value = 0
+        self.max = 0
+
+    def inc(self, amount: int = 1):
+        with _lock:
+            self.value += amount
+            self.max = max(self.max, self.value)
+
+    def dec(self, amount: int = 1):
+        with _lock:
+            self.value -= amount
+
+    def snapshot(self) -> dict:
+        return {"value": self.value, "max": self.max}
+
+
+class Timer:
+    """Count, total and maximum of observed durations (seconds)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        with _lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    @contextmanager
+    def time(self):
+        """Observe duration of the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.mean * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+_registry: dict[str, Union[Counter, Gauge, Timer]] = {}
+
+
+def _get_or_create(name: str, metric_class):
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class(name)
+    if not isinstance(metric, metric_class):
+        raise TypeError(f"Metric {name} is {type(metric).__name__}")
+    return metric
+
+
+def counter(name: str) -> Counter:
+    """Get or create counter."""
+    return _get_or_create(name, Counter)
+
+
+def gauge(name: str) -> Gauge:
+    """Get or create gauge."""
+    return _get_or_create(name, Gauge)
+
+
+def timer(name: str) -> Timer:
+    """Get or create timer."""
+    return _get_or_create(name, Timer)
+
+
+def snapshot() -> dict:
+    """Current values of all metrics."""
+    with _lock:
+        metrics = list(_registry.values())
+    return {metric.name: metric.snapshot() for metric in metrics}
+
+
+async def log_periodically(interval: float):
+    """Write all metrics to the log every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f"Metrics: {snapshot()}")
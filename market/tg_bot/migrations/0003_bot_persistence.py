@@ -0,0 +1,44 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tg_bot', '0002_alter_telegramuser_is_logged_out'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotChatData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField(unique=True)),
+                ('data', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'bot chat data',
+                'verbose_name_plural': 'bot chat data',
+            },
+        ),
+        migrations.CreateModel(
+            name='BotConversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('key', models.CharField(max_length=255)),
+                ('state', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'bot conversation',
+                'verbose_name_plural': 'bot conversations',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='botconversation',
+            constraint=models.UniqueConstraint(fields=('name', 'key'), name='unique_conversation_key'),
+        ),
+    ]
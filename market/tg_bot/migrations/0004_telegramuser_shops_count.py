@@ -0,0 +1,28 @@
+# Generated by Django 4.2.5 on 2026-10-18 09:27
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_linked_shops(apps, schema_editor):
+    TelegramUser = apps.get_model('tg_bot', 'TelegramUser')
+    counted = TelegramUser.objects.annotate(linked=Count('shops'))
+    for tg_user in counted.filter(linked__gt=0):
+        TelegramUser.objects.filter(pk=tg_user.pk) \
+            .update(shops_count=tg_user.linked)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tg_bot', '0003_bot_persistence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='telegramuser',
+            name='shops_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_linked_shops, migrations.RunPython.noop),
+    ]
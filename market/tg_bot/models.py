@@ -19,7 +19,73 @@ class TelegramUser(models.Model):
     username = models.CharField(max_length=255, blank=True)
     role = models.CharField(max_length=2, choices=Roles.choices)
     shops = models.ManyToManyField(Shop, blank=True)
+    # maintained by signals (see tg_bot.signals)
+    shops_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     is_banned = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)  # for subscription
     is_logged_out = models.BooleanField(default=False)  # for refreshing data
+
+    # fields that are written only when `update_fields` names them
+    COUNTER_FIELDS = ("shops_count",)
+
+    def save(self, *args, **kwargs):
+        """
+        Save the user, counters are not written by a full save of an
+        existing row (e.g. in the admin site), so the loaded value can't
+        overwrite concurrent F() updates of the signals.
+        """
+        if (kwargs.get('update_fields') is None
+                and not kwargs.get('force_insert')
+                and not self._state.adding):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+
+class BotChatData(models.Model):
+    """Pickled `context.chat_data` of a chat (see tg_bot.persistence)."""
+    class Meta:
+        verbose_name = _("bot chat data")
+        verbose_name_plural = _("bot chat data")
+
+    chat_id = models.BigIntegerField(unique=True)
+    data = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class BotConversation(models.Model):
+    """Pickled state of ConversationHandler conversation."""
+    class Meta:
+        verbose_name = _("bot conversation")
+        verbose_name_plural = _("bot conversations")
+        constraints = [
+            models.UniqueConstraint(fields=["name", "key"],
+                                    name="unique_conversation_key"),
+        ]
+
+    name = models.CharField(max_length=255)
+    key = models.CharField(max_length=255)  # json list
+    state = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class CacheVersion(models.Model):
+    """
+    Version of cached data, incremented by signals on every change.
+
+    Changes made by other processes (e.g. a ban in the admin site) don't
+    reach caches of the bot by signals, so bot processes poll the version
+    and clear the cache when it changes (see tg_bot.services).
+    """
+    TG_USER_STATUSES = "tg_user_statuses"
+
+    class Meta:
+        verbose_name = _("cache version")
+        verbose_name_plural = _("cache versions")
+
+    name = models.CharField(max_length=50, unique=True)
+    value = models.BigIntegerField(default=0)
@@ -0,0 +1,230 @@
+"""
+PTB persistence that keeps `chat_data` and conversations in the database.
+
+Only `chat_data` (role, expected input, chosen shop, etc.) and states of
+persistent ConversationHandlers are stored.
+"""
+import asyncio
+import json
+import logging
+import pickle
+from typing import Optional
+
+from django.db import transaction
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext._utils.types import ConversationDict, ConversationKey
+
+from tg_bot import db_executor
+from tg_bot.models import BotChatData, BotConversation
+
+logger = logging.getLogger(__name__)
+
+
+class DjangoPersistence(BasePersistence):
+    """
+    Persistence based on `BotChatData` and `BotConversation` models.
+
+    Changed entries are kept in memory as dirty and written in batches,
+    one transaction per batch. Application passes changes to the
+    persistence every `update_interval` seconds, the batch is written right
+    after that (and on shutdown).
+
+    `chat_data` is loaded lazily: a chat is read from the database before
+    the first update from this chat is processed.
+    Conversations are read at startup, because ConversationHandler
+    requires all of them at once, ended conversations are deleted from
+    the table, so it contains only active ones.
+    """
+
+    def __init__(self, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False,
+                chat_data=True,
+                user_data=False,
+                callback_data=False,
+            ),
+            update_interval=update_interval,
+        )
+        self._loaded_chat_ids: set[int] = set()
+        # None means that the entry must be deleted
+        self._dirty_chat_data: dict[int, Optional[dict]] = {}
+        self._dirty_conversations: dict[tuple[str, str], object] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        """Chats are loaded lazily in `refresh_chat_data`."""
+        return {}
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        """Load chat_data from db before the first update from the chat."""
+        if chat_id in self._loaded_chat_ids:
+            return
+        self._loaded_chat_ids.add(chat_id)
+        stored = await self._load_chat_data(chat_id)
+        if stored:
+            # values set in memory before loading are newer
+            for key, value in stored.items():
+                chat_data.setdefault(key, value)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._loaded_chat_ids.add(chat_id)
+        self._dirty_chat_data[chat_id] = data
+        self._schedule_flush()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._loaded_chat_ids.discard(chat_id)
+        self._dirty_chat_data[chat_id] = None
+        self._schedule_flush()
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        return await self._load_conversations(name)
+
+    async def update_conversation(
+            self,
+            name: str,
+            key: ConversationKey,
+            new_state: Optional[object],
+    ) -> None:
+        self._dirty_conversations[(name, json.dumps(key))] = new_state
+        self._schedule_flush()
+
+    async def flush(self) -> None:
+        """Write all dirty entries (called on shutdown)."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_dirty()
+
+    def _schedule_flush(self):
+        """
+        Start writing task, if it is not running.
+
+        Application gathers all `update_*` coroutines at once, the task
+        starts after all of them, so the changes are written in one batch.
+        """
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_dirty())
+
+    async def _flush_dirty(self):
+        with db_executor.priority(db_executor.BACKGROUND):
+            await self._flush_dirty_batches()
+
+    async def _flush_dirty_batches(self):
+        while self._dirty_chat_data or self._dirty_conversations:
+            chat_data = self._dirty_chat_data
+            conversations = self._dirty_conversations
+            self._dirty_chat_data = {}
+            self._dirty_conversations = {}
+            try:
+                # handlers change chat_data on the loop, so it is pickled
+                # here, not in the executor thread
+                await self._write_batch(
+                    self._dump_values(chat_data),
+                    self._dump_values(conversations),
+                )
+            except Exception as e:
+                logger.error(f"Can't write persistence batch: {e!r}. "
+                             f"Will retry on next flush.")
+                # newer changes have priority
+                chat_data.update(self._dirty_chat_data)
+                conversations.update(self._dirty_conversations)
+                self._dirty_chat_data = chat_data
+                self._dirty_conversations = conversations
+                return
+            logger.debug(f"Persistence batch is written: "
+                         f"{len(chat_data)} chats, "
+                         f"{len(conversations)} conversations.")
+
+    @staticmethod
+    def _dump_values(entries: dict) -> dict[object, Optional[bytes]]:
+        """Pickle values of dirty entries, None (deletion) is kept."""
+        return {
+            key: None if value is None else pickle.dumps(value)
+            for key, value in entries.items()
+        }
+
+    @staticmethod
+    @db_executor.database_sync_to_async
+    def _write_batch(chat_data: dict[int, Optional[bytes]],
+                     conversations: dict[tuple[str, str], Optional[bytes]]):
+        """Write pickled changes in one transaction."""
+        to_delete = [chat_id for chat_id, data in chat_data.items()
+                     if data is None]
+        to_save = [
+            BotChatData(chat_id=chat_id, data=data)
+            for chat_id, data in chat_data.items() if data is not None
+        ]
+        conversations_to_save = [
+            BotConversation(name=name, key=key, state=state)
+            for (name, key), state in conversations.items()
+            if state is not None
+        ]
+        with transaction.atomic():
+            if to_delete:
+                BotChatData.objects.filter(chat_id__in=to_delete).delete()
+            if to_save:
+                BotChatData.objects.bulk_create(
+                    to_save,
+                    update_conflicts=True,
+                    unique_fields=["chat_id"],
+                    update_fields=["data", "updated_at"],
+                )
+            for (name, key), state in conversations.items():
+                if state is None:
+                    BotConversation.objects \
+                        .filter(name=name, key=key).delete()
+            if conversations_to_save:
+                BotConversation.objects.bulk_create(
+                    conversations_to_save,
+                    update_conflicts=True,
+                    unique_fields=["name", "key"],
+                    update_fields=["state", "updated_at"],
+                )
+
+    @staticmethod
+    async def _load_chat_data(chat_id: int) -> Optional[dict]:
+        try:
+            stored = await db_executor.run(
+                BotChatData.objects.get, chat_id=chat_id)
+        except BotChatData.DoesNotExist:
+            return None
+        return pickle.loads(stored.data)
+
+    @staticmethod
+    async def _load_conversations(name: str) -> ConversationDict:
+        conversations = {}
+        stored = await db_executor.run(
+            list, BotConversation.objects.filter(name=name))
+        for conversation in stored:
+            key = tuple(json.loads(conversation.key))
+            conversations[key] = pickle.loads(conversation.state)
+        return conversations
+
+    # not stored data
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
@@ -3,7 +3,7 @@ import platform
 import signal
 import logging
 
-from collections.abc import Coroutine, Iterable
+from collections.abc import Callable, Coroutine, Iterable
 from typing import Optional
 
 from telegram.ext import Application
@@ -52,6 +52,80 @@ def run_polling(
         # if there is an error in fetching updates
     )
 
+    _run(application,
+         updater_coroutine=updater_coroutine,
+         side_coroutines=side_coroutines,
+         close_loop=close_loop,
+         stop_signals=stop_signals)
+
+
+def run_webhook(
+        application: Application,
+        side_coroutines: Optional[Iterable[Coroutine]] = None,
+        listen: str = "127.0.0.1",
+        port: int = 80,
+        url_path: str = "",
+        webhook_url: Optional[str] = None,
+        secret_token: Optional[str] = None,
+        register_webhook: bool = True,
+        bootstrap_retries: int = 0,
+        allowed_updates=None,
+        drop_pending_updates=None,
+        max_connections: int = 40,
+        close_loop: bool = True,
+        stop_signals=DEFAULT_NONE,
+) -> None:
+    """
+    Run application receiving updates over HTTP instead of long polling.
+
+    Works like `run_polling`, but starts a small tornado server that puts
+    every received update into `application.update_queue`.
+    If `register_webhook` is False, the server is started without calling
+    `set_webhook`, so it can be tested locally by POSTing recorded
+    updates to `http://listen:port/url_path` (with the
+    `X-Telegram-Bot-Api-Secret-Token` header if `secret_token` is set).
+    """
+    if register_webhook:
+        updater_coroutine = application.updater.start_webhook(
+            listen=listen,
+            port=port,
+            url_path=url_path,
+            webhook_url=webhook_url,
+            secret_token=secret_token,
+            bootstrap_retries=bootstrap_retries,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=drop_pending_updates,
+            max_connections=max_connections,
+        )
+        on_stop = None
+    else:
+        # tornado is only required in webhook mode
+        from tg_bot.webhook import WebhookServer
+
+        if not url_path.startswith("/"):
+            url_path = f"/{url_path}"
+        server = WebhookServer(listen, port, url_path, application.bot,
+                               application.update_queue, secret_token)
+        updater_coroutine = server.serve()
+        on_stop = server.shutdown
+        logger.info(f"Local webhook server: http://{listen}:{port}{url_path}")
+
+    _run(application,
+         updater_coroutine=updater_coroutine,
+         side_coroutines=side_coroutines,
+         close_loop=close_loop,
+         stop_signals=stop_signals,
+         on_stop=on_stop)
+
+
+def _run(
+        application: Application,
+        updater_coroutine: Coroutine,
+        side_coroutines: Optional[Iterable[Coroutine]],
+        close_loop: bool,
+        stop_signals,
+        on_stop: Optional[Callable[[], Coroutine]] = None,
+) -> None:
     # Calling get_event_loop() should still be okay even in py3.10+ as long as there is a
     # running event loop or we are in the main thread, which are the intended use cases.
     # See the docs of get_event_loop() and get_running_loop() for more info
@@ -104,6 +178,8 @@ def run_polling(
             if application.updater.running:  # type: ignore[union-attr]
                 loop.run_until_complete(
                     application.updater.stop())  # type: ignore[union-attr]
+            if on_stop is not None:
+                loop.run_until_complete(on_stop())
             if application.running:
                 loop.run_until_complete(application.stop())
             if application.post_stop:
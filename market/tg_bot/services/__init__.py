@@ -1,4 +1,5 @@
 from .chat_services import ChatService
 from .chat_services import ExpectedInput
+from .telegram_user_service import TelegramUserLoader
 from .telegram_user_service import TelegramUserService
 from .user_services import UserService
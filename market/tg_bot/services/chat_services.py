@@ -16,10 +16,14 @@ from django.db.models import QuerySet
 
 from shop.services import ShopService
 from shop.models import Shop
-from tg_bot.services.telegram_user_service import TelegramUserService
+from tg_bot import db_executor
+from tg_bot.services.telegram_user_service import (
+    TelegramUserLoader,
+    TelegramUserService,
+)
 from tg_bot.services.user_services import UserService
 from tg_bot.models import TelegramUser
-from tg_bot.data_classes import ShopInfo
+from tg_bot.data_classes import ShopInfo, TelegramUserInfo
 
 UserModel = get_user_model()
 
@@ -58,6 +62,11 @@ class ChatService:
     def __init__(self, chat_id: int, context: ContextTypes.DEFAULT_TYPE):
         self.context = context
         self.chat_id = chat_id
+        self.tg_user_loader = TelegramUserLoader.from_context(context)
+
+    async def get_tg_user_info(self) -> Optional[TelegramUserInfo]:
+        """Get TgUser data, it is queried once per update."""
+        return await self.tg_user_loader.get(self.chat_id)
 
     async def get_role(self):
         """Get role from chat_data or from db."""
@@ -65,11 +74,10 @@ class ChatService:
         if cached_role:
             return cached_role
         else:
-            tg_user_service = TelegramUserService()
-            tg_user = await tg_user_service.get_by_chat_id(self.chat_id)
-            if tg_user is None:
+            statuses = await self._get_statuses_with_role()
+            if statuses is None:
                 return None
-            role = tg_user.role
+            *_, role = statuses
             if role == TelegramUser.Roles.ADMIN:
                 self.set_admin_role()
             elif role == TelegramUser.Roles.SELLER:
@@ -114,14 +122,59 @@ class ChatService:
         """Get available Shops depending on TgUser.role."""
         role = await self.get_role()
         if role == self.SELLER_ROLE:
-            shops = await TelegramUserService().get_related_shops_by_chat_id(
-                self.chat_id)
+            tg_user = await self.get_tg_user_info()
+            shops = Shop.objects.filter(id__in=tg_user.shop_ids)
         elif role == self.ADMIN_ROLE:
             shops = Shop.objects.all()
         else:
             raise ValueError(f"Wrong {role=}")
         return shops
 
+    async def is_shop_available(self, shop_id: int) -> bool:
+        """
+        Check that the Shop is returned by `get_shops`.
+
+        Ids in callback data are sent by the client and can be forged.
+        """
+        role = await self.get_role()
+        if role == self.ADMIN_ROLE:
+            return True
+        tg_user = await self.get_tg_user_info()
+        return tg_user is not None and shop_id in tg_user.shop_ids
+
+    async def get_shops_scope(self) -> tuple:
+        """
+        Get key that identifies Shops returned by `get_shops`.
+
+        Used as a scope of cached shop list pages, for sellers it contains
+        linked shops, so linking or unlinking a shop changes the scope.
+        """
+        role = await self.get_role()
+        if role == self.SELLER_ROLE:
+            tg_user = await self.get_tg_user_info()
+            scope = ("seller", self.chat_id, tuple(tg_user.shop_ids))
+        elif role == self.ADMIN_ROLE:
+            scope = ("all",)
+        else:
+            raise ValueError(f"Wrong {role=}")
+        return scope
+
+    async def get_shops_count(self) -> int:
+        """
+        Get number of available Shops depending on TgUser.role.
+
+        It is taken from counters, not counted by the query.
+        """
+        role = await self.get_role()
+        if role == self.SELLER_ROLE:
+            tg_user = await self.get_tg_user_info()
+            shops_count = tg_user.shops_count
+        elif role == self.ADMIN_ROLE:
+            shops_count = await ShopService().get_total_count()
+        else:
+            raise ValueError(f"Wrong {role=}")
+        return shops_count
+
     async def get_statuses(self) -> tuple:
         """
         Get all TgUser statuses at once.
@@ -130,19 +183,27 @@ class ChatService:
         :return: is_banned: Optional[bool], is_activate: Optional[bool],
         is_logged_out: Optional[bool].
         """
-        tg_user_service = TelegramUserService()
-        tg_user = await tg_user_service.get_by_chat_id(self.chat_id)
-
-        is_banned = None
-        is_active = None
-        is_logged_out = None
+        statuses = await self._get_statuses_with_role()
+        if statuses is None:
+            return None, None, None
+        is_banned, is_active, is_logged_out, _ = statuses
+        return is_banned, is_active, is_logged_out
 
-        if tg_user is not None:
-            is_banned = tg_user.is_banned
-            is_active = tg_user.is_active
-            is_logged_out = tg_user.is_logged_out
+    async def _get_statuses_with_role(self) -> Optional[tuple]:
+        """
+        Get TgUser statuses from the status cache or from db.
 
-        return is_banned, is_active, is_logged_out
+        :return: is_banned, is_active, is_logged_out, role or None
+            if TgUser does not exist.
+        """
+        tg_user_service = TelegramUserService()
+        statuses = tg_user_service.get_cached_statuses(self.chat_id)
+        if statuses is None:
+            tg_user = await self.get_tg_user_info()
+            if tg_user is None:
+                return None
+            statuses = tg_user_service.cache_statuses(tg_user)
+        return statuses
 
     async def authenticate_admin(
             self,
@@ -158,9 +219,13 @@ class ChatService:
         :return: True if authenticated.
         """
         user = await UserService() \
-            .authenticate_telegram_admin(username, password)
+            .authenticate_telegram_admin(username, password, self.chat_id)
         return user is not None
 
+    def is_admin_login_throttled(self, username: str) -> bool:
+        """Check if there are too many failed attempts to log in as admin."""
+        return UserService().is_login_throttled(username, self.chat_id)
+
     async def login_admin(
             self,
             first_name: Optional[str],
@@ -174,7 +239,8 @@ class ChatService:
         last_name = last_name if last_name is not None else ""
         tg_username = tg_username if tg_username is not None else ""
 
-        tg_user, created = await TelegramUser.objects.aupdate_or_create(
+        tg_user, created = await db_executor.run(
+            TelegramUser.objects.update_or_create,
             chat_id=self.chat_id,
             defaults=dict(
                 first_name=first_name,
@@ -184,6 +250,7 @@ class ChatService:
                 is_logged_out=False,
             )
         )
+        self.tg_user_loader.invalidate(self.chat_id)
         self.set_admin_role()
 
     async def authenticate_and_login_seller(
@@ -206,7 +273,8 @@ class ChatService:
             last_name = last_name if last_name is not None else ""
             tg_username = tg_username if tg_username is not None else ""
 
-            tg_user, created = await TelegramUser.objects.aupdate_or_create(
+            tg_user, created = await db_executor.run(
+                TelegramUser.objects.update_or_create,
                 chat_id=self.chat_id,
                 defaults=dict(
                     first_name=first_name,
@@ -216,7 +284,8 @@ class ChatService:
                     is_logged_out=False,
                 )
             )
-            await tg_user.shops.aadd(shop)
+            await db_executor.run(tg_user.shops.add, shop)
+            self.tg_user_loader.invalidate(self.chat_id)
             self.set_seller_role()
 
             logger.debug(
@@ -233,6 +302,7 @@ class ChatService:
         """
         tg_user_service = TelegramUserService()
         await tg_user_service.mark_as_logged_out_by_chat_id(self.chat_id)
+        self.tg_user_loader.invalidate(self.chat_id)
 
     async def add_shop(self, shop_api_key: str):
         try:
@@ -244,4 +314,13 @@ class ChatService:
             chat_id=self.chat_id,
             shop_id=shop_info.id
         )
+        self.tg_user_loader.invalidate(self.chat_id)
         return shop_info
+
+    async def unlink_shop(self, shop_id: int):
+        """Remove many-to-many relation between TgUser and Shop."""
+        tg_user = await self.get_tg_user_info()
+        if tg_user is None:
+            raise TelegramUser.DoesNotExist
+        await TelegramUserService().unlink_shop(tg_user.id, shop_id)
+        self.tg_user_loader.invalidate(self.chat_id)
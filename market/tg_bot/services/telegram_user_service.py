@@ -1,16 +1,37 @@
+import asyncio
 import logging
+import threading
 from typing import Optional
 
+from cachetools import TTLCache
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import QuerySet
+from django.db.models import F, QuerySet
 
 from shop.models import Shop
-from tg_bot.models import TelegramUser
+from tg_bot import db_executor, metrics
+from tg_bot.data_classes import TelegramUserInfo
+from tg_bot.models import CacheVersion, TelegramUser
 
 UserModel = get_user_model()
 
 logger = logging.getLogger(__name__)
 
+STATUS_CACHE_SIZE = settings.TG_USER_STATUS_CACHE_SIZE
+STATUS_CACHE_TTL = settings.TG_USER_STATUS_CACHE_TTL
+
+# (is_banned, is_active, is_logged_out, role) by chat_id.
+# Least recently used entries are evicted when the cache is full.
+# Entries are invalidated by signals (tg_bot.signals). Changes of TgUser
+# made by another process (e.g. admin site) clear the cache by
+# `watch_statuses_version`, TTL limits the time of stale data otherwise.
+_status_cache = TTLCache(maxsize=STATUS_CACHE_SIZE, ttl=STATUS_CACHE_TTL)
+# Incremented on every invalidation, statuses loaded before it are not
+# put into the cache.
+_status_cache_generation = 0
+# signals are sent from ORM threads
+_status_cache_lock = threading.Lock()
+
 
 class TelegramUserService:
     """Methods related to TelegramUser model."""
@@ -18,39 +39,202 @@ class TelegramUserService:
     async def get_by_chat_id(self, chat_id: int) -> Optional[TelegramUser]:
         """Get TgUser by chat_id or None."""
         try:
-            tg_user = await TelegramUser.objects.aget(chat_id=chat_id)
+            tg_user = await db_executor.run(
+                TelegramUser.objects.get, chat_id=chat_id)
             return tg_user
         except TelegramUser.DoesNotExist:
             return None
 
+    async def get_info_by_chat_id(
+            self, chat_id: int) -> Optional[TelegramUserInfo]:
+        """
+        Get TgUser statuses and ids of linked shops by one query or None.
+        """
+        generation = _status_cache_generation
+        rows = TelegramUser.objects.filter(chat_id=chat_id).values(
+            "id",
+            "chat_id",
+            "role",
+            "is_banned",
+            "is_active",
+            "is_logged_out",
+            "shops_count",
+            "shops__id",
+        )
+        tg_user_info = None
+        # one row per linked shop (or one row with None)
+        for row in await db_executor.run(list, rows):
+            shop_id = row.pop("shops__id")
+            if tg_user_info is None:
+                tg_user_info = TelegramUserInfo(
+                    **row, status_cache_generation=generation)
+            if shop_id is not None:
+                tg_user_info.shop_ids.append(shop_id)
+        return tg_user_info
+
+    def get_cached_statuses(self, chat_id: int) -> Optional[tuple]:
+        """
+        Get statuses from the cache or None.
+
+        :return: is_banned, is_active, is_logged_out, role.
+        """
+        with _status_cache_lock:
+            statuses = _status_cache.get(chat_id)
+        if statuses is None:
+            metrics.counter("tg_user_status_cache.miss").inc()
+        else:
+            metrics.counter("tg_user_status_cache.hit").inc()
+        return statuses
+
+    def cache_statuses(self, tg_user: TelegramUserInfo) -> tuple:
+        """
+        Put statuses of loaded TgUser to the cache and return them.
+
+        They are not cached if the cache was invalidated after loading.
+        """
+        statuses = (
+            tg_user.is_banned,
+            tg_user.is_active,
+            tg_user.is_logged_out,
+            tg_user.role,
+        )
+        with _status_cache_lock:
+            if tg_user.status_cache_generation == _status_cache_generation:
+                _status_cache[tg_user.chat_id] = statuses
+        return statuses
+
+    def invalidate_cached_statuses(self, chat_id: int):
+        """Remove statuses from the cache (e.g. when TgUser is changed)."""
+        global _status_cache_generation
+        with _status_cache_lock:
+            _status_cache_generation += 1
+            _status_cache.pop(chat_id, None)
+
+    def clear_cached_statuses(self):
+        """Remove statuses of all TgUsers from the cache."""
+        global _status_cache_generation
+        with _status_cache_lock:
+            _status_cache_generation += 1
+            _status_cache.clear()
+
+    def increment_statuses_version(self):
+        """
+        Increment the version of TgUser statuses in the database.
+
+        Must be called when TgUser is changed (in the same transaction),
+        so other processes clear their status caches.
+        """
+        updated = CacheVersion.objects \
+            .filter(name=CacheVersion.TG_USER_STATUSES) \
+            .update(value=F("value") + 1)
+        if not updated:
+            CacheVersion.objects.get_or_create(
+                name=CacheVersion.TG_USER_STATUSES)
+
+    async def watch_statuses_version(self, interval: float):
+        """
+        Clear the status cache when TgUser is changed by another process.
+
+        The version is polled every `interval` seconds, so e.g. a ban in
+        the admin site is seen by the bot after `interval` seconds, not
+        after the cache TTL. Run it in every process that handles updates.
+        """
+        version = None
+        while True:
+            try:
+                with db_executor.priority(db_executor.BACKGROUND):
+                    version = await self.check_statuses_version(version)
+            except Exception as e:
+                logger.warning(f"Can't check TgUser statuses version: {e!r}")
+            await asyncio.sleep(interval)
+
+    async def check_statuses_version(
+            self, known_version: Optional[int]) -> Optional[int]:
+        """
+        Clear the status cache if the version of TgUser statuses differs
+        from `known_version`.
+
+        :return: the current version.
+        """
+        version = await db_executor.run(self._get_statuses_version)
+        if version != known_version:
+            self.clear_cached_statuses()
+        return version
+
+    @staticmethod
+    def _get_statuses_version() -> Optional[int]:
+        return CacheVersion.objects \
+            .filter(name=CacheVersion.TG_USER_STATUSES) \
+            .values_list("value", flat=True).first()
+
     async def mark_as_logged_out_by_chat_id(self, chat_id: int):
         """Set is_logged_out=True by chat_id."""
         tg_user = await self.get_by_chat_id(chat_id)
         tg_user.is_logged_out = True
-        await tg_user.asave()
+        # shops_count is changed by F() updates of the m2m signal,
+        # the loaded value must not overwrite it
+        await db_executor.run(tg_user.save, update_fields=["is_logged_out"])
 
     async def get_related_shops_by_chat_id(
             self, chat_id: int) -> QuerySet[Shop]:
-        """Get Shops related to TgUser by chat_id.n"""
-        tg_user = await self.get_by_chat_id(chat_id)
-        return tg_user.shops.all()
+        """Get Shops related to TgUser by chat_id."""
+        return Shop.objects.filter(telegramuser__chat_id=chat_id)
 
     async def add_shop_by_chat_id(self, chat_id: int, shop_id: int):
         """Add many-to-many relation to Shop, using chat_id."""
         tg_user = await self.get_by_chat_id(chat_id)
         if tg_user is None:
             raise TelegramUser.DoesNotExist
-        await tg_user.shops.aadd(shop_id)
+        await db_executor.run(tg_user.shops.add, shop_id)
 
     async def unlink_shop_by_chat_id(self, chat_id: int, shop_id: int):
         """Remove many-to-many relation to Shop, using chat_id."""
         tg_user = await self.get_by_chat_id(chat_id)
         if tg_user is None:
             raise TelegramUser.DoesNotExist
-        await tg_user.shops.aremove(shop_id)
+        await db_executor.run(tg_user.shops.remove, shop_id)
+
+    async def unlink_shop(self, tg_user_id: int, shop_id: int):
+        """Remove many-to-many relation to Shop, using TgUser.pk."""
+        await db_executor.run(
+            TelegramUser(pk=tg_user_id).shops.remove, shop_id)
 
     async def activate(self, chat_id):
         tg_user = await self.get_by_chat_id(chat_id)
         tg_user.is_active = True
-        await tg_user.asave()
+        await db_executor.run(tg_user.save, update_fields=["is_active"])
+
+
+class TelegramUserLoader:
+    """
+    Identity map of TgUser data for one update.
+
+    It is attached to the update context, so all handlers and services
+    that process the same update share one loaded TelegramUserInfo
+    instead of querying TelegramUser again.
+    Must be invalidated after changes of TelegramUser.
+    """
+    CONTEXT_ATTR = "tg_user_loader"
+
+    def __init__(self):
+        self._loaded: dict[int, Optional[TelegramUserInfo]] = {}
+
+    @classmethod
+    def from_context(cls, context) -> "TelegramUserLoader":
+        """Get loader of the current update."""
+        loader = getattr(context, cls.CONTEXT_ATTR, None)
+        if loader is None:
+            loader = cls()
+            setattr(context, cls.CONTEXT_ATTR, loader)
+        return loader
+
+    async def get(self, chat_id: int) -> Optional[TelegramUserInfo]:
+        """Load TgUser info on first call, then return the same object."""
+        if chat_id not in self._loaded:
+            self._loaded[chat_id] = await TelegramUserService() \
+                .get_info_by_chat_id(chat_id)
+        return self._loaded[chat_id]
 
+    def invalidate(self, chat_id: int):
+        """Forget loaded data, so it is queried again on next `get`."""
+        self._loaded.pop(chat_id, None)
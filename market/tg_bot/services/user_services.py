@@ -1,11 +1,35 @@
+import asyncio
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
+from cachetools import TTLCache
+from django.conf import settings
 from django.contrib.auth import get_user_model, models as auth_models
 
+from tg_bot import db_executor, metrics
+
 UserModel = get_user_model()
 
 logger = logging.getLogger(__name__)
 
+PASSWORD_CHECK_WORKERS = settings.TG_PASSWORD_CHECK_WORKERS
+LOGIN_MAX_FAILED_ATTEMPTS = settings.TG_LOGIN_MAX_FAILED_ATTEMPTS
+LOGIN_THROTTLE_SECONDS = settings.TG_LOGIN_THROTTLE_SECONDS
+
+# Password hashing (PBKDF2) takes a lot of CPU time, so it runs in threads
+# (hashlib releases the GIL) instead of blocking the event loop.
+_password_check_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_CHECK_WORKERS,
+    thread_name_prefix="password_check",
+)
+_password_check_semaphore = asyncio.Semaphore(PASSWORD_CHECK_WORKERS)
+
+# failed attempts by chat_id and by username,
+# the counter expires LOGIN_THROTTLE_SECONDS after the last failure
+_failed_logins = TTLCache(maxsize=10_000, ttl=LOGIN_THROTTLE_SECONDS)
+
 
 class UserService:
     """
@@ -21,26 +45,35 @@ class UserService:
             self,
             username: str,
             password: str,
+            chat_id: Optional[int] = None,
     ):
         """
         Check if UserModel with the credentials exists
         and in telegram admin group.
 
+        Failed attempts are counted by chat_id and username, when
+        there are too many of them, the password is not checked at all.
         :param username: Username of UserModel.
         :param password: Password of UserModel.
+        :param chat_id: chat where the attempt comes from.
         :return: UserModel obj. or None.
         """
+        if self.is_login_throttled(username, chat_id):
+            metrics.counter("login.throttled").inc()
+            logger.info(f"Login is throttled: {username=}, {chat_id=}")
+            return None
         try:
-            user = await UserModel.objects.aget(
-                username=username)
+            user = await db_executor.run(
+                UserModel.objects.get, username=username)
         except UserModel.DoesNotExist:
             logger.debug(f"User with {username=} DoesNotExists")
         else:
-            is_admin = await user.groups \
-                .filter(name=self.TG_ADMIN_GROUP_NAME) \
-                .aexists()
-            if user.check_password(password) and user.is_active and is_admin:
+            is_admin = await db_executor.run(
+                user.groups.filter(name=self.TG_ADMIN_GROUP_NAME).exists)
+            is_password_correct = await self._check_password(user, password)
+            if is_password_correct and user.is_active and is_admin:
                 logger.debug(f"User: {username} is authenticated.")
+                self._reset_failed_logins(username, chat_id)
                 return user
             else:
                 logger.debug(
@@ -48,10 +81,55 @@ class UserService:
                     f"is_active={user.is_active}, is in admin group={is_admin}"
                     f" (if both is Thue, then wrong password)"
                 )
+        self._register_failed_login(username, chat_id)
+        metrics.counter("login.failed").inc()
+
+    def is_login_throttled(
+            self, username: Optional[str], chat_id: Optional[int]) -> bool:
+        """Check if there are too many failed attempts recently."""
+        return any(
+            _failed_logins.get(key, 0) >= LOGIN_MAX_FAILED_ATTEMPTS
+            for key in self._failed_login_keys(username, chat_id)
+        )
+
+    def _register_failed_login(
+            self, username: Optional[str], chat_id: Optional[int]):
+        for key in self._failed_login_keys(username, chat_id):
+            _failed_logins[key] = _failed_logins.get(key, 0) + 1
+
+    def _reset_failed_logins(
+            self, username: Optional[str], chat_id: Optional[int]):
+        for key in self._failed_login_keys(username, chat_id):
+            _failed_logins.pop(key, None)
+
+    @staticmethod
+    def _failed_login_keys(
+            username: Optional[str], chat_id: Optional[int]) -> list[tuple]:
+        keys = [("username", username)]
+        if chat_id is not None:
+            keys.append(("chat_id", chat_id))
+        return keys
+
+    async def _check_password(self, user, password: str) -> bool:
+        """
+        Run `user.check_password` in the password check executor.
+
+        Not more than PASSWORD_CHECK_WORKERS checks run at the same time,
+        others wait in the queue.
+        """
+        queued_at = time.perf_counter()
+        async with _password_check_semaphore:
+            metrics.timer("password_check.queue_wait").observe(
+                time.perf_counter() - queued_at)
+            loop = asyncio.get_running_loop()
+            with metrics.timer("password_check.hash_time").time():
+                return await loop.run_in_executor(
+                    _password_check_executor, user.check_password, password)
 
     async def get_or_create_tg_admin_group(self):
         """Get or create group record for telegram admins."""
-        group, created = await auth_models.Group.objects.aget_or_create(
+        group, created = await db_executor.run(
+            auth_models.Group.objects.get_or_create,
             name=self.TG_ADMIN_GROUP_NAME,
         )
         return group, created
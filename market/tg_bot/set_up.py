@@ -5,11 +5,10 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
     PreCheckoutQueryHandler,
-    InvalidCallbackData,
     filters,
 )
 
-from tg_bot import commands
+from tg_bot import callback_data, commands
 from tg_bot.handlers import (
     add_shop,
     auxiliary,
@@ -27,12 +26,13 @@ from tg_bot.handlers import (
 )
 from tg_bot.conversation_states import States
 from tg_bot.keyboards import inline_keyboards as il_keyboards
-from tg_bot.data_classes import ShopInfo, Navigation
 
 
 def register_handlers(application: Application):
     # Main ConversationHandler allows only CallbackQueryHandler to use.
     main_conv = ConversationHandler(
+        name="main_conv",
+        persistent=True,
         per_message=True,
         allow_reentry=True,
         entry_points=[
@@ -58,9 +58,9 @@ def register_handlers(application: Application):
             ],
             States.UNLINK_SHOP: [
                 CallbackQueryHandler(unlink_shop.confirm_unlink_shop,
-                                     pattern=ShopInfo),
+                                     pattern=callback_data.SHOP_INFO_PATTERN),
                 CallbackQueryHandler(unlink_shop.display_unlink_shop,
-                                     pattern=Navigation),
+                                     pattern=callback_data.NAVIGATION_PATTERN),
                 CallbackQueryHandler(unlink_shop.unlink_shop,
                                      pattern=f"^{il_keyboards.YES}$"),
                 CallbackQueryHandler(user_menu.display_user_menu,
@@ -68,9 +68,9 @@ def register_handlers(application: Application):
             ],
             States.SHOP_LIST: [
                 CallbackQueryHandler(shop_menu.display_shop_menu,
-                                     pattern=ShopInfo),
+                                     pattern=callback_data.SHOP_INFO_PATTERN),
                 CallbackQueryHandler(shop_list.display_shop_list,
-                                     pattern=Navigation),
+                                     pattern=callback_data.NAVIGATION_PATTERN),
                 CallbackQueryHandler(user_menu.display_user_menu,
                                      pattern=f"^{il_keyboards.BACK}$", ),
             ],
@@ -104,10 +104,7 @@ def register_handlers(application: Application):
                                      pattern=f"^{il_keyboards.BACK}$"),
             ],
         },
-        fallbacks=[
-            CallbackQueryHandler(invalid_button.handle_invalid_button,
-                                 pattern=InvalidCallbackData)
-        ],
+        fallbacks=[],
     )
 
     application.add_handlers(
@@ -144,8 +141,10 @@ def register_handlers(application: Application):
             # special handlers
             CallbackQueryHandler(auxiliary.do_nothing,
                                  pattern=il_keyboards.DO_NOTHING),
+            # encoded objects that can't be decoded
             CallbackQueryHandler(invalid_button.handle_invalid_button,
-                                 pattern=InvalidCallbackData),
+                                 pattern=callback_data.is_invalid),
+            # buttons that are not expected in the current state
             CallbackQueryHandler(invalid_button.unexpected_callback),
             MessageHandler(filters.COMMAND,
                            command_handlers.unexpected_command),
@@ -1,7 +1,18 @@
-from django.db.models.signals import pre_save
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
 from django.dispatch import receiver
 
+from shop.models import Shop
+from tg_bot import db_executor
 from tg_bot.models import TelegramUser
+from tg_bot.services import TelegramUserService
 from tg_bot.tasks import ban_notification
 
 
@@ -18,3 +29,70 @@ def notify_banned_user(sender, instance: TelegramUser, **kwargs):
                 ban_notification.send_ban_unban_notification(current)
             except Exception as e:
                 print(e.__repr__())
+
+
+@receiver(post_save, sender=TelegramUser)
+@receiver(post_delete, sender=TelegramUser)
+def invalidate_cached_statuses(sender, instance: TelegramUser, **kwargs):
+    """
+    Statuses (ban, subscription, role, etc.) may have changed.
+
+    The cache of this process is invalidated at once, other processes
+    clear their caches when they see the new version.
+    """
+    tg_user_service = TelegramUserService()
+    tg_user_service.increment_statuses_version()
+    tg_user_service.invalidate_cached_statuses(instance.chat_id)
+
+
+@receiver(m2m_changed, sender=TelegramUser.shops.through)
+def count_linked_shops(
+        sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Maintain TelegramUser.shops_count.
+
+    Handles both sides of the relation: `tg_user.shops.add(shop)` and
+    `shop.telegramuser_set.add(tg_user)`.
+    """
+    if action == "post_add":
+        # pk_set contains only added relations
+        if reverse:
+            _change_shops_count(TelegramUser.objects.filter(pk__in=pk_set), 1)
+        else:
+            _change_shops_count(
+                TelegramUser.objects.filter(pk=instance.pk), len(pk_set))
+    elif action == "pre_remove":
+        # pk_set may contain not linked objects, so existing links are used
+        if reverse:
+            linked = sender.objects.filter(
+                shop_id=instance.pk, telegramuser_id__in=pk_set)
+            _change_shops_count(
+                TelegramUser.objects.filter(
+                    pk__in=linked.values("telegramuser_id")), -1)
+        else:
+            removed_count = sender.objects.filter(
+                telegramuser_id=instance.pk, shop_id__in=pk_set).count()
+            _change_shops_count(
+                TelegramUser.objects.filter(pk=instance.pk), -removed_count)
+    elif action == "pre_clear":
+        if reverse:
+            _change_shops_count(
+                TelegramUser.objects.filter(shops=instance), -1)
+        else:
+            TelegramUser.objects.filter(pk=instance.pk).update(shops_count=0)
+
+
+@receiver(pre_delete, sender=Shop)
+def count_unlinked_by_deletion(sender, instance: Shop, **kwargs):
+    """Links of deleted Shop are deleted without m2m_changed signal."""
+    _change_shops_count(TelegramUser.objects.filter(shops=instance), -1)
+
+
+def _change_shops_count(tg_users, delta: int):
+    if delta:
+        tg_users.update(shops_count=F("shops_count") + delta)
+
+
+@receiver(connection_created)
+def set_up_db_connection(sender, connection, **kwargs):
+    db_executor.set_up_connection(connection)
@@ -0,0 +1,28 @@
+from django.test import SimpleTestCase
+
+from tg_bot import callback_data
+from tg_bot.data_classes import Navigation, ShopInfo
+from tg_bot.keyboards import inline_keyboards
+
+
+class CallbackDataTest(SimpleTestCase):
+    """Buttons that are answered as invalid by the fallback handler."""
+
+    def test_encoded_objects_are_valid(self):
+        encoded = [
+            callback_data.encode_shop_info(ShopInfo(id=1, name="")),
+            callback_data.encode_navigation(Navigation(limit=5, page=1)),
+            callback_data.encode_navigation(
+                Navigation(limit=5, page=2, after=10)),
+        ]
+        for data in encoded:
+            self.assertFalse(callback_data.is_invalid(data), data)
+
+    def test_damaged_objects_are_invalid(self):
+        for data in ["s:", "s:x", "n:5", "n:5:1:c:10", "n:5:1:a:"]:
+            self.assertTrue(callback_data.is_invalid(data), data)
+
+    def test_other_buttons_are_not_invalid(self):
+        # e.g. a button of another conversation state
+        for data in [inline_keyboards.YES, inline_keyboards.SHOP_INFO]:
+            self.assertFalse(callback_data.is_invalid(data), data)
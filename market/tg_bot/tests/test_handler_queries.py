@@ -0,0 +1,123 @@
+import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import TestCase
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+from shop.models import Shop
+from shop.services import ShopService
+from tg_bot import db_executor
+from tg_bot.conversation_states import States
+from tg_bot.handlers import command_handlers, shop_menu, unlink_shop
+from tg_bot.keyboards import inline_keyboards
+from tg_bot.models import TelegramUser
+from tg_bot.services import ChatService, TelegramUserService
+from tg_bot.tests.test_telegram_user_loader import _run_in_test_thread
+
+CHAT_ID = 2002
+
+
+class HandlerQueriesTest(TestCase):
+    """
+    Queries made by handlers while one update is processed.
+
+    Requests to Telegram are replaced by mocks, ORM calls are made in the
+    test thread (see TelegramUserLoaderTest). Every update gets a new
+    context, `chat_data` is kept between updates as by the persistence.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shops = [
+            Shop.objects.create(name=f"shop {i}", client_id=str(i),
+                                ozon_api_key=f"key {i}")
+            for i in range(2)
+        ]
+        cls.tg_user = TelegramUser.objects.create(
+            chat_id=CHAT_ID, role=TelegramUser.Roles.SELLER)
+        cls.tg_user.shops.add(*cls.shops)
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(db_executor, "run", _run_in_test_thread),
+            mock.patch.object(Message, "reply_text", mock.AsyncMock()),
+            mock.patch.object(CallbackQuery, "answer", mock.AsyncMock()),
+            mock.patch.object(CallbackQuery, "edit_message_text",
+                              mock.AsyncMock()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        TelegramUserService().invalidate_cached_statuses(CHAT_ID)
+        for shop in self.shops:
+            ShopService().invalidate_shop_info(shop.pk)
+        self.chat_data = {}
+
+    def make_context(self):
+        return SimpleNamespace(chat_data=self.chat_data)
+
+    def make_message(self, text: str) -> Message:
+        return Message(
+            1,
+            datetime.datetime.now(),
+            Chat(CHAT_ID, Chat.PRIVATE),
+            from_user=User(CHAT_ID, "seller", False),
+            text=text,
+        )
+
+    def make_callback_update(self, data: str) -> Update:
+        query = CallbackQuery(
+            "1",
+            User(CHAT_ID, "seller", False),
+            "1",
+            message=self.make_message("menu"),
+            data=data,
+        )
+        return Update(1, callback_query=query)
+
+    def test_start_displays_user_menu_with_one_query(self):
+        update = Update(1, message=self.make_message("/start"))
+        with self.assertNumQueries(1):
+            async_to_sync(command_handlers.start)(update, self.make_context())
+        Message.reply_text.assert_awaited_once()
+
+    def test_start_of_known_user_does_not_query(self):
+        update = Update(1, message=self.make_message("/start"))
+        async_to_sync(command_handlers.start)(update, self.make_context())
+        with self.assertNumQueries(0):
+            async_to_sync(command_handlers.start)(update, self.make_context())
+
+    def test_unlink_shop(self):
+        context = self.make_context()
+        shop_info = async_to_sync(ShopService().get_shop_info_by_id)(
+            self.shops[0].pk)
+        ChatService(CHAT_ID, context).set_shop_info_to_unlink(shop_info)
+        update = self.make_callback_update(inline_keyboards.YES)
+        # TgUser, removing of the relation (count, counter, delete),
+        # TgUser after the change, the page of the shop list
+        with self.assertNumQueries(6):
+            state = async_to_sync(unlink_shop.unlink_shop)(
+                update, self.make_context())
+        self.assertEqual(state, States.UNLINK_SHOP)
+        self.assertEqual(
+            list(self.tg_user.shops.values_list("id", flat=True)),
+            [self.shops[1].pk])
+
+    def test_display_shop_info(self):
+        context = self.make_context()
+        shop_info = async_to_sync(ShopService().get_shop_info_by_id)(
+            self.shops[0].pk)
+        ChatService(CHAT_ID, context).set_shop_info(shop_info)
+        ShopService().invalidate_shop_info(self.shops[0].pk)
+        update = self.make_callback_update(inline_keyboards.SHOP_INFO)
+        # TgUser statuses and the Shop
+        with self.assertNumQueries(2):
+            async_to_sync(shop_menu.display_shop_info)(
+                update, self.make_context())
+        # both are cached
+        with self.assertNumQueries(0):
+            async_to_sync(shop_menu.display_shop_info)(
+                update, self.make_context())
+        CallbackQuery.edit_message_text.assert_awaited()
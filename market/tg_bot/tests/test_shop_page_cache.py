@@ -0,0 +1,72 @@
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import TestCase
+
+from shop.models import Shop
+from shop.services import ShopService
+from tg_bot import db_executor
+from tg_bot.tests.test_telegram_user_loader import _run_in_test_thread
+
+
+class ShopPageCacheTest(TestCase):
+    """
+    Cached pages of shop lists are outdated by committed changes of Shop.
+
+    A page cached before commit of a change holds the old committed rows,
+    so the cache version must change only after commit.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shops = [
+            Shop.objects.create(name=f"shop {i}", client_id=str(i),
+                                ozon_api_key=f"key {i}")
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        patch = mock.patch.object(db_executor, "run", _run_in_test_thread)
+        patch.start()
+        self.addCleanup(patch.stop)
+        # pages of other tests are in the same cache
+        self.scope = (self.id(),)
+
+    def get_page(self):
+        return async_to_sync(ShopService().paginate_shops_for_buttons)(
+            Shop.objects.all(), limit=5, scope=self.scope)
+
+    def test_page_is_cached(self):
+        self.get_page()
+        with self.assertNumQueries(0):
+            page = self.get_page()
+        self.assertEqual([shop_info.id for shop_info in page],
+                         [shop.pk for shop in self.shops])
+
+    def test_save_outdates_page_after_commit(self):
+        self.get_page()
+        with self.captureOnCommitCallbacks() as callbacks:
+            shop = Shop.objects.get(pk=self.shops[0].pk)
+            shop.name = "changed"
+            shop.save()
+            with self.assertNumQueries(0):
+                self.get_page()
+        self.assertTrue(callbacks)
+        for callback in callbacks:
+            callback()
+        with self.assertNumQueries(1):
+            page = self.get_page()
+        self.assertEqual(page[0].name, "changed")
+
+    def test_toggle_outdates_page_after_commit(self):
+        self.get_page()
+        with self.captureOnCommitCallbacks() as callbacks:
+            async_to_sync(ShopService().switch_activation)(
+                self.shops[1].pk)
+            with self.assertNumQueries(0):
+                self.get_page()
+        for callback in callbacks:
+            callback()
+        with self.assertNumQueries(1):
+            page = self.get_page()
+        self.assertNotEqual(page[1].is_active, self.shops[1].is_active)
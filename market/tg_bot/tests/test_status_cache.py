@@ -0,0 +1,68 @@
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import TestCase
+
+from tg_bot import db_executor
+from tg_bot.models import CacheVersion, TelegramUser
+from tg_bot.services import TelegramUserService
+from tg_bot.tasks import ban_notification
+from tg_bot.tests.test_telegram_user_loader import _run_in_test_thread
+
+CHAT_ID = 3003
+
+
+class StatusCacheTest(TestCase):
+    """Statuses cached by chat_id are dropped after changes of TgUser."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tg_user = TelegramUser.objects.create(
+            chat_id=CHAT_ID, role=TelegramUser.Roles.SELLER)
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(db_executor, "run", _run_in_test_thread),
+            # a ban is notified by Telegram
+            mock.patch.object(ban_notification,
+                              "send_ban_unban_notification"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.service = TelegramUserService()
+        self.service.invalidate_cached_statuses(CHAT_ID)
+
+    def cache_statuses(self):
+        tg_user = async_to_sync(self.service.get_info_by_chat_id)(CHAT_ID)
+        self.service.cache_statuses(tg_user)
+        self.assertIsNotNone(self.service.get_cached_statuses(CHAT_ID))
+
+    def test_save_increments_version(self):
+        version = async_to_sync(self.service.check_statuses_version)(None)
+        self.tg_user.is_banned = True
+        self.tg_user.save()
+        self.assertEqual(
+            CacheVersion.objects.get(name=CacheVersion.TG_USER_STATUSES)
+            .value, (version or 0) + 1)
+
+    def test_change_by_another_process_clears_cache(self):
+        version = async_to_sync(self.service.check_statuses_version)(None)
+        self.cache_statuses()
+        with self.assertNumQueries(1):
+            async_to_sync(self.service.check_statuses_version)(version)
+        self.assertIsNotNone(self.service.get_cached_statuses(CHAT_ID))
+        # as a save in the admin site: signals run there, not here
+        with mock.patch.object(TelegramUserService,
+                               "invalidate_cached_statuses"):
+            self.tg_user.is_banned = True
+            self.tg_user.save()
+        self.assertIsNotNone(self.service.get_cached_statuses(CHAT_ID))
+        async_to_sync(self.service.check_statuses_version)(version)
+        self.assertIsNone(self.service.get_cached_statuses(CHAT_ID))
+
+    def test_statuses_loaded_before_invalidation_are_not_cached(self):
+        tg_user = async_to_sync(self.service.get_info_by_chat_id)(CHAT_ID)
+        self.service.invalidate_cached_statuses(CHAT_ID)
+        self.service.cache_statuses(tg_user)
+        self.assertIsNone(self.service.get_cached_statuses(CHAT_ID))
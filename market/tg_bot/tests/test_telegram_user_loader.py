@@ -0,0 +1,113 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import TestCase
+
+from shop.models import Shop
+from tg_bot import db_executor
+from tg_bot.models import TelegramUser
+from tg_bot.services import TelegramUserService
+from tg_bot.services.chat_services import ChatService
+from tg_bot.services.telegram_user_service import TelegramUserLoader
+
+CHAT_ID = 1001
+
+
+async def _run_in_test_thread(func, *args, **kwargs):
+    # thread sensitive calls are made in the thread of async_to_sync
+    return await sync_to_async(func)(*args, **kwargs)
+
+
+class TelegramUserLoaderTest(TestCase):
+    """
+    Queries of TgUser data while one update is processed.
+
+    ORM calls of `db_executor.run` are made in the test thread, so they
+    use the connection (and the transaction) of the test and are counted
+    by `assertNumQueries`. Coroutines are called by `async_to_sync`.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.shops = [
+            Shop.objects.create(name=f"shop {i}", client_id=str(i),
+                                ozon_api_key=f"key {i}")
+            for i in range(2)
+        ]
+        cls.other_shop = Shop.objects.create(
+            name="other", client_id="9", ozon_api_key="other key")
+        cls.tg_user = TelegramUser.objects.create(
+            chat_id=CHAT_ID, role=TelegramUser.Roles.SELLER)
+        cls.tg_user.shops.add(*cls.shops)
+
+    def setUp(self):
+        patch = mock.patch.object(db_executor, "run", _run_in_test_thread)
+        patch.start()
+        self.addCleanup(patch.stop)
+        TelegramUserService().invalidate_cached_statuses(CHAT_ID)
+        self.context = SimpleNamespace(chat_data={})
+
+    def test_loader_queries_once(self):
+        loader = TelegramUserLoader.from_context(self.context)
+        with self.assertNumQueries(1):
+            tg_user = async_to_sync(loader.get)(CHAT_ID)
+            self.assertIs(async_to_sync(loader.get)(CHAT_ID), tg_user)
+        self.assertEqual(tg_user.id, self.tg_user.pk)
+        self.assertEqual(sorted(tg_user.shop_ids),
+                         sorted(shop.pk for shop in self.shops))
+        self.assertEqual(tg_user.shops_count, 2)
+
+    def test_loader_caches_missing_user(self):
+        loader = TelegramUserLoader.from_context(self.context)
+        with self.assertNumQueries(1):
+            self.assertIsNone(async_to_sync(loader.get)(CHAT_ID + 1))
+            self.assertIsNone(async_to_sync(loader.get)(CHAT_ID + 1))
+
+    def test_loader_invalidate(self):
+        loader = TelegramUserLoader.from_context(self.context)
+        async_to_sync(loader.get)(CHAT_ID)
+        loader.invalidate(CHAT_ID)
+        with self.assertNumQueries(1):
+            async_to_sync(loader.get)(CHAT_ID)
+
+    def test_chat_service_update_queries_once(self):
+        async def process_update():
+            # handlers and services create their own ChatService
+            statuses = await ChatService(CHAT_ID, self.context).get_statuses()
+            chat_service = ChatService(CHAT_ID, self.context)
+            role = await chat_service.get_role()
+            shops = await chat_service.get_shops()
+            is_available = await chat_service.is_shop_available(
+                self.other_shop.pk)
+            shops_count = await chat_service.get_shops_count()
+            return statuses, role, shops, is_available, shops_count
+
+        with self.assertNumQueries(1):
+            statuses, role, shops, is_available, shops_count = \
+                async_to_sync(process_update)()
+        self.assertEqual(statuses, (False, True, False))
+        self.assertEqual(role, ChatService.SELLER_ROLE)
+        self.assertFalse(is_available)
+        self.assertEqual(shops_count, 2)
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(shops.order_by("id"), self.shops)
+
+    def test_get_tg_user_info_after_change(self):
+        chat_service = ChatService(CHAT_ID, self.context)
+        async_to_sync(chat_service.get_tg_user_info)()
+        async_to_sync(chat_service.unlink_shop)(self.shops[0].pk)
+        with self.assertNumQueries(1):
+            tg_user = async_to_sync(chat_service.get_tg_user_info)()
+        self.assertEqual(tg_user.shop_ids, [self.shops[1].pk])
+        self.assertEqual(tg_user.shops_count, 1)
+
+    def test_full_save_keeps_shops_count(self):
+        # loaded before the shop is linked, e.g. a form in the admin site
+        tg_user = TelegramUser.objects.get(pk=self.tg_user.pk)
+        self.tg_user.shops.add(self.other_shop)
+        tg_user.is_banned = True
+        tg_user.save()
+        tg_user.refresh_from_db()
+        self.assertTrue(tg_user.is_banned)
+        self.assertEqual(tg_user.shops_count, 3)
@@ -46,6 +46,9 @@ LOGGED_IN_AS_ADMIN = "✅ Вы вошли в систему как Админи
 WRONG_CREDENTIALS = "❌ Неверный username или password.\n" \
                     "Вы можете ввести пароль повторно:"
 
+TOO_MANY_LOGIN_ATTEMPTS = "⛔️ Слишком много неудачных попыток входа. " \
+                          "Попробуйте позже."
+
 ASK_SHOP_API_KEY = "Введите API key 🔑 вашего магазина:"
 
 API_KEY_RECEIVED = "API key получен. \nОжидайте."
@@ -0,0 +1,89 @@
+"""Concurrent processing of updates that keeps order inside every chat."""
+import asyncio
+import logging
+from collections import Counter
+from typing import Any, Awaitable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates from different chats in parallel.
+
+    Updates from the same chat are processed strictly one by one, in the
+    order they were received, because handlers mutate `context.chat_data`
+    (`expected_input`, `shop_info`, etc.) and conversation states.
+
+    `max_concurrent_updates` limits updates that are processed at the same
+    time, `max_pending_updates` limits updates that are already taken from
+    the update queue (including the ones waiting for their chat).
+    Waiting updates do not occupy processing slots, so one busy chat can't
+    block the others.
+    """
+
+    def __init__(self,
+                 max_concurrent_updates: int,
+                 max_pending_updates: int = 1024):
+        if max_pending_updates < max_concurrent_updates:
+            raise ValueError("`max_pending_updates` must be greater or equal "
+                             "to `max_concurrent_updates`")
+        super().__init__(max_pending_updates)
+        self.max_processing_updates = max_concurrent_updates
+        self._processing_semaphore = asyncio.BoundedSemaphore(
+            max_concurrent_updates)
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Counter[int] = Counter()
+
+    async def do_process_update(
+            self,
+            update: object,
+            coroutine: Awaitable[Any],
+    ) -> None:
+        """Wait for previous updates from the chat, then process update."""
+        chat_id = self._get_chat_id(update)
+        if chat_id is None:
+            async with self._processing_semaphore:
+                await coroutine
+            return
+
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        self._chat_waiters[chat_id] += 1
+        try:
+            async with lock:
+                async with self._processing_semaphore:
+                    await coroutine
+        finally:
+            self._chat_waiters[chat_id] -= 1
+            if not self._chat_waiters[chat_id]:
+                # nobody else waits for this chat, lock can be forgotten
+                del self._chat_waiters[chat_id]
+                del self._chat_locks[chat_id]
+
+    async def initialize(self) -> None:
+        """Nothing to allocate."""
+
+    async def shutdown(self) -> None:
+        """Nothing to free."""
+        if self._chat_locks:
+            logger.warning(f"Shutdown with {len(self._chat_locks)} "
+                           f"chats still processing updates.")
+
+    @staticmethod
+    def _get_chat_id(update: object) -> Optional[int]:
+        """
+        Get id used for ordering.
+
+        Updates without chat (e.g. pre checkout query) are ordered by user,
+        in private chats it is the same id.
+        """
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
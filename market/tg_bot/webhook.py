@@ -0,0 +1,78 @@
+"""
+HTTP server that receives updates (webhook mode without `set_webhook`).
+
+Tornado is only required in webhook mode, so the module is imported only
+there (see `tg_bot.run.run_webhook`).
+"""
+import asyncio
+import json
+import logging
+import re
+from http import HTTPStatus
+from typing import Optional
+
+from django.utils.crypto import constant_time_compare
+from telegram import Bot, Update
+from tornado.httpserver import HTTPServer
+from tornado.web import Application, HTTPError, RequestHandler
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class UpdateHandler(RequestHandler):
+    """Puts every update POSTed as JSON into the update queue."""
+
+    def initialize(self,
+                   bot: Bot,
+                   update_queue: asyncio.Queue,
+                   secret_token: Optional[str]):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token is not None and not constant_time_compare(
+                self.request.headers.get(SECRET_TOKEN_HEADER, ""),
+                self.secret_token):
+            logger.warning("Webhook request with wrong secret token")
+            raise HTTPError(HTTPStatus.FORBIDDEN)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot)
+        except Exception as e:
+            logger.warning(f"Can't parse webhook update: {e!r}")
+            raise HTTPError(HTTPStatus.BAD_REQUEST)
+        if update is None:
+            raise HTTPError(HTTPStatus.BAD_REQUEST)
+        await self.update_queue.put(update)
+        self.set_status(HTTPStatus.OK)
+
+
+class WebhookServer:
+    """Tornado server with one `UpdateHandler` on `url_path`."""
+
+    def __init__(self,
+                 listen: str,
+                 port: int,
+                 url_path: str,
+                 bot: Bot,
+                 update_queue: asyncio.Queue,
+                 secret_token: Optional[str] = None):
+        self.listen = listen
+        self.port = port
+        app = Application([(
+            rf"{re.escape(url_path.rstrip('/'))}/?",
+            UpdateHandler,
+            dict(bot=bot, update_queue=update_queue,
+                 secret_token=secret_token),
+        )])
+        self._http_server = HTTPServer(app)
+
+    async def serve(self):
+        """Start listening, requests are handled by the running loop."""
+        self._http_server.listen(self.port, self.listen)
+
+    async def shutdown(self):
+        self._http_server.stop()
+        await self._http_server.close_all_connections()
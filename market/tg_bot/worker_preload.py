@@ -0,0 +1,18 @@
+"""
+Preloaded by the fork server of bot workers (see tg_bot.workers).
+
+The fork server is started by exec, so it has no threads, event loops or
+connections of the front process. Django and the bot modules are imported
+here once and frozen, so workers forked from the server share them with
+copy-on-write.
+"""
+import gc
+
+import django
+
+django.setup()
+
+import tg_bot.bot
+
+gc.collect()
+gc.freeze()
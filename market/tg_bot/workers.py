@@ -0,0 +1,314 @@
+"""
+Multi-process worker mode.
+
+The front process receives updates (polling or webhook) and forwards them
+to worker processes, the worker is chosen by `chat_id`, so `chat_data` and
+ConversationHandler states of a chat always live in the same process.
+Each worker runs its own Application with all handlers.
+Workers are forked by the multiprocessing fork server, a clean process
+(no threads, event loops or connections) that preloads Django and the bot
+modules (`tg_bot.worker_preload`), so the front process is never forked.
+A worker that died is started again when the next update of its chats
+comes (`workers.respawned` metric), updates that it was processing are lost.
+
+In-memory shop caches (`shop.services.shop_services`) of all processes are
+kept consistent: an invalidation in a worker is sent to the front, the
+front applies it and sends it to the other workers, an invalidation in the
+front (e.g. a broker message) is sent to all workers.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import socket
+from collections.abc import Callable
+from typing import Optional
+
+from django import db
+from django.conf import settings
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+
+from shop.services import ShopService
+from tg_bot import metrics
+from tg_bot.services import TelegramUserService
+
+logger = logging.getLogger(__name__)
+
+# max size of one forwarded update
+READ_LIMIT = 2 ** 20
+# imported by the fork server before it forks workers
+PRELOAD_MODULE = "tg_bot.worker_preload"
+
+METRICS_LOG_INTERVAL = settings.TG_METRICS_LOG_INTERVAL
+USER_STATUS_CHECK_INTERVAL = settings.TG_USER_STATUS_CHECK_INTERVAL
+
+# keys of messages between the front and workers
+UPDATE_KEY = "update"
+INVALIDATE_SHOP_KEY = "invalidate_shop"
+
+
+class WorkerPool:
+    """
+    Starts worker processes and forwards updates to them.
+
+    Every worker is connected with the front process by a unix socket pair,
+    messages are sent as newline-delimited JSON:
+    `{"update": {...}}` to the worker, `{"invalidate_shop": id}` both ways.
+    """
+
+    def __init__(self,
+                 workers_count: int,
+                 build_application: Callable[[], Application]):
+        """
+        :param workers_count: number of worker processes.
+        :param build_application: creates Application with handlers,
+            called in each worker, it must be a module level function
+            (it is pickled to the worker).
+        """
+        if workers_count < 1:
+            raise ValueError(f"Wrong {workers_count=}")
+        self.workers_count = workers_count
+        self.build_application = build_application
+        self._processes: list[multiprocessing.Process] = []
+        self._sockets: list[socket.socket] = []
+        self._writers: list[asyncio.StreamWriter] = []
+        self._respawn_locks: list[asyncio.Lock] = []
+        self._receive_tasks: list[asyncio.Task] = []
+        self._invalidation_listener: Optional[Callable[[int], None]] = None
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload([PRELOAD_MODULE])
+
+    def start(self):
+        """
+        Start the fork server and workers.
+
+        Workers are forked by the fork server, modules it preloaded are
+        shared by workers with copy-on-write.
+        """
+        for index in range(self.workers_count):
+            front_sock, worker_sock = socket.socketpair()
+            self._processes.append(self._start_process(index, worker_sock))
+            worker_sock.close()
+            self._sockets.append(front_sock)
+        logger.info(f"Started {self.workers_count} bot workers.")
+
+    async def connect(self, application: Optional[Application] = None):
+        """Open streams to workers (use as `post_init`)."""
+        for sock in self._sockets:
+            reader, writer = await asyncio.open_unix_connection(
+                sock=sock, limit=READ_LIMIT)
+            self._writers.append(writer)
+            self._receive_tasks.append(
+                asyncio.create_task(self._receive(reader, writer)))
+            self._respawn_locks.append(asyncio.Lock())
+        self._invalidation_listener = _call_soon_threadsafe(
+            asyncio.get_running_loop(), self._broadcast_invalidation)
+        ShopService().add_invalidation_listener(self._invalidation_listener)
+
+    async def close(self, application: Optional[Application] = None):
+        """
+        Close streams and wait for workers (use as `post_shutdown`).
+
+        Workers finish processing received updates and stop on EOF.
+        """
+        if self._invalidation_listener is not None:
+            ShopService().remove_invalidation_listener(
+                self._invalidation_listener)
+            self._invalidation_listener = None
+        for task in self._receive_tasks:
+            task.cancel()
+        self._receive_tasks.clear()
+        for writer in self._writers:
+            writer.close()
+        for writer in self._writers:
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+        self._writers.clear()
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                logger.warning(f"Worker {process.name} is killed.")
+                process.kill()
+        logger.info("Bot workers are stopped.")
+
+    def get_worker_index(self, update: Update) -> int:
+        """Choose worker by chat (or by user if there is no chat)."""
+        if update.effective_chat is not None:
+            key = update.effective_chat.id
+        elif update.effective_user is not None:
+            key = update.effective_user.id
+        else:
+            key = 0
+        return key % self.workers_count
+
+    async def forward(
+            self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Send update to its worker (use as TypeHandler callback).
+
+        If the worker is dead, it is respawned and the update is sent to
+        the new one.
+        """
+        index = self.get_worker_index(update)
+        data = _encode({UPDATE_KEY: update.to_dict()})
+        try:
+            await self._send(index, data)
+        except ConnectionError as e:
+            logger.error(f"Can't send update to worker {index}: {e!r}")
+            await self._respawn(index)
+            await self._send(index, data)
+
+    async def _send(self, index: int, data: bytes):
+        if not self._processes[index].is_alive():
+            await self._respawn(index)
+        writer = self._writers[index]
+        writer.write(data)
+        await writer.drain()
+
+    async def _respawn(self, index: int):
+        """Replace dead worker (or worker with broken socket) by a new one."""
+        async with self._respawn_locks[index]:
+            process = self._processes[index]
+            if process.is_alive() and not self._writers[index].is_closing():
+                # already respawned while waiting for the lock
+                return
+            if process.is_alive():
+                process.kill()
+                process.join(timeout=10)
+            logger.error(f"Worker {process.name} is dead "
+                         f"(exitcode={process.exitcode}), respawning it.")
+            metrics.counter("workers.respawned").inc()
+            self._writers[index].close()
+            front_sock, worker_sock = socket.socketpair()
+            self._sockets[index] = front_sock
+            reader, writer = await asyncio.open_unix_connection(
+                sock=front_sock, limit=READ_LIMIT)
+            self._writers[index] = writer
+            self._receive_tasks[index] = asyncio.create_task(
+                self._receive(reader, writer))
+            # the new worker starts with empty caches, it does not miss
+            # invalidations
+            self._processes[index] = self._start_process(index, worker_sock)
+            worker_sock.close()
+
+    async def _receive(self,
+                       reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter):
+        """Apply invalidations from the worker and send them to others."""
+        try:
+            while line := await reader.readline():
+                shop_id = json.loads(line)[INVALIDATE_SHOP_KEY]
+                ShopService().invalidate_shop_info(shop_id, notify=False)
+                self._broadcast_invalidation(shop_id, exclude=writer)
+        except ConnectionError:
+            # the worker is dead, it is respawned by `forward`
+            pass
+
+    def _broadcast_invalidation(
+            self,
+            shop_id: int,
+            exclude: Optional[asyncio.StreamWriter] = None,
+    ):
+        """Send invalidation of ShopInfo to workers (except `exclude`)."""
+        data = _encode({INVALIDATE_SHOP_KEY: shop_id})
+        for writer in self._writers:
+            if writer is not exclude and not writer.is_closing():
+                writer.write(data)
+
+    def _start_process(
+            self,
+            index: int,
+            worker_sock: socket.socket,
+    ) -> multiprocessing.Process:
+        """
+        Start worker by the fork server.
+
+        `worker_sock` is passed to the worker, the caller closes it.
+        """
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, worker_sock, self.build_application),
+            name=f"tg_bot_worker_{index}",
+            daemon=True,
+        )
+        process.start()
+        return process
+
+
+def _worker_main(index: int,
+                 worker_sock: socket.socket,
+                 build_application: Callable[[], Application]):
+    """Entry point of worker process."""
+    # front process handles stop signals and closes the socket
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # connections must not be shared with the fork server
+    db.connections.close_all()
+
+    application = build_application()
+    asyncio.run(_serve(application, worker_sock))
+    logger.info(f"Worker {index} is stopped.")
+
+
+async def _serve(application: Application, sock: socket.socket):
+    """
+    Put updates from the front process into update_queue until EOF.
+
+    Invalidations are applied when they are read, before queued updates.
+    """
+    reader, writer = await asyncio.open_unix_connection(
+        sock=sock, limit=READ_LIMIT)
+
+    def send_invalidation(shop_id: int):
+        if not writer.is_closing():
+            writer.write(_encode({INVALIDATE_SHOP_KEY: shop_id}))
+
+    shop_service = ShopService()
+    invalidation_listener = _call_soon_threadsafe(
+        asyncio.get_running_loop(), send_invalidation)
+    shop_service.add_invalidation_listener(invalidation_listener)
+    background_tasks = []
+    if METRICS_LOG_INTERVAL:
+        background_tasks.append(asyncio.create_task(
+            metrics.log_periodically(METRICS_LOG_INTERVAL)))
+    if USER_STATUS_CHECK_INTERVAL:
+        background_tasks.append(asyncio.create_task(
+            TelegramUserService().watch_statuses_version(
+                USER_STATUS_CHECK_INTERVAL)))
+    async with application:
+        await application.start()
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if UPDATE_KEY in message:
+                    update = Update.de_json(
+                        message[UPDATE_KEY], application.bot)
+                    await application.update_queue.put(update)
+                else:
+                    shop_service.invalidate_shop_info(
+                        message[INVALIDATE_SHOP_KEY], notify=False)
+        finally:
+            shop_service.remove_invalidation_listener(invalidation_listener)
+            await application.stop()
+            for task in background_tasks:
+                task.cancel()
+
+
+def _encode(message: dict) -> bytes:
+    return json.dumps(message).encode() + b"\n"
+
+
+def _call_soon_threadsafe(loop: asyncio.AbstractEventLoop,
+                          callback: Callable) -> Callable:
+    """Wrap callback, so it can be called from any thread."""
+    def wrapper(*args):
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # the loop is closed
+            pass
+    return wrapper